@@ -11,7 +11,13 @@ class AgentState(TypedDict):
     """State for the story generation agent."""
 
     story_context: str
+    # Retrieved by rag_node; kept apart from the story so it gets its own share of the prompt
+    lore: str
     user_input: str
     conversation_history: Annotated[list, add_messages]
     safety_passed: bool
     response: str
+    # Scheduler fairness is per session; empty for requests without one
+    session_id: str
+    # "fast" or "quality" to pick the model tier; empty lets model_router decide from the input
+    latency: str
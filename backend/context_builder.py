@@ -0,0 +1,226 @@
+"""
+Builds the prompt for llm_node within a token budget.
+The story is split into sections (paragraphs, with long ones cut into chunks). The
+most recent sections go into the prompt verbatim; older ones are represented by a
+rolling summary kept per session. The summary is folded forward in the background
+as sections age out of the recent window, and rebuilt only when text it already
+covers changes, so prompt size stays flat however long the story grows and no
+request waits for a summary.
+"""
+
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+import llm_scheduler
+import metrics
+from llm_client import SMALL_MODEL, get_llm, model_options
+
+# Estimated tokens for the whole prompt; keep it below the model's num_ctx minus room for the reply
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("SAFETALE_CONTEXT_TOKENS", "1536"))
+# Caps per part, filled in this order until the budget runs out
+RECENT_STORY_TOKENS = 600
+SUMMARY_TOKENS = 200
+LORE_TOKENS = 250
+HISTORY_TOKENS = 300
+HISTORY_MESSAGES = 10
+
+SECTION_CHARS = 800
+# Older text folded into the summary by one LLM call
+SUMMARY_INPUT_TOKENS = 1500
+MAX_SUMMARIZED_SESSIONS = 1000
+
+SUMMARY_PROMPT = (
+    "You keep a running summary of a children's fairy tale for a storyteller.\n"
+    "Summary so far:\n{summary}\n\n"
+    "Next part of the story:\n{text}\n\n"
+    "Rewrite the summary so it also covers the next part. Keep characters, places and "
+    "open plot threads. Answer with the summary only, in under {words} words."
+)
+
+# (session_id, summary so far, next part of the story) -> updated summary
+Summarizer = Callable[[str, str, str], Awaitable[str]]
+
+
+def estimate_tokens(text: str) -> int:
+    """About four characters per token for English text with Llama tokenizers."""
+    return (len(text) + 3) // 4
+
+
+def _head(text: str, tokens: int) -> str:
+    return text[: max(tokens, 0) * 4]
+
+
+def _tail(text: str, tokens: int) -> str:
+    return text[-tokens * 4 :] if tokens > 0 else ""
+
+
+def _digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def split_sections(text: str) -> list[str]:
+    """Paragraphs, with long ones cut at word boundaries; appending text leaves earlier sections unchanged."""
+    sections = []
+    for paragraph in text.split("\n\n"):
+        paragraph = paragraph.strip()
+        while len(paragraph) > SECTION_CHARS:
+            cut = paragraph.rfind(" ", 0, SECTION_CHARS)
+            if cut <= 0:
+                cut = SECTION_CHARS
+            sections.append(paragraph[:cut])
+            paragraph = paragraph[cut:].lstrip()
+        if paragraph:
+            sections.append(paragraph)
+    return sections
+
+
+def split_recent(sections: list[str], tokens: int = RECENT_STORY_TOKENS) -> tuple[list[str], list[str]]:
+    """(older, recent): the latest sections that fit in tokens, and always at least the last one."""
+    start = len(sections)
+    used = 0
+    while start > 0:
+        used += estimate_tokens(sections[start - 1])
+        if used > tokens and start < len(sections):
+            break
+        start -= 1
+    return sections[:start], sections[start:]
+
+
+class StorySummary:
+    def __init__(self) -> None:
+        self.text = ""
+        # Digests of the older sections the text covers
+        self.covered: list[bytes] = []
+        self.task: asyncio.Task | None = None
+
+
+class StorySummaries:
+    """Rolling summaries of the older part of each session's story, refreshed in the background."""
+
+    def __init__(self, summarize: Summarizer | None = None, max_sessions: int = MAX_SUMMARIZED_SESSIONS) -> None:
+        self.summarize = summarize
+        self.max_sessions = max_sessions
+        self._sessions: OrderedDict[str, StorySummary] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def summary_for(self, key: str, older: list[str]) -> str:
+        """The current summary for these older sections (possibly a step behind); starts a refresh if it is."""
+        if self.summarize is None or not older:
+            return ""
+        state = self._sessions.get(key)
+        if state is None:
+            state = self._sessions[key] = StorySummary()
+            while len(self._sessions) > self.max_sessions:
+                _key, evicted = self._sessions.popitem(last=False)
+                if evicted.task is not None:
+                    evicted.task.cancel()
+        self._sessions.move_to_end(key)
+        digests = [_digest(section) for section in older]
+        # A summary covering more than the older sections (text was deleted) is still usable
+        if state.task is None and digests != state.covered[: len(digests)]:
+            state.task = asyncio.create_task(self._refresh(key, state, older, digests))
+        return state.text
+
+    async def close(self) -> None:
+        sessions, self._sessions = self._sessions, OrderedDict()
+        refreshes = [state.task for state in sessions.values() if state.task is not None]
+        for refresh in refreshes:
+            refresh.cancel()
+        await asyncio.gather(*refreshes, return_exceptions=True)
+
+    async def _refresh(self, key: str, state: StorySummary, older: list[str], digests: list[bytes]) -> None:
+        try:
+            start = len(state.covered)
+            if digests[:start] == state.covered:
+                result, text = "incremental", state.text
+            else:
+                # Text the summary covers was edited: summarize again from the beginning
+                result, start, text = "full", 0, ""
+            while start < len(older):
+                end, used = start, 0
+                while end < len(older) and (end == start or used + estimate_tokens(older[end]) < SUMMARY_INPUT_TOKENS):
+                    # One more token for the paragraph break between sections
+                    used += estimate_tokens(older[end]) + 1
+                    end += 1
+                text = await self.summarize(key, text, "\n\n".join(older[start:end]))
+                # Each batch leaves a usable summary, so long stories catch up gradually
+                state.text, state.covered = _head(text, SUMMARY_TOKENS), digests[:end]
+                start = end
+            metrics.STORY_SUMMARIES.inc(labels=(result,))
+        except Exception:
+            metrics.STORY_SUMMARIES.inc(labels=("failed",))
+        finally:
+            state.task = None
+
+
+async def summarize_with_llm(session_id: str, summary: str, text: str) -> str:
+    """Fold the next part of the story into the summary with the small model, sharing the scheduler."""
+    prompt = SUMMARY_PROMPT.format(summary=summary or "(none yet)", text=text, words=SUMMARY_TOKENS * 3 // 4)
+    async with llm_scheduler.scheduler.slot(session_id):
+        llm = get_llm(SMALL_MODEL)
+        response = await llm.ainvoke(prompt, options=model_options(SMALL_MODEL, num_predict=SUMMARY_TOKENS))
+    return str(response.content).strip()
+
+
+@dataclass
+class PromptParts:
+    """What goes into a story prompt, before build_messages fits it into a token budget."""
+
+    system: str
+    user_input: str
+    story_context: str = ""
+    lore: str = ""
+    history: list = field(default_factory=list)
+    # Keys the rolling summary; requests without one share summaries by the story's opening
+    session_id: str = ""
+
+
+def _recent_history(history: list, budget: int) -> list:
+    """The latest turns of the history that fit in budget, oldest first."""
+    kept: list = []
+    for msg in reversed(history[-HISTORY_MESSAGES:]):
+        tokens = estimate_tokens(str(msg.content))
+        if tokens > budget:
+            break
+        budget -= tokens
+        kept.insert(0, msg)
+    return kept
+
+
+def build_messages(parts: PromptParts, budget: int = CONTEXT_TOKEN_BUDGET) -> list[BaseMessage]:
+    """System prompt, recent history, then summary, recent story and lore, then the user's input, within budget."""
+    remaining = budget - estimate_tokens(parts.system) - estimate_tokens(parts.user_input)
+
+    older, recent_sections = split_recent(split_sections(parts.story_context))
+    recent = _tail("\n\n".join(recent_sections), min(RECENT_STORY_TOKENS, remaining))
+    remaining -= estimate_tokens(recent)
+    summary = ""
+    if older:
+        key = parts.session_id or _digest(older[0]).hex()
+        summary = _head(summaries.summary_for(key, older), min(SUMMARY_TOKENS, remaining))
+        remaining -= estimate_tokens(summary)
+    lore = _head(parts.lore, min(LORE_TOKENS, remaining))
+    remaining -= estimate_tokens(lore)
+
+    # The story changes every turn, so it follows the history: instructions and past turns
+    # stay a stable prefix of the prompt that Ollama can keep in its KV cache
+    sections = (("Story so far (summary)", summary), ("Current story context", recent), ("Relevant lore", lore))
+    context = "\n\n".join(f"{title}:\n{text}" for title, text in sections if text)
+    messages = [SystemMessage(content=parts.system), *_recent_history(parts.history, min(HISTORY_TOKENS, remaining))]
+    if context:
+        messages.append(HumanMessage(content=context))
+    messages.append(HumanMessage(content=parts.user_input))
+    metrics.PROMPT_TOKENS.observe(sum(estimate_tokens(str(m.content)) for m in messages))
+    return messages
+
+
+summaries = StorySummaries(summarize_with_llm)
+metrics.STORY_SUMMARY_SESSIONS.set_function(lambda: len(summaries))
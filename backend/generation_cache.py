@@ -0,0 +1,305 @@
+"""
+Cache of LLM story continuations, consulted by llm_node before calling the model.
+Exact entries are keyed on a hash of the normalized user input, the prompt context
+(story context and history) and the model. An optional semantic tier also matches
+inputs whose embeddings are close enough, within the same context and model.
+Each key collects a few candidate responses and serves them in rotation, so the
+variety of sampling at temperature 0.7 is kept. Entries expire after a TTL and are
+evicted least-recently-used past an entry or byte bound; with a *.db path they are
+also kept in SQLite and survive restarts. Writes to SQLite are handed to a single
+writer thread in order, so the event loop never waits on the disk.
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import metrics
+
+# SQLite file that keeps the cache across restarts; empty keeps it in memory only, "off" disables it
+GENERATION_CACHE_PATH = os.environ.get("SAFETALE_GENERATION_CACHE", "")
+# Cosine similarity for the semantic tier, e.g. 0.95; empty disables it
+GENERATION_CACHE_SIMILARITY = os.environ.get("SAFETALE_GENERATION_CACHE_SIMILARITY", "")
+CACHE_EMBED_MODEL = "nomic-embed-text"
+
+GENERATION_CACHE_TTL = 60 * 60
+GENERATION_CACHE_MAX_ENTRIES = 10_000
+GENERATION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# A key is served from cache once it holds this many responses; until then requests still reach the LLM
+GENERATION_CACHE_CANDIDATES = 3
+
+# Rough per-entry bookkeeping cost on top of responses and embedding
+_ENTRY_OVERHEAD = 256
+
+Embedder = Callable[[str], Awaitable[list[float]]]
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def _digest(*parts: str) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _cosine(a: list[float], b: list[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class CacheEntry:
+    def __init__(self, group: str, created: float, embedding: list[float] | None = None) -> None:
+        self.group = group
+        self.created = created
+        self.embedding = embedding
+        self.candidates: list[str] = []
+        self.served = 0
+
+    def size(self) -> int:
+        return (
+            _ENTRY_OVERHEAD
+            + sum(len(c.encode("utf-8")) for c in self.candidates)
+            + 8 * len(self.embedding or ())
+        )
+
+
+def _keys(model: str, context: str, user_input: str) -> "tuple[str, str]":
+    """(key, group) of a prompt: the group is everything but the user input."""
+    group = _digest(model, context)
+    return _digest(group, normalize(user_input)), group
+
+
+class CacheLookup:
+    """Result of GenerationCache.lookup(); pass it back to store() after a miss."""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        key: str,
+        group: str,
+        embedding: list[float] | None,
+        response: str | None,
+        prompt: "tuple[str, str, str]",
+    ) -> None:
+        self.key = key
+        self.group = group
+        self.embedding = embedding
+        self.response = response
+        # (model, context, user input), to re-key the entry if another model answers
+        self.prompt = prompt
+
+
+# Each limit is its own tuning knob with an env default, like the other services' settings
+class GenerationCache:  # pylint: disable=too-many-instance-attributes
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        path: str | Path | None = None,
+        *,
+        ttl: float = GENERATION_CACHE_TTL,
+        max_entries: int = GENERATION_CACHE_MAX_ENTRIES,
+        max_bytes: int = GENERATION_CACHE_MAX_BYTES,
+        candidates: int = GENERATION_CACHE_CANDIDATES,
+        embedder: Embedder | None = None,
+        similarity: float = 0.95,
+    ) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.candidates = candidates
+        self.embedder = embedder
+        self.similarity = similarity
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._bytes = 0
+        self._db: sqlite3.Connection | None = None
+        self._writer: ThreadPoolExecutor | None = None
+        if path:
+            # Opened and loaded before serving (the process-wide cache is built at import);
+            # after that only the writer thread touches the connection
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generation-cache")
+            self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS generations (key TEXT PRIMARY KEY, grp TEXT NOT NULL, "
+                "created REAL NOT NULL, used REAL NOT NULL, embedding TEXT, candidates TEXT NOT NULL)"
+            )
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def bytes(self) -> int:
+        return self._bytes
+
+    async def lookup(self, model: str, context: str, user_input: str) -> CacheLookup:
+        """Find a cached response for this prompt; response is None on a miss."""
+        key, group = _keys(model, context, user_input)
+        prompt = (model, context, user_input)
+        now = time.time()
+        entry = self._get(key, now)
+        if entry is not None and len(entry.candidates) >= self.candidates:
+            metrics.GENERATION_CACHE_REQUESTS.inc(labels=("exact",))
+            return CacheLookup(key, group, entry.embedding, self._serve(key, entry), prompt)
+        if self.embedder is None:
+            metrics.GENERATION_CACHE_REQUESTS.inc(labels=("miss",))
+            return CacheLookup(key, group, None, None, prompt)
+        embedding = entry.embedding if entry is not None else await self._embed(user_input)
+        if embedding is not None and entry is None:
+            match = self._nearest(group, embedding, now)
+            if match is not None:
+                metrics.GENERATION_CACHE_REQUESTS.inc(labels=("semantic",))
+                return CacheLookup(key, group, embedding, self._serve(*match), prompt)
+        metrics.GENERATION_CACHE_REQUESTS.inc(labels=("miss",))
+        return CacheLookup(key, group, embedding, None, prompt)
+
+    def store(self, lookup: CacheLookup, response: str, model: str | None = None) -> None:
+        """
+        Add a freshly generated response as another candidate for the looked-up key.
+        If a different model than the one looked up answered, it is stored under that model.
+        """
+        key, group = lookup.key, lookup.group
+        if model is not None and model != lookup.prompt[0]:
+            key, group = _keys(model, *lookup.prompt[1:])
+        now = time.time()
+        entry = self._get(key, now)
+        if entry is None:
+            entry = CacheEntry(group, now, lookup.embedding)
+            self._entries[key] = entry
+        else:
+            self._bytes -= entry.size()
+        if len(entry.candidates) < self.candidates:
+            entry.candidates.append(response)
+        self._bytes += entry.size()
+        self._entries.move_to_end(key)
+        self._write(key, entry, now)
+        self._evict()
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+        self._submit("DELETE FROM generations")
+
+    def close(self) -> None:
+        """Finish queued writes and close the database."""
+        if self._db is None:
+            return
+        self._writer.submit(self._db.close)
+        self._writer.shutdown(wait=True)
+        self._db = None
+
+    def _get(self, key: str, now: float) -> CacheEntry | None:
+        entry = self._entries.get(key)
+        if entry is not None and now - entry.created > self.ttl:
+            self._remove(key)
+            return None
+        return entry
+
+    def _serve(self, key: str, entry: CacheEntry) -> str:
+        response = entry.candidates[entry.served % len(entry.candidates)]
+        entry.served += 1
+        self._entries.move_to_end(key)
+        return response
+
+    def _nearest(self, group: str, embedding: list[float], now: float) -> tuple[str, CacheEntry] | None:
+        best: tuple[str, CacheEntry] | None = None
+        best_score = self.similarity
+        for key, entry in list(self._entries.items()):
+            if entry.group != group or entry.embedding is None or len(entry.candidates) < self.candidates:
+                continue
+            if self._get(key, now) is None:
+                continue
+            score = _cosine(embedding, entry.embedding)
+            if score >= best_score:
+                best, best_score = (key, entry), score
+        return best
+
+    async def _embed(self, text: str) -> list[float] | None:
+        try:
+            return await self.embedder(normalize(text))
+        except Exception:
+            return None
+
+    def _evict(self) -> None:
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size()
+        self._submit("DELETE FROM generations WHERE key = ?", (key,))
+
+    def _write(self, key: str, entry: CacheEntry, now: float) -> None:
+        if self._db is None:
+            return
+        self._submit(
+            "INSERT OR REPLACE INTO generations VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                entry.group,
+                entry.created,
+                now,
+                None if entry.embedding is None else json.dumps(entry.embedding),
+                json.dumps(entry.candidates),
+            ),
+        )
+
+    def _submit(self, sql: str, params: tuple = ()) -> None:
+        """Queue a statement for the writer thread (nothing to do without a database)."""
+        if self._db is not None:
+            self._writer.submit(self._db.execute, sql, params)
+
+    def _load(self) -> None:
+        """Read unexpired entries back, least recently used first, then apply the bounds."""
+        self._db.execute("DELETE FROM generations WHERE created < ?", (time.time() - self.ttl,))
+        rows = self._db.execute(
+            "SELECT key, grp, created, embedding, candidates FROM generations ORDER BY used"
+        ).fetchall()
+        for key, group, created, embedding, candidates in rows:
+            entry = CacheEntry(group, created, None if embedding is None else json.loads(embedding))
+            entry.candidates = json.loads(candidates)[: self.candidates]
+            self._entries[key] = entry
+            self._bytes += entry.size()
+        self._evict()
+
+
+def _ollama_embedder() -> Embedder:
+    from langchain_ollama import OllamaEmbeddings
+
+    from llm_client import OLLAMA_BASE_URL
+
+    embeddings = OllamaEmbeddings(model=CACHE_EMBED_MODEL, base_url=OLLAMA_BASE_URL)
+    return embeddings.aembed_query
+
+
+def open_cache(
+    path: str = GENERATION_CACHE_PATH, similarity: str = GENERATION_CACHE_SIMILARITY
+) -> GenerationCache | None:
+    """Build the process-wide cache: on disk for a path, with the semantic tier if a similarity is set."""
+    if path == "off":
+        return None
+    if not similarity:
+        return GenerationCache(path or None)
+    return GenerationCache(path or None, embedder=_ollama_embedder(), similarity=float(similarity))
+
+
+async def close_cache() -> None:
+    """Write out the process-wide cache at shutdown."""
+    if cache is not None:
+        await asyncio.to_thread(cache.close)
+
+
+cache = open_cache()
+metrics.GENERATION_CACHE_ENTRIES.set_function(lambda: len(cache) if cache is not None else 0)
+metrics.GENERATION_CACHE_BYTES.set_function(lambda: cache.bytes if cache is not None else 0)
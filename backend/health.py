@@ -0,0 +1,139 @@
+"""
+Health probes for SafeTale Sync.
+Liveness uses cheap probes (Ollama's model list and Qdrant's readiness endpoint),
+cached for a few seconds, so load balancer polling costs no generation. A deep
+probe runs a real generation in the background every few minutes; readiness and
+/api/health serve its cached result, and /api/health/deep runs one on demand.
+A story generation that succeeds counts as a passing deep probe.
+"""
+
+import asyncio
+import time
+
+import httpx
+
+import metrics
+from llm_client import DEFAULT_MODEL, OLLAMA_BASE_URL, check_llm_responding
+from lore_tools import QDRANT_HOST, QDRANT_PORT
+from single_flight import SingleFlight
+
+PROBE_TIMEOUT = 2.0
+# Cheap probe results are shared by every health request within this many seconds
+CHEAP_PROBE_TTL = 5.0
+DEEP_PROBE_INTERVAL = 300.0
+# A deep probe result older than this no longer counts, e.g. when the background loop is stuck
+DEEP_PROBE_TTL = 900.0
+
+
+class ProbeResult:
+    def __init__(self, ok: bool, detail: str, checked_at: float | None = None) -> None:
+        self.ok = ok
+        self.detail = detail
+        self.checked_at = time.monotonic() if checked_at is None else checked_at
+
+    def age(self) -> float:
+        return time.monotonic() - self.checked_at
+
+    def as_dict(self) -> dict:
+        return {"ok": self.ok, "detail": self.detail, "age_s": round(self.age(), 1)}
+
+
+# Probe settings, both cached results and the client/task they are probed with
+class HealthMonitor:  # pylint: disable=too-many-instance-attributes
+    def __init__(
+        self,
+        cheap_ttl: float = CHEAP_PROBE_TTL,
+        deep_interval: float = DEEP_PROBE_INTERVAL,
+        deep_ttl: float = DEEP_PROBE_TTL,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ) -> None:
+        self.cheap_ttl = cheap_ttl
+        self.deep_interval = deep_interval
+        self.deep_ttl = deep_ttl
+        self.transport = transport
+        self.deep_result: ProbeResult | None = None
+        self._cheap: dict[str, ProbeResult] | None = None
+        self._flights = SingleFlight("health")
+        self._client: httpx.AsyncClient | None = None
+        self._task: asyncio.Task | None = None
+
+    async def liveness(self) -> dict[str, ProbeResult]:
+        """Ollama and Qdrant reachability, probed at most once per cheap_ttl."""
+        cheap = self._cheap
+        if cheap is not None and cheap["ollama"].age() < self.cheap_ttl:
+            return cheap
+        return await self._flights.run("cheap", self._probe_cheap)
+
+    def deep_status(self) -> str:
+        """ok or error for a recent deep probe; pending before the first one or once it is stale."""
+        result = self.deep_result
+        if result is None or result.age() > self.deep_ttl:
+            return "pending"
+        return "ok" if result.ok else "error"
+
+    async def deep(self, max_age: float | None = None) -> ProbeResult:
+        """A real generation's result: the cached one if younger than max_age, otherwise a fresh probe."""
+        result = self.deep_result
+        if result is not None and max_age is not None and result.age() < max_age:
+            return result
+        return await self._flights.run("deep", self._probe_deep)
+
+    def generation_succeeded(self) -> None:
+        self.deep_result = ProbeResult(True, "story generated")
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _run(self) -> None:
+        # Startup already loads the model (warm_up_llm); the first deep probe waits one interval
+        while True:
+            await asyncio.sleep(self.deep_interval)
+            # Skipped while recent generations keep proving the model works
+            await self.deep(max_age=self.deep_interval)
+
+    async def _probe_cheap(self) -> dict[str, ProbeResult]:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=PROBE_TIMEOUT, transport=self.transport)
+        ollama, qdrant = await asyncio.gather(self._probe_ollama(), self._probe_qdrant())
+        self._cheap = {"ollama": ollama, "qdrant": qdrant}
+        return self._cheap
+
+    async def _probe_ollama(self) -> ProbeResult:
+        try:
+            response = await self._client.get(f"{OLLAMA_BASE_URL}/api/tags")
+            response.raise_for_status()
+            models = {m.get("name") for m in response.json().get("models", [])}
+        except Exception as exc:
+            return self._record("ollama", ProbeResult(False, f"unreachable: {exc!r}"))
+        if DEFAULT_MODEL not in models:
+            return self._record("ollama", ProbeResult(False, f"model {DEFAULT_MODEL} is not pulled"))
+        return self._record("ollama", ProbeResult(True, "reachable"))
+
+    async def _probe_qdrant(self) -> ProbeResult:
+        try:
+            response = await self._client.get(f"http://{QDRANT_HOST}:{QDRANT_PORT}/readyz")
+            response.raise_for_status()
+        except Exception as exc:
+            return self._record("qdrant", ProbeResult(False, f"unreachable: {exc!r}"))
+        return self._record("qdrant", ProbeResult(True, "reachable"))
+
+    async def _probe_deep(self) -> ProbeResult:
+        ok, detail = await check_llm_responding()
+        self.deep_result = self._record("deep", ProbeResult(ok, detail))
+        return self.deep_result
+
+    def _record(self, probe: str, result: ProbeResult) -> ProbeResult:
+        metrics.HEALTH_PROBES.inc(labels=(probe, "ok" if result.ok else "error"))
+        return result
+
+
+monitor = HealthMonitor()
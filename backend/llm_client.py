@@ -1,21 +1,108 @@
 """
 Local LLM client for SafeTale Sync.
 Uses LangChain ChatOllama pointed at the local Ollama instance.
+One ChatOllama (and its pooled HTTP connections) per model is shared by the whole
+process; it is rebuilt only when the base URL or keep-alive changes.
 """
 
+import os
+
+import httpx
 from langchain_ollama import ChatOllama
 
 OLLAMA_BASE_URL = "http://localhost:11434"
 DEFAULT_MODEL = "llama3.1:8b"
+# Fast model for short, simple turns (see model_router)
+SMALL_MODEL = os.environ.get("SAFETALE_SMALL_MODEL", "llama3.2:3b")
+TEMPERATURE = 0.7
+
+# Ollama options per model. Every call to a model must use the same num_ctx: Ollama
+# reloads a model when it changes. If both names are the same model, the larger wins.
+MODEL_OPTIONS = {
+    SMALL_MODEL: {"num_ctx": 2048, "num_predict": 192},
+    DEFAULT_MODEL: {"num_ctx": 4096, "num_predict": 384},
+}
+
+# How long Ollama keeps the model loaded after a request: a duration ("30m"),
+# seconds, or -1 to pin it in memory. Ollama's own default unloads after 5 minutes.
+OLLAMA_KEEP_ALIVE = os.environ.get("SAFETALE_OLLAMA_KEEP_ALIVE", "30m")
+
+# HTTP connection pool to Ollama, reused across generations
+LLM_MAX_CONNECTIONS = 32
+LLM_MAX_KEEPALIVE_CONNECTIONS = 16
+LLM_KEEPALIVE_EXPIRY = 300.0
+
+# model -> (base URL and keep-alive it was built with, client)
+_llms: dict[str, tuple[tuple, ChatOllama]] = {}
+
+
+def _keep_alive(value: int | str) -> int | str:
+    """Ollama takes seconds as a number and durations as a string."""
+    if isinstance(value, str) and value.lstrip("-").isdigit():
+        return int(value)
+    return value
+
 
+def model_options(model: str, **overrides: int | float) -> dict:
+    """Ollama options for a one-off call to model, e.g. a shorter num_predict, keeping its num_ctx."""
+    return {"temperature": TEMPERATURE, **MODEL_OPTIONS.get(model, {}), **overrides}
 
-def get_llm(model: str = DEFAULT_MODEL, base_url: str = OLLAMA_BASE_URL) -> ChatOllama:
-    """Return a ChatOllama instance for local inference."""
-    return ChatOllama(
-        base_url=base_url,
-        model=model,
-        temperature=0.7,
-    )
+
+def get_llm(
+    model: str = DEFAULT_MODEL,
+    base_url: str = OLLAMA_BASE_URL,
+    keep_alive: int | str = OLLAMA_KEEP_ALIVE,
+) -> ChatOllama:
+    """Return the model's shared ChatOllama, building a new one if the configuration changed."""
+    config = (base_url, _keep_alive(keep_alive))
+    config_llm = _llms.get(model)
+    if config_llm is None or config_llm[0] != config:
+        # A replaced client is not closed here: generations still running on it keep their reference
+        limits = httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        )
+        options = MODEL_OPTIONS.get(model, {})
+        llm = ChatOllama(
+            base_url=base_url,
+            model=model,
+            temperature=TEMPERATURE,
+            num_ctx=options.get("num_ctx"),
+            num_predict=options.get("num_predict"),
+            keep_alive=config[1],
+            client_kwargs={"limits": limits},
+        )
+        config_llm = _llms[model] = (config, llm)
+    return config_llm[1]
+
+
+async def close_llm() -> None:
+    """Close the shared clients' connections (at shutdown)."""
+    llms = [llm for _config, llm in _llms.values()]
+    _llms.clear()
+    for llm in llms:
+        async_client = getattr(llm, "_async_client", None)
+        if async_client is not None:
+            await async_client.close()
+        sync_client = getattr(llm, "_client", None)
+        if sync_client is not None:
+            sync_client.close()
+
+
+async def warm_up_llm() -> bool:
+    """
+    Load each model into Ollama's memory and open a pooled connection with a one-token generation,
+    so the first story request does not pay for either. Returns False if a model could not be loaded.
+    """
+    loaded = True
+    # One after the other: loading both at once competes for the same CPU and disk
+    for model in dict.fromkeys((DEFAULT_MODEL, SMALL_MODEL)):
+        try:
+            await get_llm(model).ainvoke("Hi", options=model_options(model, num_predict=1))
+        except Exception:
+            loaded = False
+    return loaded
 
 
 async def check_llm_responding() -> "tuple[bool, str]":
@@ -0,0 +1,147 @@
+"""
+Admission control in front of the LLM.
+At most `concurrency` generations run on Ollama at once. Others wait in a bounded
+queue that is served round-robin across sessions, so one busy classroom cannot
+starve the rest. When a session's share or the whole queue is full, or a request
+has waited too long, LLMOverloaded is raised at once with a Retry-After estimate
+instead of piling more work onto Ollama.
+"""
+
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Hashable
+
+import metrics
+
+# Generations running on Ollama at once; match OLLAMA_NUM_PARALLEL
+LLM_CONCURRENCY = int(os.environ.get("SAFETALE_LLM_CONCURRENCY", "2"))
+LLM_MAX_QUEUE = 32
+LLM_MAX_QUEUE_PER_SESSION = 8
+# A request still waiting after this many seconds is shed rather than run late
+LLM_QUEUE_TIMEOUT = 30.0
+# Starting guess for one generation's duration, refined as generations finish
+LLM_EXPECTED_SECONDS = 5.0
+
+
+class LLMOverloaded(Exception):
+    """The request was not admitted; status is 429 (session over its share) or 503 (server busy)."""
+
+    def __init__(self, status: int, retry_after: int) -> None:
+        super().__init__(f"LLM overloaded ({status}), retry after {retry_after}s")
+        self.status = status
+        self.retry_after = retry_after
+
+
+# Four limits plus the slot and queue bookkeeping they govern
+class LLMScheduler:  # pylint: disable=too-many-instance-attributes
+    def __init__(
+        self,
+        concurrency: int = LLM_CONCURRENCY,
+        max_queue: int = LLM_MAX_QUEUE,
+        max_queue_per_session: int = LLM_MAX_QUEUE_PER_SESSION,
+        queue_timeout: float = LLM_QUEUE_TIMEOUT,
+    ) -> None:
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_session = max_queue_per_session
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self._waiting: OrderedDict[Hashable, deque[asyncio.Future]] = OrderedDict()
+        self._queued = 0
+        self._expected = LLM_EXPECTED_SECONDS
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def retry_after(self) -> int:
+        """Seconds until the queue ahead of a new request has likely drained."""
+        return max(1, math.ceil(self._expected * (self._queued + 1) / self.concurrency))
+
+    @asynccontextmanager
+    async def slot(self, session_id: str = "") -> AsyncIterator[None]:
+        """Hold one of the concurrency slots for the body of the block."""
+        # Callers without a session (plain REST requests) each get a lane of their own
+        # rather than all sharing one, where eight would fill the per-session cap
+        await self._acquire(session_id or object())
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            # Moving average of generation time, for Retry-After
+            self._expected += (time.monotonic() - started - self._expected) * 0.2
+            self._release()
+
+    async def _acquire(self, session_id: Hashable) -> None:
+        if self.running < self.concurrency and not self._queued:
+            self.running += 1
+            metrics.LLM_WAIT_SECONDS.observe(0)
+            return
+        waiters = self._waiting.get(session_id)
+        if waiters is not None and len(waiters) >= self.max_queue_per_session:
+            raise self._overloaded("session", 429)
+        if self._queued >= self.max_queue:
+            raise self._overloaded("queue", 503)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if waiters is None:
+            waiters = self._waiting[session_id] = deque()
+        waiters.append(future)
+        self._queued += 1
+        queued_at = time.monotonic()
+        timer = loop.call_later(self.queue_timeout, self._expire, session_id, future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._forget(session_id, future)
+            elif future.exception() is None:
+                # Admitted just as the caller went away: give the slot to the next request
+                self._release()
+            raise
+        finally:
+            timer.cancel()
+        metrics.LLM_WAIT_SECONDS.observe(time.monotonic() - queued_at)
+
+    def _release(self) -> None:
+        """Hand the slot to the first waiter of the next session in round-robin order."""
+        while self._waiting:
+            session_id, waiters = next(iter(self._waiting.items()))
+            future = waiters.popleft()
+            self._queued -= 1
+            if waiters:
+                self._waiting.move_to_end(session_id)
+            else:
+                del self._waiting[session_id]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    def _forget(self, session_id: Hashable, future: asyncio.Future) -> None:
+        waiters = self._waiting.get(session_id)
+        if waiters is None or future not in waiters:
+            return
+        waiters.remove(future)
+        self._queued -= 1
+        if not waiters:
+            del self._waiting[session_id]
+
+    def _expire(self, session_id: Hashable, future: asyncio.Future) -> None:
+        if future.done():
+            return  # admitted (or cancelled) in the same loop iteration the timer fired
+        self._forget(session_id, future)
+        future.set_exception(self._overloaded("timeout", 503))
+
+    def _overloaded(self, reason: str, status: int) -> LLMOverloaded:
+        metrics.LLM_REJECTED.inc(labels=(reason,))
+        return LLMOverloaded(status, self.retry_after())
+
+
+scheduler = LLMScheduler()
+metrics.LLM_WAITING.set_function(lambda: scheduler.queued)
+metrics.LLM_RUNNING.set_function(lambda: scheduler.running)
@@ -1,7 +1,10 @@
 """
 LangChain tools for SafeTale Sync RAG (search_lore).
+The tool is async (call it with ainvoke) so lore lookups never block the event loop.
 """
 
+import asyncio
+
 from langchain_core.tools import tool
 
 QDRANT_HOST = "localhost"
@@ -11,7 +14,7 @@ NOMIC_MODEL = "nomic-embed-text-v1"
 
 
 @tool
-def search_lore(query: str, top_k: int = 3) -> str:
+async def search_lore(query: str, top_k: int = 3) -> str:
     """
     Search the fairy-tale lore database for thematic context.
     Use this to retrieve relevant story snippets before generating continuations.
@@ -20,34 +23,41 @@ def search_lore(query: str, top_k: int = 3) -> str:
         return ""
     query = query.strip()
     try:
-        from qdrant_client import QdrantClient
+        from qdrant_client import AsyncQdrantClient
         from nomic import embed
     except ImportError:
         return ""
 
     try:
-        client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
+        client = AsyncQdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
     except Exception:
         return ""
 
     try:
-        out = embed.text(
-            texts=[query],
-            model=NOMIC_MODEL,
-            task_type="search_query",
-        )
-        query_vector = out["embeddings"][0]
-    except Exception:
-        return ""
+        try:
+            # nomic has no async API; run the HTTP call off the event loop
+            out = await asyncio.to_thread(
+                embed.text,
+                texts=[query],
+                model=NOMIC_MODEL,
+                task_type="search_query",
+            )
+            query_vector = out["embeddings"][0]
+        except Exception:
+            return ""
 
-    try:
-        hits = client.search(
-            collection_name=COLLECTION_NAME,
-            query_vector=query_vector,
-            limit=top_k,
-        )
-    except Exception:
-        return ""
+        try:
+            result = await client.query_points(
+                collection_name=COLLECTION_NAME,
+                query=query_vector,
+                limit=top_k,
+            )
+        except Exception:
+            return ""
+    finally:
+        await client.close()
+
+    hits = result.points
 
     if not hits:
         return ""
@@ -2,29 +2,80 @@
 SafeTale Sync - FastAPI entry point.
 """
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Literal
+
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
-from llm_client import check_llm_responding
+import context_builder
+import health
+import metrics
+import story_memory
+from generation_cache import close_cache, normalize
+from llm_client import close_llm, warm_up_llm
+from llm_scheduler import LLMOverloaded
+from single_flight import SingleFlight
 from story_agent import build_story_graph
+from story_stream import EMPTY_INPUT_PROMPT, StoryGenerations, initial_state, ndjson_stream, stream_story
 from ws_manager import manager as ws_manager
+from ws_protocol import COMPRESSION_DEFLATE
 
 
 class GenerateStoryRequest(BaseModel):
     story_context: str = ""
     user_input: str = ""
+    # Keys the session's conversation memory; identical concurrent requests from one session
+    # share a graph run, and the LLM queue is fair across sessions
+    session_id: str = ""
+    # "fast" for the small model, "quality" for the large one; empty routes by the input
+    latency: Literal["", "fast", "quality"] = ""
 
 
 class GenerateStoryResponse(BaseModel):
     response: str
 
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """Start and stop background services shared by all requests."""
+    await ws_manager.start()
+    await story_memory.open_memory()
+    health.monitor.start()
+    # Load the model in the background so startup does not wait on (or fail without) Ollama
+    warm_up = asyncio.create_task(warm_up_llm())
+    yield
+    warm_up.cancel()
+    await asyncio.gather(warm_up, return_exceptions=True)
+    await story_generations.stop()
+    await ws_manager.stop()
+    await story_memory.close_memory()
+    await context_builder.summaries.close()
+    await close_cache()
+    await health.monitor.stop()
+    await close_llm()
+
+
 app = FastAPI(
     title="SafeTale Sync",
     description="Real-time collaborative AI storytelling",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
+@app.exception_handler(LLMOverloaded)
+async def llm_overloaded(_request: Request, exc: LLMOverloaded) -> JSONResponse:
+    """Shed load quickly instead of queueing more work on Ollama."""
+    return JSONResponse(
+        {"detail": "The story guide is busy. Please try again shortly."},
+        status_code=exc.status,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -34,20 +85,57 @@ app.add_middleware(
 )
 
 
+def _llm_health(result: health.ProbeResult) -> dict:
+    if not result.ok:
+        return {"status": "unhealthy", "llm": "error", "detail": result.detail, "age_s": result.as_dict()["age_s"]}
+    return {"status": "healthy", "llm": "ok", "detail": result.detail, "age_s": result.as_dict()["age_s"]}
+
+
 @app.get("/api/health")
-async def health():
-    """Verify the local LLM (Ollama) is responding."""
-    ok, detail = await check_llm_responding()
-    if not ok:
-        return {"status": "unhealthy", "llm": "error", "detail": detail}
-    return {"status": "healthy", "llm": "ok", "detail": detail}
+async def get_health():
+    """Whether the local LLM (Ollama) generates, from the cached deep probe; probes again once it is stale."""
+    return _llm_health(await health.monitor.deep(max_age=health.monitor.deep_interval))
+
+
+@app.get("/api/health/deep")
+async def get_health_deep():
+    """Run a real generation now (shared by concurrent callers)."""
+    return _llm_health(await health.monitor.deep())
+
+
+@app.get("/api/health/live")
+async def get_health_live() -> JSONResponse:
+    """Cheap reachability of Ollama (required) and Qdrant (optional, for lore); no generation."""
+    probes = await health.monitor.liveness()
+    if not probes["ollama"].ok:
+        status, code = "unavailable", 503
+    else:
+        status, code = ("ok" if probes["qdrant"].ok else "degraded"), 200
+    return JSONResponse({"status": status, **{name: p.as_dict() for name, p in probes.items()}}, status_code=code)
+
+
+@app.get("/api/health/ready")
+async def get_health_ready() -> JSONResponse:
+    """Live, and the last deep probe (if recent) did not fail."""
+    probes = await health.monitor.liveness()
+    deep = health.monitor.deep_status()
+    ready = probes["ollama"].ok and deep != "error"
+    body = {"status": "ready" if ready else "unavailable", "ollama": probes["ollama"].as_dict(), "generation": deep}
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+
+@app.get("/api/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> PlainTextResponse:
+    """Prometheus text exposition of WebSocket and story generation metrics."""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
 
 
 async def _websocket_receive_loop(websocket: WebSocket, session_id: str) -> None:  # pragma: no cover
-    """Receive bytes and broadcast to session until disconnect. E2E-covered."""
-    while True:
+    """Receive bytes and hand each frame to the session manager until disconnect or eviction. E2E-covered."""
+    # An evicted socket is already being closed, so receiving again would fail
+    while ws_manager.is_connected(websocket, session_id):
         data = await websocket.receive_bytes()
-        await ws_manager.broadcast_to_session(session_id, data, exclude=websocket)
+        await ws_manager.handle_frame(websocket, session_id, data)
 
 
 @app.websocket("/ws/story/{session_id}")
@@ -55,7 +143,9 @@ async def websocket_story(websocket: WebSocket, session_id: str) -> None:
     if not session_id or not session_id.strip():
         await websocket.close(code=4000)
         return
-    await ws_manager.connect(websocket, session_id)
+    compress = websocket.query_params.get("compress") == COMPRESSION_DEFLATE
+    if not await ws_manager.connect(websocket, session_id, compress=compress):
+        return
     try:
         await _websocket_receive_loop(websocket, session_id)
     except WebSocketDisconnect:
@@ -65,33 +155,67 @@ async def websocket_story(websocket: WebSocket, session_id: str) -> None:
 
 
 _story_graph = None
-
-
-def _get_story_graph():
-    global _story_graph
+# (checkpointer, graph) for runs that keep a session's conversation
+_memory_graph: tuple = (None, None)
+
+
+def _get_story_graph(memory: bool = False):
+    """The compiled story graph; with memory, the one that checkpoints by session (if memory is on)."""
+    global _story_graph, _memory_graph
+    checkpointer = story_memory.checkpointer
+    if memory and checkpointer is not None:
+        if _memory_graph[0] is not checkpointer:
+            _memory_graph = (checkpointer, build_story_graph(checkpointer))
+        return _memory_graph[1]
     if _story_graph is None:
         _story_graph = build_story_graph()
     return _story_graph
 
 
+# Generation requests sent over /ws/story stream their tokens to the whole session
+story_generations = StoryGenerations(ws_manager, lambda: _get_story_graph(memory=True))
+ws_manager.set_generate_handler(story_generations.request)
+
+generate_flights = SingleFlight("generate_story")
+
+
 @app.post("/api/generate-story", response_model=GenerateStoryResponse)
 async def generate_story(body: GenerateStoryRequest) -> GenerateStoryResponse:
     """Run the story agent and return the continuation."""
     if not body.user_input or not body.user_input.strip():
-        return GenerateStoryResponse(response="What would you like to happen next in the story?")
-    graph = _get_story_graph()
-    initial: dict = {
-        "story_context": body.story_context or "",
-        "user_input": body.user_input.strip(),
-        "conversation_history": [],
-        "safety_passed": False,
-        "response": "",
-    }
-    result = graph.invoke(initial)
+        return GenerateStoryResponse(response=EMPTY_INPUT_PROMPT)
+    initial = initial_state(body.user_input.strip(), body.story_context or "", body.session_id, body.latency)
+
+    async def run() -> dict:
+        graph = _get_story_graph(memory=bool(body.session_id))
+        with metrics.GENERATE_SECONDS.time(("total",)):
+            return await graph.ainvoke(initial, story_memory.run_config(body.session_id))
+
+    key = (body.session_id, normalize(body.user_input), body.story_context or "", body.latency)
+    result = await generate_flights.run(key, run)
     response = result.get("response") or ""
     return GenerateStoryResponse(response=response)
 
 
+@app.post("/api/generate-story/stream")
+async def generate_story_stream(body: GenerateStoryRequest, request: Request) -> StreamingResponse:
+    """
+    Stream the continuation as NDJSON: {"event": "token", "text": ...} lines as the LLM generates,
+    then {"event": "done", "text": <full response>} (or "error"). Disconnecting aborts the generation.
+    """
+
+    async def events():
+        if not body.user_input or not body.user_input.strip():
+            yield {"event": "done", "text": EMPTY_INPUT_PROMPT}
+            return
+        initial = initial_state(body.user_input.strip(), body.story_context or "", body.session_id, body.latency)
+        graph = _get_story_graph(memory=bool(body.session_id))
+        async for event in stream_story(graph, initial, story_memory.run_config(body.session_id)):
+            yield event
+
+    return StreamingResponse(ndjson_stream(events(), request.receive), media_type="application/x-ndjson")
+
+
 @app.get("/")
 async def root():
     return {"app": "SafeTale Sync", "docs": "/docs"}
@@ -0,0 +1,250 @@
+"""
+In-process metrics registry for SafeTale Sync, rendered in the Prometheus text format.
+All updates happen on the event loop thread, so plain dict/float updates are enough:
+no locks and no allocations beyond the first sample of each label set.
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (128, 256, 512, 1024, 1536, 2048, 4096, 8192)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self._samples()]
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """Monotonic count, e.g. frames or bytes; Prometheus derives per-second rates from it."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, labels: tuple[str, ...] = ()) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels: tuple[str, ...] = ()) -> float:
+        return self._values.get(labels, 0)
+
+    def _samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(v)}"
+            for labels, v in self._values.items()
+        ]
+
+
+class Gauge(Metric):
+    """Current value; either set directly or read from a callback at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+        self._function: Callable[[], float] | None = None
+
+    def set(self, value: float, labels: tuple[str, ...] = ()) -> None:
+        self._values[labels] = value
+
+    def inc(self, amount: float = 1, labels: tuple[str, ...] = ()) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, labels: tuple[str, ...] = ()) -> None:
+        self.inc(-amount, labels)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def value(self, labels: tuple[str, ...] = ()) -> float:
+        if self._function is not None:
+            return self._function()
+        return self._values.get(labels, 0)
+
+    def _samples(self) -> list[str]:
+        if self._function is not None:
+            return [f"{self.name} {_format_value(self._function())}"]
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(v)}"
+            for labels, v in self._values.items()
+        ]
+
+
+class Histogram(Metric):
+    """Cumulative latency buckets plus sum and count per label set."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # per label set: [count per bucket..., +Inf count, sum]
+        self._values: dict[tuple[str, ...], list[float]] = {}
+
+    def observe(self, value: float, labels: tuple[str, ...] = ()) -> None:
+        row = self._values.get(labels)
+        if row is None:
+            row = self._values[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                row[i] += 1
+                break
+        else:
+            row[len(self.buckets)] += 1
+        row[-1] += value
+
+    @contextmanager
+    def time(self, labels: tuple[str, ...] = ()) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, labels)
+
+    def count(self, labels: tuple[str, ...] = ()) -> int:
+        row = self._values.get(labels)
+        return int(sum(row[:-1])) if row else 0
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for labels, row in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, row):
+                cumulative += n
+                le = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {_format_value(cumulative)}")
+            cumulative += row[len(self.buckets)]
+            le = _format_labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {_format_value(cumulative)}")
+            plain = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{plain} {_format_value(row[-1])}")
+            lines.append(f"{self.name}_count{plain} {_format_value(cumulative)}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(
+    name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS
+) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# WebSocket sync
+WS_SESSIONS = gauge("safetale_ws_sessions", "Sessions with at least one connection")
+WS_CONNECTIONS = gauge("safetale_ws_connections", "Open WebSocket connections")
+WS_BUFFERED_BYTES = gauge("safetale_ws_buffered_bytes", "Bytes waiting in outbound queues")
+WS_FRAMES_IN = counter("safetale_ws_frames_received_total", "Frames received from clients")
+WS_BYTES_IN = counter("safetale_ws_bytes_received_total", "Bytes received from clients")
+WS_FRAMES_OUT = counter("safetale_ws_frames_sent_total", "Frames sent to clients")
+WS_BYTES_OUT = counter("safetale_ws_bytes_sent_total", "Bytes sent to clients")
+WS_FANOUT_SECONDS = histogram("safetale_ws_fanout_seconds", "Time to queue one frame for every peer of a session")
+WS_SEND_SECONDS = histogram("safetale_ws_send_seconds", "Time for one socket send")
+WS_DEAD_SOCKETS = counter("safetale_ws_dead_sockets_total", "Connections dropped because a send failed")
+WS_DROPPED_FRAMES = counter("safetale_ws_dropped_frames_total", "Frames dropped for slow consumers")
+WS_INGRESS_LIMITED = counter(
+    "safetale_ws_ingress_limited_total", "Client frames over an ingress limit", labelnames=("limit", "action")
+)
+WS_HEARTBEAT_TIMEOUTS = counter("safetale_ws_heartbeat_timeouts_total", "Connections reaped for missing heartbeats")
+
+# Story generation
+GENERATE_SECONDS = histogram(
+    "safetale_generate_story_seconds", "Story generation latency by stage", labelnames=("stage",)
+)
+GENERATION_CACHE_REQUESTS = counter(
+    "safetale_generation_cache_requests_total",
+    "LLM calls looked up in the generation cache, by result (exact, semantic or miss)",
+    ("result",),
+)
+GENERATION_CACHE_ENTRIES = gauge("safetale_generation_cache_entries", "Prompts held in the generation cache")
+GENERATION_CACHE_BYTES = gauge("safetale_generation_cache_bytes", "Approximate memory held by the generation cache")
+SINGLE_FLIGHT_SHARED = counter(
+    "safetale_single_flight_shared_total", "Requests that joined an identical run already in flight", ("flight",)
+)
+LLM_RUNNING = gauge("safetale_llm_running", "Generations admitted by the scheduler and running on the LLM")
+LLM_WAITING = gauge("safetale_llm_waiting", "Generations waiting in the scheduler queue")
+LLM_WAIT_SECONDS = histogram("safetale_llm_wait_seconds", "Time a generation waited for an LLM slot")
+LLM_REJECTED = counter(
+    "safetale_llm_rejected_total", "Generations shed by the scheduler, by reason (session, queue, timeout)", ("reason",)
+)
+LLM_ROUTES = counter(
+    "safetale_llm_routes_total",
+    "Story generations per model tier, by reason (hint, complex, simple, overload, failover)",
+    ("tier", "reason"),
+)
+PROMPT_TOKENS = histogram(
+    "safetale_prompt_tokens", "Estimated tokens in each story prompt sent to the LLM", buckets=TOKEN_BUCKETS
+)
+STORY_SUMMARIES = counter(
+    "safetale_story_summaries_total", "Story summary refreshes, by result (incremental, full, failed)", ("result",)
+)
+STORY_SUMMARY_SESSIONS = gauge("safetale_story_summary_sessions", "Sessions with a rolling story summary")
+
+# Health
+HEALTH_PROBES = counter(
+    "safetale_health_probes_total", "Health probes run, by probe (ollama, qdrant, deep) and result", ("probe", "result")
+)
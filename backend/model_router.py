@@ -0,0 +1,75 @@
+"""
+Routes each story generation to a model tier.
+Short, simple turns go to a small fast model and long or complex ones to the larger
+model, so on CPU-only nodes most turns finish sooner and cost less. A request can ask
+for "fast" or "quality" instead. While the LLM queue is backed up, large-tier turns
+fall back to the small model, and a tier whose model fails is retried on the other.
+"""
+
+import os
+import re
+
+import llm_scheduler
+import metrics
+from context_builder import CONTEXT_TOKEN_BUDGET, estimate_tokens
+from llm_client import DEFAULT_MODEL, MODEL_OPTIONS, SMALL_MODEL
+
+LATENCY_HINTS = ("fast", "quality")
+# User input past either limit is a complex turn for the large model
+LARGE_INPUT_TOKENS = 40
+LARGE_INPUT_SENTENCES = 3
+# Asking for more than a plain continuation
+COMPLEX_PATTERN = re.compile(r"\b(why|how|explain|describe|remember|recap|summari[sz]e|twist|plan)\b", re.IGNORECASE)
+SENTENCE_END = re.compile(r"[.!?]+(\s|$)")
+# Large-tier turns go to the small model while this many generations wait for a slot
+LARGE_FALLBACK_QUEUE = int(os.environ.get("SAFETALE_LARGE_FALLBACK_QUEUE", str(llm_scheduler.LLM_CONCURRENCY)))
+
+
+class ModelTier:
+    def __init__(self, name: str, model: str) -> None:
+        self.name = name
+        self.model = model
+        options = MODEL_OPTIONS[model]
+        # The prompt has to fit in the model's context next to the reply
+        self.prompt_budget = min(CONTEXT_TOKEN_BUDGET, options["num_ctx"] - options["num_predict"])
+
+
+SMALL = ModelTier("small", SMALL_MODEL)
+LARGE = ModelTier("large", DEFAULT_MODEL)
+
+
+def is_complex(user_input: str) -> bool:
+    return (
+        estimate_tokens(user_input) > LARGE_INPUT_TOKENS
+        or len(SENTENCE_END.findall(user_input.strip())) >= LARGE_INPUT_SENTENCES
+        or COMPLEX_PATTERN.search(user_input) is not None
+    )
+
+
+def choose_tier(user_input: str, latency: str = "") -> ModelTier:
+    """The tier for this turn, from the request's latency hint, else its input; counted by reason."""
+    if latency == "fast":
+        return _routed(SMALL, "hint")
+    if latency == "quality":
+        reason = "hint"
+    elif is_complex(user_input):
+        reason = "complex"
+    else:
+        return _routed(SMALL, "simple")
+    # A smaller model drains the queue faster than making the turn wait for the large one
+    if llm_scheduler.scheduler.queued >= LARGE_FALLBACK_QUEUE:
+        return _routed(SMALL, "overload")
+    return _routed(LARGE, reason)
+
+
+def fallback_for(tier: ModelTier) -> ModelTier | None:
+    """The other tier, to retry a turn whose model failed (e.g. not pulled); None if it is the same model."""
+    other = LARGE if tier is SMALL else SMALL
+    if other.model == tier.model:
+        return None
+    return _routed(other, "failover")
+
+
+def _routed(tier: ModelTier, reason: str) -> ModelTier:
+    metrics.LLM_ROUTES.inc(labels=(tier.name, reason))
+    return tier
@@ -0,0 +1,29 @@
+"""
+Token buckets for ingress limits on /ws/story.
+"""
+
+import time
+
+
+class TokenBucket:
+    """Refills at rate tokens per second up to capacity; consume() may run into debt to compute a delay."""
+
+    def __init__(self, rate: float, capacity: float, now: float | None = None) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, amount: float, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= amount
+
+    def consume(self, amount: float, now: float) -> float:
+        """Take amount tokens and return how many seconds to wait before the bucket is out of debt."""
+        self._refill(now)
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
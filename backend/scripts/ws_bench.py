@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Load generator for /ws/story/{session_id} fan-out.
+Opens S sessions x C clients, has every client send real Yjs updates (keystrokes,
+with the occasional paste) at a Poisson rate, and measures end-to-end delivery
+latency from send to every peer's receive. Prints one JSON object so runs can be
+compared before and after changes to ws_manager.
+
+Usage:
+  python -m scripts.ws_bench                         # spawn a local uvicorn
+  python -m scripts.ws_bench --in-process            # run the app in this process
+  python -m scripts.ws_bench --url ws://127.0.0.1:8000 --server-pid 1234
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+SYNC_UPDATE = 0x01
+PING = 0x03
+PONG = 0x04
+
+RSS_SAMPLE_INTERVAL = 0.5
+
+
+def percentile(sorted_values: list[float], pct: float) -> float | None:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def rss_bytes(pid: int) -> int | None:
+    """Resident set size of a process, or None where /proc is unavailable."""
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if pid == os.getpid():
+        # ru_maxrss is the peak, in KiB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    return None
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _wait_for_port(port: int, timeout: float = 15.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+class UpdateSource:
+    """Produces real Yjs update frames for one client: mostly single keystrokes, sometimes a paste."""
+
+    def __init__(self, rng: random.Random, paste_ratio: float, paste_bytes: int) -> None:
+        from pycrdt import Doc, Text
+
+        self.rng = rng
+        self.paste_ratio = paste_ratio
+        self.paste_bytes = paste_bytes
+        self.doc = Doc()
+        self.text = self.doc.get("story", type=Text)
+        self._updates: list[bytes] = []
+        self.doc.observe(lambda event: self._updates.append(event.update))
+
+    def next_frame(self) -> bytes:
+        if self.rng.random() < self.paste_ratio:
+            chunk = "".join(self.rng.choice("abcdefghij klmnopqrstuvwxyz.") for _ in range(self.paste_bytes))
+        else:
+            chunk = self.rng.choice("abcdefghij klmnopqrstuvwxyz.")
+        self.text.insert(self.rng.randint(0, len(self.text)), chunk)
+        update = self._updates.pop()
+        self._updates.clear()
+        return bytes([SYNC_UPDATE]) + update
+
+
+# Plain counters for the JSON report
+class UpdateTraffic:  # pylint: disable=too-many-instance-attributes
+    """Send times and delivery counts of Yjs update frames; shared by the bench and ws_replay."""
+
+    def __init__(self, args: argparse.Namespace, url: str) -> None:
+        self.args = args
+        self.url = url.rstrip("/")
+        # Frame bytes are unique per update (client id + clock), so they key the send time
+        self.sent_at: dict[bytes, float] = {}
+        self.latencies: list[float] = []
+        self.sent = 0
+        self.sent_bytes = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.unmatched = 0
+        self.errors = 0
+
+
+async def received_frames(ws) -> AsyncIterator[tuple[float, bytes]]:
+    """(receive time, frame) for each binary frame from the server; pings are answered here."""
+    async for message in ws:
+        now = time.perf_counter()
+        if not isinstance(message, bytes) or not message:
+            continue
+        if message[0] == PING:
+            await ws.send(bytes([PONG]))
+            continue
+        yield now, message
+
+
+def latency_ms(latencies: list[float]) -> dict:
+    """Sample count and nearest-rank percentiles of latencies, in milliseconds."""
+    latencies = sorted(latencies)
+    return {
+        "samples": len(latencies),
+        "p50": _ms(percentile(latencies, 50)),
+        "p95": _ms(percentile(latencies, 95)),
+        "p99": _ms(percentile(latencies, 99)),
+        "max": _ms(latencies[-1] if latencies else None),
+    }
+
+
+class Bench(UpdateTraffic):  # pylint: disable=too-many-instance-attributes
+    def __init__(self, args: argparse.Namespace, url: str) -> None:
+        super().__init__(args, url)
+        self.rng = random.Random(args.seed)
+        self.measuring = False
+        self.connected = 0
+        self.go = asyncio.Event()
+        self.stop = asyncio.Event()
+
+    async def client(self, session_id: str) -> None:
+        import websockets
+
+        source = UpdateSource(random.Random(self.rng.random()), self.args.paste_ratio, self.args.paste_bytes)
+        try:
+            async with websockets.connect(f"{self.url}/ws/story/{session_id}", max_size=None) as ws:
+                receiver = asyncio.create_task(self._receive(ws))
+                self.connected += 1
+                await self.go.wait()
+                try:
+                    while not self.stop.is_set():
+                        await asyncio.sleep(source.rng.expovariate(self.args.rate))
+                        frame = source.next_frame()
+                        if self.measuring:
+                            self.sent_at[frame] = time.perf_counter()
+                            self.sent += 1
+                            self.sent_bytes += len(frame)
+                        await ws.send(frame)
+                finally:
+                    receiver.cancel()
+        except Exception:
+            self.errors += 1
+
+    async def _receive(self, ws) -> None:
+        async for now, message in received_frames(ws):
+            if message[0] != SYNC_UPDATE:
+                continue
+            sent = self.sent_at.get(message)
+            if sent is None:
+                if self.measuring:
+                    self.received += 1
+                    self.received_bytes += len(message)
+                    self.unmatched += 1  # e.g. merged by server-side coalescing
+                continue
+            # Frames sent during the measured window count even if they land during the drain
+            self.received += 1
+            self.received_bytes += len(message)
+            self.latencies.append(now - sent)
+
+    async def run(self, server_pid: int | None) -> dict:
+        args = self.args
+        run_id = uuid.uuid4().hex[:8]
+        tasks = [
+            asyncio.create_task(self.client(f"bench-{run_id}-{s}"))
+            for s in range(args.sessions)
+            for _ in range(args.clients)
+        ]
+        # Start sending only once every client is connected
+        deadline = time.monotonic() + args.connect_timeout
+        while self.connected + self.errors < len(tasks) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self.go.set()
+        rss_start = rss_bytes(server_pid) if server_pid else None
+        rss_peak = rss_start or 0
+        await asyncio.sleep(args.warmup)
+        self.measuring = True
+        started = time.perf_counter()
+        while time.perf_counter() - started < args.duration:
+            await asyncio.sleep(RSS_SAMPLE_INTERVAL)
+            if server_pid:
+                rss_peak = max(rss_peak, rss_bytes(server_pid) or 0)
+        self.measuring = False
+        elapsed = time.perf_counter() - started
+        # Let in-flight frames land before stopping the clients
+        await asyncio.sleep(args.drain)
+        rss_end = rss_bytes(server_pid) if server_pid else None
+        rss_peak = max(rss_peak, rss_end or 0)
+        self.stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        expected = self.sent * (args.clients - 1)
+        return {
+            "config": {
+                "url": self.url,
+                "sessions": args.sessions,
+                "clients_per_session": args.clients,
+                "rate_per_client": args.rate,
+                "paste_ratio": args.paste_ratio,
+                "paste_bytes": args.paste_bytes,
+                "duration_s": args.duration,
+                "warmup_s": args.warmup,
+                "seed": args.seed,
+            },
+            "sent_frames": self.sent,
+            "sent_bytes": self.sent_bytes,
+            "expected_deliveries": expected,
+            "delivered_frames": self.received,
+            "delivered_bytes": self.received_bytes,
+            "delivery_ratio": round(self.received / expected, 4) if expected else None,
+            "unmatched_frames": self.unmatched,
+            "client_errors": self.errors,
+            "latency_ms": latency_ms(self.latencies),
+            "throughput": {
+                "sent_frames_per_s": round(self.sent / elapsed, 1),
+                "delivered_frames_per_s": round(self.received / elapsed, 1),
+                "delivered_bytes_per_s": round(self.received_bytes / elapsed, 1),
+            },
+            "server_rss_bytes": {"start": rss_start, "end": rss_end, "peak": rss_peak or None},
+        }
+
+
+def _ms(seconds: float | None) -> float | None:
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def _start_in_process(port: int) -> None:
+    """Serve the app from a thread with its own event loop, so client load does not share the server loop."""
+    import uvicorn
+
+    config = uvicorn.Config("main:app", host="127.0.0.1", port=port, log_level="warning", lifespan="on")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+
+
+@asynccontextmanager
+async def serve(args: argparse.Namespace, env: dict[str, str] | None = None) -> AsyncIterator[tuple[str, int | None]]:
+    """
+    (url, pid) of the server under test: --url if given, else the app on a free port, in this process
+    with --in-process or in a uvicorn subprocess (with env, if given) that is stopped on exit.
+    """
+    if args.url is not None:
+        yield args.url, args.server_pid
+        return
+    port = _free_port()
+    url = f"ws://127.0.0.1:{port}"
+    if args.in_process:
+        _start_in_process(port)
+        await _wait_for_port(port)
+        yield url, os.getpid()
+        return
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)]
+    command += ["--log-level", "warning"]
+    with subprocess.Popen(command, cwd=BACKEND_DIR, env=env) as server:
+        try:
+            await _wait_for_port(port)
+            yield url, server.pid
+        finally:
+            server.terminate()
+
+
+def report(result: dict, output: str | None) -> None:
+    """Print the JSON result, and also write it to output if given."""
+    text = json.dumps(result, indent=2)
+    print(text)
+    if output:
+        Path(output).write_text(text + "\n", encoding="utf-8")
+
+
+async def main_async(args: argparse.Namespace) -> dict:
+    async with serve(args) as (url, server_pid):
+        return await Bench(args, url).run(server_pid)
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="WebSocket fan-out load test for SafeTale Sync.")
+    parser.add_argument("--url", help="Base ws:// URL of a running server (default: spawn one)")
+    parser.add_argument("--server-pid", type=int, help="PID of the server at --url, for RSS sampling")
+    parser.add_argument("--in-process", action="store_true", help="Run the app in this process instead of a subprocess")
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--clients", type=int, default=5, help="Clients per session")
+    parser.add_argument("--rate", type=float, default=4.0, help="Updates per second per client (Poisson)")
+    parser.add_argument("--paste-ratio", type=float, default=0.02, help="Fraction of updates that are pastes")
+    parser.add_argument("--paste-bytes", type=int, default=2000, help="Characters per paste")
+    parser.add_argument("--duration", type=float, default=10.0, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Unmeasured seconds before measuring")
+    parser.add_argument("--drain", type=float, default=1.0, help="Seconds to wait for in-flight frames")
+    parser.add_argument("--connect-timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Also write the JSON result to this file")
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    args = parse_args()
+    if args.clients < 2:
+        print("--clients must be at least 2 to measure fan-out", file=sys.stderr)
+        sys.exit(1)
+    report(asyncio.run(main_async(args)), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Replays recorded /ws/story traffic (see session_recorder) against a server.
+Every recorded connection joins, sends its frames and leaves at its recorded
+offsets (divided by --speed), so bursts of joins, pauses and big pastes keep
+their real shape. Prints one JSON object with delivery latency of Yjs updates
+and the server's CPU time, so optimizations can be checked against real traffic.
+
+Record with SAFETALE_RECORD_DIR=/path/to/recordings, then:
+  python -m scripts.ws_replay /path/to/recordings                 # spawn a local uvicorn
+  python -m scripts.ws_replay /path/to/recordings --speed 10      # 10x faster
+  python -m scripts.ws_replay a.rec b.rec --url ws://127.0.0.1:8000 --server-pid 1234
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+
+from scripts.ws_bench import PONG, SYNC_UPDATE, UpdateTraffic, latency_ms, received_frames, report, rss_bytes, serve
+from session_recorder import RECORD_FRAME, RECORD_JOIN, RECORD_LEAVE, Record, read_recording
+from ws_protocol import COMPRESSED, decompress_frame
+
+
+def cpu_seconds(pid: int) -> float | None:
+    """User + system CPU time of a process, or None where /proc is unavailable."""
+    try:
+        with open(f"/proc/{pid}/stat", encoding="ascii") as f:
+            # Fields after the parenthesised command name; utime and stime are the 12th and 13th
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except OSError:
+        if pid == os.getpid():
+            return time.process_time()
+        return None
+
+
+def load_recordings(paths: list[str]) -> list[tuple[str, list[Record]]]:
+    """Read *.rec files, expanding directories; recordings without records are skipped."""
+    files: list[Path] = []
+    for path in map(Path, paths):
+        files.extend(sorted(path.glob("*.rec")) if path.is_dir() else [path])
+    return [rec for rec in map(read_recording, files) if rec[1]]
+
+
+def schedule(records: list[Record], speed: float, max_gap: float) -> dict[int, list[tuple[float, int, bytes]]]:
+    """Group records by connection with replay offsets; idle gaps longer than max_gap are cut to max_gap."""
+    timeline: dict[int, list[tuple[float, int, bytes]]] = {}
+    offset = 0.0
+    previous = records[0][0]
+    for timestamp, kind, connection, payload in records:
+        offset += min(max(timestamp - previous, 0.0), max_gap) / speed
+        previous = timestamp
+        timeline.setdefault(connection, []).append((offset, kind, payload))
+    return timeline
+
+
+class Replay(UpdateTraffic):  # pylint: disable=too-many-instance-attributes
+    def __init__(self, args: argparse.Namespace, url: str, recordings: list[tuple[str, list[Record]]]) -> None:
+        super().__init__(args, url)
+        self.recordings = recordings
+        self.joins = 0
+        self.started = 0.0
+
+    async def connection(self, session_id: str, events: list[tuple[float, int, bytes]]) -> None:
+        import websockets
+
+        ws = None
+        receiver: asyncio.Task | None = None
+        try:
+            for offset, kind, payload in events:
+                delay = self.started + offset - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if kind == RECORD_JOIN and ws is None:
+                    query = "?compress=deflate" if payload == b"deflate" else ""
+                    ws = await websockets.connect(f"{self.url}/ws/story/{session_id}{query}", max_size=None)
+                    receiver = asyncio.create_task(self._receive(ws))
+                    self.joins += 1
+                elif kind == RECORD_FRAME and ws is not None:
+                    # This run answers the server's own pings; recorded pongs belong to the old server
+                    if payload[:1] == bytes([PONG]):
+                        continue
+                    frame = decompress_frame(payload) if payload[:1] == bytes([COMPRESSED]) else payload
+                    if frame[:1] == bytes([SYNC_UPDATE]):
+                        self.sent_at[frame] = time.perf_counter()
+                    self.sent += 1
+                    self.sent_bytes += len(payload)
+                    await ws.send(payload)
+                elif kind == RECORD_LEAVE:
+                    break
+        except Exception:
+            self.errors += 1
+        finally:
+            if receiver is not None:
+                receiver.cancel()
+            if ws is not None:
+                await ws.close()
+
+    async def _receive(self, ws) -> None:
+        async for now, message in received_frames(ws):
+            if message[0] == COMPRESSED:
+                message = decompress_frame(message)
+            if message[0] != SYNC_UPDATE:
+                continue
+            self.received += 1
+            self.received_bytes += len(message)
+            sent = self.sent_at.get(message)
+            if sent is None:
+                self.unmatched += 1  # e.g. merged by coalescing, or a sync reply
+                continue
+            self.latencies.append(now - sent)
+
+    async def run(self, server_pid: int | None) -> dict:
+        args = self.args
+        run_id = uuid.uuid4().hex[:8]
+        timelines = [
+            (f"replay-{run_id}-{i}", schedule(records, args.speed, args.max_gap))
+            for i, (_session, records) in enumerate(self.recordings)
+        ]
+        rss_start = rss_bytes(server_pid) if server_pid else None
+        cpu_start = cpu_seconds(server_pid) if server_pid else None
+        self.started = time.perf_counter()
+        await asyncio.gather(
+            *(
+                self.connection(session_id, events)
+                for session_id, timeline in timelines
+                for events in timeline.values()
+            )
+        )
+        elapsed = time.perf_counter() - self.started
+        cpu_end = cpu_seconds(server_pid) if server_pid else None
+        rss_end = rss_bytes(server_pid) if server_pid else None
+        cpu = None if cpu_start is None or cpu_end is None else round(cpu_end - cpu_start, 3)
+
+        per_frame = round(cpu * 1000 / self.sent, 3) if cpu is not None and self.sent else None
+        return {
+            "config": {
+                "url": self.url,
+                "recordings": len(self.recordings),
+                "speed": args.speed,
+                "max_gap_s": args.max_gap,
+            },
+            "connections": sum(len(timeline) for _session, timeline in timelines),
+            "joined": self.joins,
+            "sent_frames": self.sent,
+            "sent_bytes": self.sent_bytes,
+            "delivered_updates": self.received,
+            "delivered_bytes": self.received_bytes,
+            "unmatched_updates": self.unmatched,
+            "client_errors": self.errors,
+            "elapsed_s": round(elapsed, 3),
+            "latency_ms": latency_ms(self.latencies),
+            # With --in-process this includes the replay clients, which share the process
+            "server_cpu_seconds": cpu,
+            "server_cpu_ms_per_sent_frame": per_frame,
+            "server_rss_bytes": {"start": rss_start, "end": rss_end},
+        }
+
+
+async def main_async(args: argparse.Namespace, recordings: list[tuple[str, list[Record]]]) -> dict:
+    # Replayed traffic must not be recorded again
+    env = {k: v for k, v in os.environ.items() if k != "SAFETALE_RECORD_DIR"}
+    async with serve(args, env) as (url, server_pid):
+        return await Replay(args, url, recordings).run(server_pid)
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Replay recorded WebSocket traffic against SafeTale Sync.")
+    parser.add_argument("recordings", nargs="+", help="*.rec files or directories of them")
+    parser.add_argument("--url", help="Base ws:// URL of a running server (default: spawn one)")
+    parser.add_argument("--server-pid", type=int, help="PID of the server at --url, for CPU and RSS sampling")
+    parser.add_argument("--in-process", action="store_true", help="Run the app in this process instead of a subprocess")
+    parser.add_argument("--speed", type=float, default=1.0, help="Playback speed multiplier (1 = real time)")
+    parser.add_argument(
+        "--max-gap", type=float, default=30.0, help="Cap on idle gaps between records, in recorded seconds"
+    )
+    parser.add_argument("--output", help="Also write the JSON result to this file")
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    args = parse_args()
+    if args.speed <= 0:
+        print("--speed must be positive", file=sys.stderr)
+        sys.exit(1)
+    recordings = load_recordings(args.recordings)
+    if not recordings:
+        print("No recorded traffic found", file=sys.stderr)
+        sys.exit(1)
+    report(asyncio.run(main_async(args, recordings)), args.output)
+
+
+if __name__ == "__main__":
+    main()
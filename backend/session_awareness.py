@@ -0,0 +1,90 @@
+"""
+Ephemeral presence state (cursors, "who is typing") for a story session.
+Only the latest state per client is kept, and only in memory; peers receive
+diffs of what changed since the last flush.
+"""
+
+import asyncio
+import json
+
+from ws_protocol import AWARENESS
+
+# Latest serialized JSON state per client; None in a diff means the client left
+AwarenessEntries = dict[str, bytes | None]
+
+
+def encode_awareness(entries: AwarenessEntries) -> bytes:
+    """0x05 + a JSON object mapping client keys to their state (null when removed)."""
+    body = b",".join(
+        b'"%s":%s' % (key.encode("utf-8"), b"null" if state is None else state) for key, state in entries.items()
+    )
+    return bytes([AWARENESS]) + b"{" + body + b"}"
+
+
+def decode_awareness(frame: bytes) -> AwarenessEntries:
+    """Parse an awareness diff frame. Raises ValueError if it is not a JSON object."""
+    data = _load(frame[1:])
+    if not isinstance(data, dict):
+        raise ValueError("Awareness frame must be a JSON object")
+    return {key: None if state is None else _dump(state) for key, state in data.items()}
+
+
+def _load(payload: bytes) -> object:
+    try:
+        return json.loads(payload)
+    except RecursionError as e:
+        # A few kilobytes of brackets nest past the interpreter's limit; treat it as any bad JSON
+        raise ValueError("Awareness state is nested too deeply") from e
+
+
+def _dump(state: object) -> bytes:
+    # Browsers' JSON.parse rejects NaN and Infinity, which json.loads accepts: a frame
+    # carrying one would break presence for the whole session, so it is an error here
+    return json.dumps(state, separators=(",", ":"), ensure_ascii=False, allow_nan=False).encode("utf-8")
+
+
+def parse_client_state(payload: bytes, max_size: int) -> bytes | None:
+    """
+    Validate a client's own state and return it re-serialized as compact UTF-8 JSON.
+    Empty payload clears it; raises ValueError if invalid or too large.
+    """
+    if not payload:
+        return None
+    if len(payload) > max_size:
+        raise ValueError("Awareness state too large")
+    state = _dump(_load(payload))
+    if len(state) > max_size:
+        raise ValueError("Awareness state too large")
+    return state
+
+
+class SessionAwareness:
+    """Latest awareness state of every client in a session, plus what changed since the last flush."""
+
+    def __init__(self) -> None:
+        self.states: AwarenessEntries = {}
+        self.dirty: AwarenessEntries = {}
+        self.timer: asyncio.TimerHandle | None = None
+
+    def set(self, key: str, state: bytes | None) -> bool:
+        """Record a local client's state; returns False if nothing changed."""
+        if self.states.get(key) == state:
+            return False
+        if state is None:
+            del self.states[key]
+        else:
+            self.states[key] = state
+        self.dirty[key] = state
+        return True
+
+    def merge(self, entries: AwarenessEntries) -> None:
+        """Record states relayed from another worker; they are already on their way to peers."""
+        for key, state in entries.items():
+            if state is None:
+                self.states.pop(key, None)
+            else:
+                self.states[key] = state
+
+    def take_diff(self) -> AwarenessEntries:
+        diff, self.dirty = self.dirty, {}
+        return diff
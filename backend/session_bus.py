@@ -0,0 +1,269 @@
+"""
+Cross-worker pub/sub for session frames.
+Each uvicorn worker has its own ConnectionManager; a SessionBus forwards a
+session's frames to the other workers that have clients in that session.
+Routing is by subscription, so sessions whose clients all landed on the same
+worker never touch the bus.
+"""
+
+import asyncio
+import fcntl
+import os
+import struct
+from typing import Callable
+
+BusHandler = Callable[[str, bytes], None]
+ResyncHandler = Callable[[str], None]
+
+OP_SUBSCRIBE = 1
+OP_UNSUBSCRIBE = 2
+OP_PUBLISH = 3
+OP_READY = 4
+
+# op, session id length, payload length
+_HEADER = struct.Struct(">BHI")
+
+RECONNECT_DELAY = 0.5
+CONNECT_TIMEOUT = 2.0
+
+
+def encode_message(op: int, session_id: str, payload: bytes = b"") -> bytes:
+    sid = session_id.encode("utf-8")
+    return _HEADER.pack(op, len(sid), len(payload)) + sid + payload
+
+
+async def read_message(reader: asyncio.StreamReader) -> "tuple[int, str, bytes]":
+    op, sid_len, payload_len = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    sid = await reader.readexactly(sid_len)
+    payload = await reader.readexactly(payload_len)
+    return op, sid.decode("utf-8"), payload
+
+
+class SessionBus:
+    """
+    Base class for bus backends.
+    subscribe/unsubscribe/publish never block; incoming frames are passed to
+    the handler registered by the ConnectionManager.
+    """
+
+    def __init__(self) -> None:
+        self._handler: BusHandler | None = None
+        self._resync: ResyncHandler | None = None
+
+    def set_handler(self, handler: BusHandler, resync: ResyncHandler | None = None) -> None:
+        """Register the frame handler and an optional callback run for each session after a reconnect."""
+        self._handler = handler
+        self._resync = resync
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    def subscribe(self, session_id: str) -> None:
+        raise NotImplementedError
+
+    def unsubscribe(self, session_id: str) -> None:
+        raise NotImplementedError
+
+    def publish(self, session_id: str, frame: bytes) -> None:
+        raise NotImplementedError
+
+    def _deliver(self, session_id: str, frame: bytes) -> None:
+        if self._handler is not None:
+            self._handler(session_id, frame)
+
+
+class InProcessBroker:
+    """Shared routing table for InProcessBus instances in one process."""
+
+    def __init__(self) -> None:
+        self.subscribers: dict[str, set["InProcessBus"]] = {}
+
+
+class InProcessBus(SessionBus):
+    """Bus between managers in the same process (tests, embedded use)."""
+
+    def __init__(self, broker: InProcessBroker) -> None:
+        super().__init__()
+        self.broker = broker
+
+    def subscribe(self, session_id: str) -> None:
+        self.broker.subscribers.setdefault(session_id, set()).add(self)
+
+    def unsubscribe(self, session_id: str) -> None:
+        subs = self.broker.subscribers.get(session_id)
+        if subs is None:
+            return
+        subs.discard(self)
+        if not subs:
+            del self.broker.subscribers[session_id]
+
+    def publish(self, session_id: str, frame: bytes) -> None:
+        loop = asyncio.get_running_loop()
+        for bus in self.broker.subscribers.get(session_id, ()):
+            if bus is not self:
+                loop.call_soon(bus._deliver, session_id, frame)
+
+
+class UnixSocketBroker:
+    """Relays published frames to the other workers subscribed to the session."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._server: asyncio.AbstractServer | None = None
+        self._subscribers: dict[str, set[asyncio.StreamWriter]] = {}
+        self._clients: set[asyncio.StreamWriter] = set()
+
+    async def start(self) -> None:
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # stale socket left by a worker that died
+        self._server = await asyncio.start_unix_server(self._serve, path=self.path)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._clients):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        subscribed: set[str] = set()
+        self._clients.add(writer)
+        writer.write(encode_message(OP_READY, ""))
+        try:
+            while True:
+                op, session_id, payload = await read_message(reader)
+                if op == OP_SUBSCRIBE:
+                    self._subscribers.setdefault(session_id, set()).add(writer)
+                    subscribed.add(session_id)
+                elif op == OP_UNSUBSCRIBE:
+                    self._remove(session_id, writer)
+                    subscribed.discard(session_id)
+                elif op == OP_PUBLISH:
+                    message = encode_message(OP_PUBLISH, session_id, payload)
+                    for peer in self._subscribers.get(session_id, ()):
+                        if peer is not writer:
+                            peer.write(message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for session_id in subscribed:
+                self._remove(session_id, writer)
+            self._clients.discard(writer)
+            writer.close()
+
+    def _remove(self, session_id: str, writer: asyncio.StreamWriter) -> None:
+        subs = self._subscribers.get(session_id)
+        if subs is None:
+            return
+        subs.discard(writer)
+        if not subs:
+            del self._subscribers[session_id]
+
+
+class UnixSocketBus(SessionBus):
+    """
+    Bus between workers on one machine over a Unix socket.
+    The worker holding an flock on "<path>.lock" runs the broker; if it dies the
+    lock is released and the next worker to reconnect takes over.
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.path = path
+        self._sessions: set[str] = set()
+        self._broker: UnixSocketBroker | None = None
+        self._lock_fd: int | None = None
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._read_task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        await self._connect_until_ready()
+        self._read_task = asyncio.create_task(self._read_loop())
+
+    async def stop(self) -> None:
+        if self._read_task is not None:
+            self._read_task.cancel()
+            self._read_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._broker is not None:
+            await self._broker.stop()
+            self._broker = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def subscribe(self, session_id: str) -> None:
+        self._sessions.add(session_id)
+        self._send(encode_message(OP_SUBSCRIBE, session_id))
+
+    def unsubscribe(self, session_id: str) -> None:
+        self._sessions.discard(session_id)
+        self._send(encode_message(OP_UNSUBSCRIBE, session_id))
+
+    def publish(self, session_id: str, frame: bytes) -> None:
+        self._send(encode_message(OP_PUBLISH, session_id, frame))
+
+    def _send(self, message: bytes) -> None:
+        # While reconnecting frames are dropped; peers resync when we resubscribe
+        if self._writer is not None:
+            self._writer.write(message)
+
+    async def _connect(self) -> None:
+        """Become the broker if no other worker is, then connect to it and resubscribe."""
+        if self._broker is None and self._try_lock():
+            self._broker = UnixSocketBroker(self.path)
+            await self._broker.start()
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        try:
+            # Only trust the connection once the broker has actually started serving it
+            op, _sid, _payload = await asyncio.wait_for(read_message(reader), CONNECT_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            writer.close()
+            raise ConnectionError("session bus broker did not answer") from e
+        if op != OP_READY:
+            writer.close()
+            raise ConnectionError("unexpected session bus handshake")
+        self._reader, self._writer = reader, writer
+        for session_id in self._sessions:
+            self._writer.write(encode_message(OP_SUBSCRIBE, session_id))
+
+    async def _connect_until_ready(self) -> None:
+        while True:
+            try:
+                await self._connect()
+                return
+            except OSError:
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    def _try_lock(self) -> bool:
+        fd = os.open(self.path + ".lock", os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    async def _read_loop(self) -> None:
+        while True:
+            try:
+                op, session_id, payload = await read_message(self._reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self._writer = None
+                await asyncio.sleep(RECONNECT_DELAY)
+                await self._connect_until_ready()
+                # Frames published while disconnected were lost: resync every session
+                if self._resync is not None:
+                    for session_id in list(self._sessions):
+                        self._resync(session_id)
+                continue
+            if op == OP_PUBLISH:
+                self._deliver(session_id, payload)
@@ -0,0 +1,47 @@
+"""
+Server-side Yjs replica of a story session's document.
+Lets the backend answer sync requests itself instead of relaying them to every peer.
+"""
+
+from pycrdt import Doc, Text
+
+EMPTY_STATE_VECTOR = b"\x00"
+# Shared text type the frontend edits (doc.getText('story'))
+STORY_TEXT = "story"
+
+
+class SessionDoc:
+    """CRDT replica kept up to date with every update the session receives."""
+
+    def __init__(self) -> None:
+        self._doc = Doc()
+
+    def apply_update(self, update: bytes) -> bool:
+        """Apply a Yjs update. Returns False if it could not be decoded."""
+        try:
+            self._doc.apply_update(update)
+        except ValueError:
+            return False
+        return True
+
+    def is_empty(self) -> bool:
+        return self._doc.get_state() == EMPTY_STATE_VECTOR
+
+    def text(self, name: str = STORY_TEXT) -> str:
+        """Current contents of a shared text type."""
+        return str(self._doc.get(name, type=Text))
+
+    def state_vector(self) -> bytes:
+        return self._doc.get_state()
+
+    def encode_state(self, state_vector: bytes | None = None) -> bytes:
+        """
+        Encode the document as a single update.
+        With a client state vector, only the missing part (diff) is encoded.
+        """
+        if state_vector:
+            try:
+                return self._doc.get_update(state_vector)
+            except ValueError:
+                pass
+        return self._doc.get_update()
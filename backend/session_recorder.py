@@ -0,0 +1,92 @@
+"""
+Opt-in recording of client traffic on /ws/story for offline replay.
+Each session gets its own append-only log of what its clients sent: joins,
+frames (as received, before any limits or decompression) and leaves, each with
+a wall-clock timestamp. scripts/ws_replay.py plays the logs back against a server.
+"""
+
+import hashlib
+import struct
+import time
+from pathlib import Path
+from typing import BinaryIO
+
+MAGIC = b"STREC1\n"
+
+RECORD_JOIN = 0
+RECORD_FRAME = 1
+RECORD_LEAVE = 2
+
+# Wall-clock seconds, record kind, connection id, payload length
+_RECORD_HEADER = struct.Struct(">dBII")
+_SESSION_HEADER = struct.Struct(">H")
+
+# (timestamp, kind, connection id, payload); a join's payload is b"deflate" for compressed clients
+Record = tuple[float, int, int, bytes]
+
+
+class TrafficRecorder:
+    """Writes one *.rec file per session; files stay open (buffered) while the session has clients."""
+
+    def __init__(self, root: str | Path) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._files: dict[str, BinaryIO] = {}
+
+    def join(self, session_id: str, connection: int, compress: bool = False) -> None:
+        self._write(session_id, RECORD_JOIN, connection, b"deflate" if compress else b"")
+
+    def frame(self, session_id: str, connection: int, data: bytes) -> None:
+        self._write(session_id, RECORD_FRAME, connection, data)
+
+    def leave(self, session_id: str, connection: int) -> None:
+        self._write(session_id, RECORD_LEAVE, connection, b"")
+
+    def close_session(self, session_id: str) -> None:
+        f = self._files.pop(session_id, None)
+        if f is not None:
+            f.close()
+
+    def close(self) -> None:
+        for session_id in list(self._files):
+            self.close_session(session_id)
+
+    def path(self, session_id: str) -> Path:
+        # Session ids come from the URL; hash them into safe file names
+        return self.root / (hashlib.sha256(session_id.encode("utf-8")).hexdigest() + ".rec")
+
+    def _write(self, session_id: str, kind: int, connection: int, payload: bytes) -> None:
+        f = self._files.get(session_id)
+        if f is None:
+            # Stays open while the session has clients; close_session closes it
+            f = self._files[session_id] = open(self.path(session_id), "ab")  # pylint: disable=consider-using-with
+            if f.tell() == 0:
+                name = session_id.encode("utf-8")
+                f.write(MAGIC + _SESSION_HEADER.pack(len(name)) + name)
+        f.write(_RECORD_HEADER.pack(time.time(), kind, connection, len(payload)) + payload)
+
+
+def read_recording(path: str | Path) -> tuple[str, list[Record]]:
+    """Return (session_id, records) from a *.rec file. A truncated last record is ignored."""
+    raw = Path(path).read_bytes()
+    if not raw.startswith(MAGIC):
+        raise ValueError(f"Not a traffic recording: {path}")
+    offset = len(MAGIC)
+    (name_len,) = _SESSION_HEADER.unpack_from(raw, offset)
+    offset += _SESSION_HEADER.size
+    session_id = raw[offset : offset + name_len].decode("utf-8")
+    offset += name_len
+    records: list[Record] = []
+    while offset + _RECORD_HEADER.size <= len(raw):
+        timestamp, kind, connection, size = _RECORD_HEADER.unpack_from(raw, offset)
+        offset += _RECORD_HEADER.size
+        if offset + size > len(raw):
+            break
+        records.append((timestamp, kind, connection, raw[offset : offset + size]))
+        offset += size
+    return session_id, records
+
+
+def open_recorder(path: str) -> TrafficRecorder | None:
+    """Open a recorder writing into a directory; an empty path disables recording."""
+    return TrafficRecorder(path) if path else None
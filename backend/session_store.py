@@ -0,0 +1,268 @@
+"""
+Durable local storage for session documents.
+Every Yjs update is appended to a per-session log; once the log passes a
+threshold it is compacted into a single snapshot, so rejoining a cold session
+only reads one snapshot plus a short tail.
+"""
+
+import hashlib
+import os
+import sqlite3
+import struct
+import threading
+import time
+from pathlib import Path
+
+from pycrdt import merge_updates
+
+COMPACT_MAX_UPDATES = 500
+COMPACT_MAX_BYTES = 1024 * 1024
+
+# Buffered file-store appends are written at most this long after the update
+FLUSH_INTERVAL = 0.05
+
+_RECORD_HEADER = struct.Struct(">I")
+
+
+def _parse_log(raw: bytes) -> "tuple[list[bytes], int]":
+    """Complete length-prefixed records and the offset where they end; past it is a torn write."""
+    entries: list[bytes] = []
+    offset = 0
+    while offset + _RECORD_HEADER.size <= len(raw):
+        (size,) = _RECORD_HEADER.unpack_from(raw, offset)
+        start = offset + _RECORD_HEADER.size
+        if start + size > len(raw):
+            break
+        entries.append(raw[start : start + size])
+        offset = start + size
+    return entries, offset
+
+
+class SessionStore:
+    """
+    Base class for persistence backends.
+    append() is called on the event loop for every update and must be cheap;
+    compact() runs in a worker thread and may overlap with appends.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+
+    def append(self, session_id: str, update: bytes) -> None:
+        raise NotImplementedError
+
+    def load(self, session_id: str) -> "tuple[bytes | None, list[bytes]]":
+        """Return (snapshot, log tail); the tail is ordered oldest first."""
+        with self._lock:
+            snapshot, tail, _mark = self._read(session_id)
+        return snapshot, tail
+
+    def compact(self, session_id: str) -> None:
+        """Fold the snapshot and the current log into a new snapshot."""
+        with self._lock:
+            snapshot, tail, mark = self._read(session_id)
+        if not tail:
+            return
+        merged = merge_updates(*(([snapshot] if snapshot else []) + tail))
+        with self._lock:
+            self._replace(session_id, merged, mark, snapshot)
+
+    def flush(self) -> None:
+        """Write anything append() buffered (at shutdown)."""
+
+    def close(self) -> None:
+        pass
+
+    def _read(self, session_id: str) -> "tuple[bytes | None, list[bytes], int]":
+        """Return (snapshot, log entries, mark); mark identifies the last entry read."""
+        raise NotImplementedError
+
+    def _replace(self, session_id: str, snapshot: bytes, mark: int, base: bytes | None) -> None:
+        """Store snapshot and drop log entries up to and including mark; base is the snapshot it was merged from."""
+        raise NotImplementedError
+
+
+class BufferedSessionStore(SessionStore):
+    """
+    append() only buffers the update; a writer thread hands buffered updates to
+    _write_records() every flush_interval, one batch per session. Loads and compactions
+    write a session's buffered updates first, so they always see every append.
+    """
+
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL) -> None:
+        super().__init__()
+        self.flush_interval = flush_interval
+        # Guards only the buffers, so append() never waits on disk I/O under _lock
+        self._buffer_lock = threading.Lock()
+        self._buffers: dict[str, list[bytes]] = {}
+        self._wake = threading.Event()
+        self._closed = False
+        self._writer: threading.Thread | None = None
+
+    def append(self, session_id: str, update: bytes) -> None:
+        with self._buffer_lock:
+            self._buffers.setdefault(session_id, []).append(update)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="session-store", daemon=True)
+                self._writer.start()
+        self._wake.set()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._write_pending()
+
+    def close(self) -> None:
+        self._closed = True
+        self._wake.set()
+        if self._writer is not None:
+            self._writer.join()
+        self.flush()
+
+    def _write_loop(self) -> None:
+        while not self._closed:
+            self._wake.wait()
+            # Let a burst of keystrokes share one write
+            time.sleep(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def _write_pending(self, session_id: str | None = None) -> None:
+        """Write buffered updates (one session's, or all); the caller holds _lock."""
+        with self._buffer_lock:
+            if session_id is None:
+                buffers, self._buffers = self._buffers, {}
+            else:
+                buffers = {session_id: self._buffers.pop(session_id, [])}
+        for sid, updates in buffers.items():
+            if updates:
+                self._write_records(sid, updates)
+
+    def _write_records(self, session_id: str, updates: list[bytes]) -> None:
+        """Append a batch of updates to the session's log."""
+        raise NotImplementedError
+
+
+class FileSessionStore(BufferedSessionStore):
+    """
+    One directory per session holding snapshot.bin and a length-prefixed log.bin.
+    Single worker only: nothing locks the files across processes.
+    Each batch of buffered appends opens the session's log once.
+    """
+
+    def __init__(self, root: str | Path, flush_interval: float = FLUSH_INTERVAL) -> None:
+        super().__init__(flush_interval)
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Sessions whose log has been checked for a torn record since startup
+        self._checked: set[str] = set()
+
+    def _write_records(self, session_id: str, updates: list[bytes]) -> None:
+        path = self._dir(session_id)
+        path.mkdir(exist_ok=True)
+        self._repair(session_id, path / "log.bin")
+        with open(path / "log.bin", "ab") as f:
+            f.write(b"".join(_RECORD_HEADER.pack(len(u)) + u for u in updates))
+
+    def _repair(self, session_id: str, log_path: Path) -> None:
+        """Cut a record torn by a crash off the end of the log, once per session, before anything follows it."""
+        if session_id in self._checked:
+            return
+        self._checked.add(session_id)
+        if not log_path.exists():
+            return
+        raw = log_path.read_bytes()
+        _entries, end = _parse_log(raw)
+        if end < len(raw):
+            os.truncate(log_path, end)
+
+    def _dir(self, session_id: str) -> Path:
+        # Session ids come from the URL; hash them into safe directory names
+        return self.root / hashlib.sha256(session_id.encode("utf-8")).hexdigest()
+
+    def _read(self, session_id: str) -> "tuple[bytes | None, list[bytes], int]":
+        path = self._dir(session_id)
+        log_path = path / "log.bin"
+        self._repair(session_id, log_path)
+        self._write_pending(session_id)
+        snapshot_path = path / "snapshot.bin"
+        snapshot = snapshot_path.read_bytes() if snapshot_path.exists() else None
+        raw = log_path.read_bytes() if log_path.exists() else b""
+        entries, offset = _parse_log(raw)
+        return snapshot, entries, offset
+
+    def _replace(self, session_id: str, snapshot: bytes, mark: int, base: bytes | None) -> None:
+        path = self._dir(session_id)
+        tmp = path / "snapshot.tmp"
+        tmp.write_bytes(snapshot)
+        os.replace(tmp, path / "snapshot.bin")
+        log_path = path / "log.bin"
+        rest = log_path.read_bytes()[mark:]
+        tmp = path / "log.tmp"
+        tmp.write_bytes(rest)
+        os.replace(tmp, log_path)
+
+
+class SQLiteSessionStore(BufferedSessionStore):
+    """
+    Snapshots and update log in a single SQLite database (WAL mode); several workers may share it.
+    Buffered appends go in one transaction per batch, so another worker loading a cold
+    session sees them at most flush_interval late.
+    """
+
+    def __init__(self, path: str | Path, flush_interval: float = FLUSH_INTERVAL) -> None:
+        super().__init__(flush_interval)
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS snapshots (session_id TEXT PRIMARY KEY, data BLOB NOT NULL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS updates "
+            "(id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, data BLOB NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS updates_session ON updates (session_id, id)")
+
+    def close(self) -> None:
+        super().close()
+        with self._lock:
+            self._db.close()
+
+    def _write_records(self, session_id: str, updates: list[bytes]) -> None:
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT INTO updates (session_id, data) VALUES (?, ?)", [(session_id, u) for u in updates]
+            )
+
+    def _read(self, session_id: str) -> "tuple[bytes | None, list[bytes], int]":
+        self._write_pending(session_id)
+        # One read transaction: another worker's compaction must not land between the two queries
+        with self._db:
+            self._db.execute("BEGIN")
+            row = self._db.execute("SELECT data FROM snapshots WHERE session_id = ?", (session_id,)).fetchone()
+            rows = self._db.execute(
+                "SELECT id, data FROM updates WHERE session_id = ? ORDER BY id", (session_id,)
+            ).fetchall()
+        mark = rows[-1][0] if rows else 0
+        return (row[0] if row else None), [data for _id, data in rows], mark
+
+    def _replace(self, session_id: str, snapshot: bytes, mark: int, base: bytes | None) -> None:
+        with self._db:
+            # Takes the write lock before the check, so workers sharing the file compact one at a time
+            self._db.execute("BEGIN IMMEDIATE")
+            row = self._db.execute("SELECT data FROM snapshots WHERE session_id = ?", (session_id,)).fetchone()
+            if (row[0] if row else None) != base:
+                # Another worker compacted meanwhile; its snapshot covers more of the log than ours
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO snapshots (session_id, data) VALUES (?, ?)", (session_id, snapshot)
+            )
+            self._db.execute("DELETE FROM updates WHERE session_id = ? AND id <= ?", (session_id, mark))
+
+
+def open_store(path: str) -> SessionStore | None:
+    """Open a store from a path: *.db / *.sqlite is SQLite, anything else a directory. Empty disables persistence."""
+    if not path:
+        return None
+    if path.endswith((".db", ".sqlite", ".sqlite3")):
+        return SQLiteSessionStore(path)
+    return FileSessionStore(path)
@@ -0,0 +1,32 @@
+"""
+Single-flight execution: concurrent calls with the same key share one run.
+The first caller starts the work in its own task; later callers with that key await
+the same result instead of starting another run. The key is forgotten as soon as
+the run finishes, so this coalesces duplicates in flight; it does not cache.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+import metrics
+
+
+class SingleFlight:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._flights: dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def run(self, key: Hashable, work: Callable[[], Awaitable[Any]]) -> Any:
+        """Return work()'s result, sharing it with every concurrent caller using the same key."""
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.create_task(work())
+            self._flights[key] = task
+            task.add_done_callback(lambda _task: self._flights.pop(key, None))
+        else:
+            metrics.SINGLE_FLIGHT_SHARED.inc(labels=(self.name,))
+        # A caller that goes away does not cancel the run the others are waiting for
+        return await asyncio.shield(task)
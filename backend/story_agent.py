@@ -1,15 +1,24 @@
 """
 LangGraph story agent: safety check -> LLM or fallback.
-Uses StateGraph only (no AgentExecutor).
+Uses StateGraph only (no AgentExecutor). Nodes are async; run the graph with ainvoke / astream.
 """
 
 import re
-from typing import Literal
+from typing import Any, Literal
 
-from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.callbacks import AsyncCallbackHandler, BaseCallbackManager
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph import END, START, StateGraph
 from agent_state import AgentState
+from context_builder import PromptParts, build_messages
+import generation_cache
+import health
+import llm_scheduler
+import model_router
 from llm_client import get_llm
+from metrics import GENERATE_SECONDS
+from story_memory import remember_turn
 from lore_tools import search_lore
 
 # Simple PII / off-topic patterns (guard clauses)
@@ -31,27 +40,48 @@ def _safety_check(text: str) -> bool:
     return True
 
 
-def safety_check_node(state: AgentState) -> dict:
+async def safety_check_node(state: AgentState) -> dict:
     """Validate user input for PII or off-topic content."""
     user_input = state.get("user_input") or ""
-    passed = _safety_check(user_input)
+    with GENERATE_SECONDS.time(("safety",)):
+        passed = _safety_check(user_input)
     return {"safety_passed": passed}
 
 
-def rag_node(state: AgentState) -> dict:
-    """Retrieve thematic context from lore (RAG) and append to story_context."""
+async def rag_node(state: AgentState) -> dict:
+    """Retrieve thematic context from lore (RAG) for the prompt."""
     user_input = state.get("user_input") or ""
-    story_context = state.get("story_context") or ""
-    lore = search_lore.invoke({"query": user_input, "top_k": 3})
-    if lore:
-        story_context = (story_context + "\n\nRelevant lore:\n" + lore).strip()
-    return {"story_context": story_context}
+    with GENERATE_SECONDS.time(("rag",)):
+        lore = await search_lore.ainvoke({"query": user_input, "top_k": 3})
+    return {"lore": lore or ""}
 
 
-def llm_node(state: AgentState) -> dict:
-    """Generate story continuation using the local LLM."""
+# The ancestry is LangChain's handler mixins
+class _TokenWatch(AsyncCallbackHandler):  # pylint: disable=too-many-ancestors
+    """Notes whether a model call has streamed any of its reply yet."""
+
+    def __init__(self) -> None:
+        self.streamed = False
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.streamed = True
+
+
+def _watched(config: RunnableConfig | None, watch: _TokenWatch) -> RunnableConfig:
+    """The node's config with watch added to its callbacks, so streaming to the graph's caller still works."""
+    callbacks = (config or {}).get("callbacks")
+    if isinstance(callbacks, BaseCallbackManager):
+        callbacks = callbacks.copy()
+        callbacks.add_handler(watch)
+    else:
+        callbacks = [*(callbacks or []), watch]
+    return {**(config or {}), "callbacks": callbacks}
+
+
+# Prompt, cache lookup and failover state of one turn, kept together for the error path
+async def llm_node(state: AgentState, config: RunnableConfig | None = None) -> dict:  # pylint: disable=too-many-locals
+    """Generate story continuation using the local LLM, on the model tier the turn is routed to."""
     user_input = state.get("user_input") or ""
-    story_context = state.get("story_context") or ""
     history = state.get("conversation_history") or []
 
     system = (
@@ -59,24 +89,59 @@ def llm_node(state: AgentState) -> dict:
         "Keep responses short, whimsical, and suitable for all ages. "
         "Do not repeat or include PII. If story context is provided, use it."
     )
-    if story_context:
-        system += f"\n\nCurrent story context:\n{story_context[:2000]}"
-
-    messages = [SystemMessage(content=system)]
-    for msg in history[-10:]:
-        messages.append(msg)
-    messages.append(HumanMessage(content=user_input))
+    tier = model_router.choose_tier(user_input, state.get("latency") or "")
+    parts = PromptParts(
+        system,
+        user_input,
+        story_context=state.get("story_context") or "",
+        lore=state.get("lore") or "",
+        history=history,
+        session_id=state.get("session_id") or "",
+    )
+    messages = build_messages(parts, budget=tier.prompt_budget)
 
+    model = tier.model
     try:
-        llm = get_llm()
-        response = llm.invoke(messages)
+        llm = get_llm(model)
+        cache = generation_cache.cache
+        lookup = None
+        if cache is not None:
+            context = "\n".join(f"{m.type}: {m.content}" for m in messages[:-1])
+            lookup = await cache.lookup(tier.model, context, user_input)
+            if lookup.response is not None:
+                return {
+                    "response": lookup.response,
+                    "conversation_history": remember_turn(history, user_input, lookup.response),
+                }
+        async with llm_scheduler.scheduler.slot(state.get("session_id") or ""):
+            with GENERATE_SECONDS.time(("llm",)):
+                watch = _TokenWatch()
+                call_config = _watched(config, watch)
+                try:
+                    response = await llm.ainvoke(messages, call_config)
+                except Exception:
+                    # Once part of the reply has streamed to the session, the other tier would repeat it
+                    if watch.streamed:
+                        raise
+                    fallback = model_router.fallback_for(tier)
+                    if fallback is None:
+                        raise
+                    model = fallback.model
+                    response = await get_llm(model).ainvoke(messages, call_config)
+        health.monitor.generation_succeeded()
         content = response.content if hasattr(response, "content") else str(response)
-        return {"response": content or "The story continues..."}
+        if not content:
+            return {"response": "The story continues..."}
+        if lookup is not None:
+            cache.store(lookup, content, model)
+        return {"response": content, "conversation_history": remember_turn(history, user_input, content)}
+    except llm_scheduler.LLMOverloaded:
+        raise
     except Exception:
-        return {"response": "The story guide is resting. Make sure Ollama is running with llama3.1:8b and try again."}
+        return {"response": f"The story guide is resting. Make sure Ollama is running with {model} and try again."}
 
 
-def fallback_node(state: AgentState) -> dict:
+async def fallback_node(state: AgentState) -> dict:
     """Return a safe deterministic response when safety check fails."""
     return {"response": "Let's keep our tale safe and on topic. Try asking what happens next in the story!"}
 
@@ -87,7 +152,8 @@ def route_after_safety(state: AgentState) -> Literal["llm_node", "fallback_node"
     return "fallback_node"
 
 
-def build_story_graph() -> StateGraph:
+def build_story_graph(checkpointer: BaseCheckpointSaver | None = None) -> StateGraph:
+    """Compile the graph; with a checkpointer, runs given a thread_id continue that thread's state."""
     workflow = StateGraph(AgentState)
     workflow.add_node("safety_check_node", safety_check_node)
     workflow.add_node("rag_node", rag_node)
@@ -104,4 +170,4 @@ def build_story_graph() -> StateGraph:
     workflow.add_edge("llm_node", END)
     workflow.add_edge("fallback_node", END)
 
-    return workflow.compile()
+    return workflow.compile(checkpointer=checkpointer)
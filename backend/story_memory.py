@@ -0,0 +1,134 @@
+"""
+Per-session conversation memory for the story graph, kept as LangGraph checkpoints.
+A run with a session id uses it as the thread id, so llm_node's turns accumulate in
+conversation_history and the next prompt carries them without clients resending
+anything. The history is trimmed in chunks rather than sliding by one turn, so the
+prompt keeps a stable prefix that Ollama can reuse from its KV cache. Only the
+latest checkpoint of each session is stored, and sessions idle past a TTL or
+beyond a count are dropped.
+"""
+
+import os
+import time
+from typing import Any
+
+import aiosqlite
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, RemoveMessage
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+from context_builder import HISTORY_MESSAGES, HISTORY_TOKENS, estimate_tokens
+
+# SQLite file that keeps conversations across restarts; empty keeps them in memory only, "off" disables them
+STORY_MEMORY_PATH = os.environ.get("SAFETALE_STORY_MEMORY", "")
+STORY_MEMORY_TTL = 7 * 24 * 60 * 60
+STORY_MEMORY_MAX_SESSIONS = 10_000
+SWEEP_INTERVAL = 60.0
+
+
+# AsyncSqliteSaver leaves the optional copy/prune/delete-for-runs methods to the base
+# class, which raises NotImplementedError; the story never calls them
+class SessionCheckpointer(AsyncSqliteSaver):  # pylint: disable=abstract-method
+    """AsyncSqliteSaver that keeps one checkpoint per session and forgets idle sessions."""
+
+    def __init__(
+        self,
+        conn: aiosqlite.Connection,
+        ttl: float = STORY_MEMORY_TTL,
+        max_sessions: int = STORY_MEMORY_MAX_SESSIONS,
+    ) -> None:
+        super().__init__(conn)
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._swept_at = 0.0
+
+    async def setup(self) -> None:
+        if self.is_setup:
+            return
+        # Last use of each session, for the sweep
+        await self.conn.execute("CREATE TABLE IF NOT EXISTS sessions (thread_id TEXT PRIMARY KEY, used REAL NOT NULL)")
+        await self.conn.commit()
+        await super().setup()
+
+    async def aput(self, config: dict, checkpoint: Any, metadata: Any, new_versions: Any) -> dict:
+        saved = await super().aput(config, checkpoint, metadata, new_versions)
+        thread_id = saved["configurable"]["thread_id"]
+        latest = (thread_id, saved["configurable"]["checkpoint_ns"], saved["configurable"]["checkpoint_id"])
+        # Earlier checkpoints only serve time travel, which the story does not use
+        async with self.lock, self.conn.cursor() as cur:
+            await cur.execute(
+                "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id <> ?", latest
+            )
+            await cur.execute(
+                "DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id <> ?", latest
+            )
+            await cur.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?)", (thread_id, time.time()))
+            await self.conn.commit()
+        if time.monotonic() - self._swept_at >= SWEEP_INTERVAL:
+            await self.sweep()
+        return saved
+
+    async def sweep(self) -> list[str]:
+        """Delete sessions idle longer than ttl, then the least recently used beyond max_sessions."""
+        self._swept_at = time.monotonic()
+        async with self.lock:
+            async with self.conn.execute(
+                "SELECT thread_id FROM sessions WHERE used < ? "
+                "UNION SELECT thread_id FROM (SELECT thread_id FROM sessions ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (time.time() - self.ttl, self.max_sessions),
+            ) as cur:
+                expired = [row[0] async for row in cur]
+            for table in ("checkpoints", "writes", "sessions"):
+                await self.conn.executemany(f"DELETE FROM {table} WHERE thread_id = ?", [(t,) for t in expired])
+            await self.conn.commit()
+        return expired
+
+
+checkpointer: SessionCheckpointer | None = None
+
+
+async def open_memory(path: str = STORY_MEMORY_PATH) -> SessionCheckpointer | None:
+    """Open the process-wide checkpointer (at startup): a SQLite file for a path, in memory when empty."""
+    global checkpointer
+    if path == "off":
+        return None
+    conn = await aiosqlite.connect(path or ":memory:")
+    checkpointer = SessionCheckpointer(conn)
+    await checkpointer.setup()
+    return checkpointer
+
+
+async def close_memory() -> None:
+    global checkpointer
+    saver, checkpointer = checkpointer, None
+    if saver is not None:
+        await saver.conn.close()
+
+
+def run_config(session_id: str) -> dict | None:
+    """Graph config that keeps this session's conversation; None without a session or memory."""
+    if not session_id or checkpointer is None:
+        return None
+    return {"configurable": {"thread_id": session_id}}
+
+
+def remember_turn(history: list[BaseMessage], user_input: str, response: str) -> list[BaseMessage]:
+    """
+    Updates for conversation_history (an add_messages channel) that append this turn.
+    Past the history limits the oldest turns are dropped down to half of them in one go.
+    """
+    turn = [HumanMessage(content=user_input), AIMessage(content=response)]
+    kept = [*history, *turn]
+
+    def over(limit_messages: int, limit_tokens: int) -> bool:
+        return len(kept) > limit_messages or sum(estimate_tokens(str(m.content)) for m in kept) > limit_tokens
+
+    if not over(HISTORY_MESSAGES, HISTORY_TOKENS):
+        return turn
+    dropped = 0
+    # Whole turns go: the kept history starts with the user's message
+    while len(kept) > len(turn) and (
+        over(HISTORY_MESSAGES // 2, HISTORY_TOKENS // 2) or isinstance(kept[0], AIMessage)
+    ):
+        kept.pop(0)
+        dropped += 1
+    return [RemoveMessage(id=m.id) for m in history[:dropped] if m.id] + turn
@@ -0,0 +1,225 @@
+"""
+Streaming story generation.
+Over /ws/story/{session_id}, a client sends a 0x06 request; the story graph runs once
+per session at a time and its tokens stream to every collaborator as 0x07 events.
+Requests that arrive while one is running are queued (or joined, if identical)
+instead of starting another run. POST /api/generate-story/stream sends the same
+events to a single HTTP client as NDJSON, and stops the graph if the client goes away.
+"""
+
+import asyncio
+import itertools
+import json
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+from fastapi import WebSocket
+from langchain_core.messages import AIMessageChunk
+
+import metrics
+import story_memory
+from llm_scheduler import LLMOverloaded
+from model_router import LATENCY_HINTS
+from ws_manager import ConnectionManager
+from ws_protocol import GENERATION
+
+# Requests waiting behind the running one, per session
+MAX_QUEUED_GENERATIONS = 2
+# Tokens are batched into one event per interval instead of one frame per token
+TOKEN_FLUSH_INTERVAL = 0.05
+MAX_USER_INPUT_CHARS = 2000
+EMPTY_INPUT_PROMPT = "What would you like to happen next in the story?"
+RESTING_TEXT = "The story guide is resting."
+
+_generation_ids = itertools.count(1)
+
+
+def encode_event(event: dict) -> bytes:
+    return bytes([GENERATION]) + json.dumps(event, separators=(",", ":")).encode("utf-8")
+
+
+def initial_state(user_input: str, story_context: str, session_id: str = "", latency: str = "") -> dict:
+    return {
+        "story_context": story_context,
+        "lore": "",
+        "user_input": user_input,
+        "conversation_history": [],
+        "safety_passed": False,
+        "response": "",
+        "session_id": session_id,
+        "latency": latency,
+    }
+
+
+async def stream_story(graph: Any, initial: dict, config: dict | None = None) -> AsyncIterator[dict]:
+    """Run the graph, yielding a token event per LLM chunk as it is generated, then a done event."""
+    response = ""
+    with metrics.GENERATE_SECONDS.time(("total",)):
+        async for mode, chunk in graph.astream(initial, config, stream_mode=["messages", "values"]):
+            if mode == "values":
+                response = chunk.get("response") or response
+                continue
+            message, meta = chunk
+            # Only the model's streamed chunks; llm_node's history update is emitted here too
+            if meta.get("langgraph_node") == "llm_node" and isinstance(message, AIMessageChunk) and message.content:
+                yield {"event": "token", "text": message.content}
+    yield {"event": "done", "text": response}
+
+
+async def ndjson_stream(events: AsyncIterator[dict], receive: Callable[[], Awaitable[dict]]) -> AsyncIterator[bytes]:
+    """
+    Yield events as NDJSON lines. The events are produced in their own task, which is
+    cancelled (closing the upstream Ollama request) as soon as receive() reports that the
+    HTTP client disconnected, even while no tokens are flowing yet.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def produce() -> None:
+        try:
+            async for event in events:
+                queue.put_nowait(event)
+        except LLMOverloaded as exc:
+            queue.put_nowait({"event": "busy", "retry_after": exc.retry_after})
+        except Exception:
+            queue.put_nowait({"event": "error", "text": RESTING_TEXT})
+        queue.put_nowait(done)
+
+    async def watch() -> None:
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        producer.cancel()
+        queue.put_nowait(done)
+
+    producer = asyncio.create_task(produce())
+    watcher = asyncio.create_task(watch())
+    try:
+        while (event := await queue.get()) is not done:
+            yield (json.dumps(event, separators=(",", ":")) + "\n").encode("utf-8")
+    finally:
+        producer.cancel()
+        watcher.cancel()
+        await asyncio.gather(producer, watcher, return_exceptions=True)
+
+
+class GenerationJob:
+    def __init__(self, user_input: str, story_context: str | None, latency: str = "") -> None:
+        self.id = next(_generation_ids)
+        self.user_input = user_input
+        self.story_context = story_context
+        self.latency = latency
+
+
+class SessionGenerations:
+    """The running generation of one session and the requests queued behind it."""
+
+    def __init__(self) -> None:
+        self.current: GenerationJob | None = None
+        self.queue: deque[GenerationJob] = deque()
+        self.task: asyncio.Task | None = None
+
+
+class StoryGenerations:
+    """Runs the story graph for WebSocket requests and fans its output out to the session."""
+
+    def __init__(
+        self,
+        manager: ConnectionManager,
+        graph_factory: Callable[[], Any],
+        max_queued: int = MAX_QUEUED_GENERATIONS,
+    ) -> None:
+        self.manager = manager
+        self.graph_factory = graph_factory
+        self.max_queued = max_queued
+        self._sessions: dict[str, SessionGenerations] = {}
+
+    def request(self, session_id: str, websocket: WebSocket, payload: bytes) -> None:
+        """Handle a 0x06 frame: start, join or queue a generation for the session."""
+        try:
+            body = json.loads(payload)
+            user_input = str(body.get("user_input") or "").strip()[:MAX_USER_INPUT_CHARS]
+            story_context = body.get("story_context")
+            latency = body.get("latency")
+        except (ValueError, AttributeError, RecursionError):
+            self._reply(websocket, session_id, {"event": "error", "text": "Invalid generation request"})
+            return
+        if not user_input:
+            self._reply(websocket, session_id, {"event": "error", "text": EMPTY_INPUT_PROMPT})
+            return
+        gens = self._sessions.get(session_id)
+        if gens is None:
+            gens = self._sessions[session_id] = SessionGenerations()
+        # Several collaborators asking for the same thing watch the same run
+        for job in ([gens.current] if gens.current else []) + list(gens.queue):
+            if job.user_input == user_input:
+                self._reply(websocket, session_id, {"id": job.id, "event": "joined"})
+                return
+        # Until the task picks it up, the head of the queue is the run, not a waiter
+        waiting = len(gens.queue) - (gens.current is None)
+        if waiting >= self.max_queued:
+            self._reply(websocket, session_id, {"event": "busy"})
+            return
+        job = GenerationJob(
+            user_input,
+            story_context if isinstance(story_context, str) else None,
+            latency if latency in LATENCY_HINTS else "",
+        )
+        gens.queue.append(job)
+        if gens.task is None:
+            gens.task = asyncio.create_task(self._run(session_id, gens))
+        else:
+            self._reply(websocket, session_id, {"id": job.id, "event": "queued", "position": waiting + 1})
+
+    async def stop(self) -> None:
+        tasks = [gens.task for gens in self._sessions.values() if gens.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._sessions.clear()
+
+    async def _run(self, session_id: str, gens: SessionGenerations) -> None:
+        try:
+            while gens.queue:
+                if not self.manager.session_size(session_id):
+                    break  # everyone left; nobody would see the result
+                gens.current = gens.queue.popleft()
+                await self._generate(session_id, gens.current)
+                gens.current = None
+        finally:
+            self._sessions.pop(session_id, None)
+
+    async def _generate(self, session_id: str, job: GenerationJob) -> None:
+        # The input has not been through the graph's safety check yet, so peers are not shown it
+        await self._broadcast(session_id, {"id": job.id, "event": "start"})
+        story_context = job.story_context
+        if story_context is None:
+            story_context = self.manager.document(session_id).text()
+        pending = response = ""
+        flushed_at = time.monotonic()
+        try:
+            initial = initial_state(job.user_input, story_context, session_id, job.latency)
+            async for event in stream_story(self.graph_factory(), initial, story_memory.run_config(session_id)):
+                if event["event"] == "done":
+                    response = event["text"]
+                    continue
+                pending += event["text"]
+                if time.monotonic() - flushed_at >= TOKEN_FLUSH_INTERVAL:
+                    await self._broadcast(session_id, {"id": job.id, "event": "token", "text": pending})
+                    pending = ""
+                    flushed_at = time.monotonic()
+        except LLMOverloaded as exc:
+            await self._broadcast(session_id, {"id": job.id, "event": "busy", "retry_after": exc.retry_after})
+            return
+        except Exception:
+            await self._broadcast(session_id, {"id": job.id, "event": "error", "text": RESTING_TEXT})
+            return
+        if pending:
+            await self._broadcast(session_id, {"id": job.id, "event": "token", "text": pending})
+        await self._broadcast(session_id, {"id": job.id, "event": "done", "text": response})
+
+    async def _broadcast(self, session_id: str, event: dict) -> None:
+        await self.manager.broadcast_to_session(session_id, encode_event(event))
+
+    def _reply(self, websocket: WebSocket, session_id: str, event: dict) -> None:
+        self.manager.send(websocket, session_id, encode_event(event))
@@ -3,12 +3,105 @@ Pytest fixtures for SafeTale Sync backend tests.
 E2E tests use TestClient (in-process) so coverage is collected; no live server required.
 """
 
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import httpx
 import pytest
 from fastapi.testclient import TestClient
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+from pycrdt import Doc, Text
 
+from context_builder import StorySummaries
+from health import HealthMonitor
 from main import app
 
 
+def yjs_updates(*texts: str, root: str = "t", doc: Doc | None = None) -> list[bytes]:
+    """The Yjs updates of a client (a fresh doc unless given) appending each text in turn to its root text."""
+    doc = Doc() if doc is None else doc
+    text = doc.get(root, type=Text)
+
+    def append(chunk: str) -> bytes:
+        state = doc.get_state()
+        text.insert(len(text), chunk)
+        return doc.get_update(state)
+
+    return [append(chunk) for chunk in texts]
+
+
+def yjs_update(text: str, root: str = "t") -> bytes:
+    return yjs_updates(text, root=root)[0]
+
+
+def mock_ws() -> MagicMock:
+    """A connected WebSocket whose sends complete at once."""
+    ws = MagicMock()
+    ws.accept = AsyncMock()
+    ws.send_bytes = AsyncMock()
+    return ws
+
+
+def stalled_ws() -> MagicMock:
+    """A connected WebSocket whose send_bytes never completes."""
+    ws = mock_ws()
+    ws.close = AsyncMock()
+
+    async def never(data):
+        await asyncio.Event().wait()
+
+    ws.send_bytes = AsyncMock(side_effect=never)
+    return ws
+
+
+@pytest.fixture(autouse=True)
+def no_llm_warm_up():
+    """The app's lifespan would otherwise send a warm-up generation to a local Ollama."""
+    with patch("main.warm_up_llm", AsyncMock(return_value=False)) as warm_up:
+        yield warm_up
+
+
+@pytest.fixture(autouse=True)
+def no_generation_cache():
+    """Tests start without cached generations; test_generation_cache builds its own caches."""
+    with patch("generation_cache.cache", None):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def no_story_summaries():
+    """Long stories in tests are not summarized by a local Ollama; test_context_builder uses its own summarizers."""
+    with patch("context_builder.summaries", StorySummaries()):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def checkpointer_setup_in_a_task():
+    """
+    AsyncSqliteSaver.setup raises and catches an error on every call, which on Python 3.11
+    stops coverage's line tracing in the frames awaiting it; its own task keeps them traced.
+    """
+    setup = AsyncSqliteSaver.setup
+
+    async def in_a_task(self):
+        await asyncio.create_task(setup(self))
+
+    with patch.object(AsyncSqliteSaver, "setup", in_a_task):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def health_monitor():
+    """A fresh monitor per test whose cheap probes find nothing listening; tests swap in their own transport."""
+
+    def unreachable(request):
+        raise httpx.ConnectError("connection refused", request=request)
+
+    monitor = HealthMonitor(transport=httpx.MockTransport(unreachable))
+    with patch("health.monitor", monitor):
+        yield monitor
+
+
 @pytest.fixture
 def client():
     """HTTP client for E2E API tests (sync TestClient)."""
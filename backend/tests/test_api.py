@@ -12,7 +12,7 @@ def test_root(client):
     assert "docs" in data
 
 
-@patch("main.check_llm_responding", new_callable=AsyncMock)
+@patch("health.check_llm_responding", new_callable=AsyncMock)
 def test_health_healthy(patch_check, client):
     patch_check.return_value = (True, "OK")
     r = client.get("/api/health")
@@ -22,7 +22,7 @@ def test_health_healthy(patch_check, client):
     assert data.get("llm") == "ok"
 
 
-@patch("main.check_llm_responding", new_callable=AsyncMock)
+@patch("health.check_llm_responding", new_callable=AsyncMock)
 def test_health_unhealthy(patch_check, client):
     patch_check.return_value = (False, "Connection refused")
     r = client.get("/api/health")
@@ -44,13 +44,38 @@ def test_generate_story_empty_input(client):
 @patch("main._get_story_graph")
 def test_generate_story_success(mock_get_graph, client):
     mock_graph = MagicMock()
-    mock_graph.invoke = MagicMock(return_value={"response": "The dragon smiled and flew away."})
+    mock_graph.ainvoke = AsyncMock(return_value={"response": "The dragon smiled and flew away."})
     mock_get_graph.return_value = mock_graph
     r = client.post("/api/generate-story", json={"story_context": "In a forest.", "user_input": "What happens next?"})
     assert r.status_code == 200
     data = r.json()
     assert data["response"] == "The dragon smiled and flew away."
-    mock_graph.invoke.assert_called_once()
+    mock_graph.ainvoke.assert_called_once()
+
+
+@patch("main._get_story_graph")
+def test_generate_story_passes_latency_hint(mock_get_graph, client):
+    mock_graph = MagicMock()
+    mock_graph.ainvoke = AsyncMock(return_value={"response": "Quick."})
+    mock_get_graph.return_value = mock_graph
+    r = client.post("/api/generate-story", json={"user_input": "Go on.", "latency": "fast"})
+    assert r.json()["response"] == "Quick."
+    assert mock_graph.ainvoke.call_args.args[0]["latency"] == "fast"
+    r = client.post("/api/generate-story", json={"user_input": "Go on.", "latency": "turbo"})
+    assert r.status_code == 422
+
+
+@patch("main._get_story_graph")
+def test_generate_story_overloaded_sheds_with_retry_after(mock_get_graph, client):
+    from llm_scheduler import LLMOverloaded
+
+    mock_graph = MagicMock()
+    mock_graph.ainvoke = AsyncMock(side_effect=LLMOverloaded(503, 7))
+    mock_get_graph.return_value = mock_graph
+    r = client.post("/api/generate-story", json={"user_input": "What happens next?"})
+    assert r.status_code == 503
+    assert r.headers["retry-after"] == "7"
+    assert "busy" in r.json()["detail"]
 
 
 @patch("main._get_story_graph")
@@ -62,7 +87,7 @@ def test_generate_story_whitespace_input_returns_prompt(mock_get_graph, client):
     data = r.json()
     assert "response" in data
     assert "What would you like" in data["response"] or "happen next" in data["response"]
-    mock_graph.invoke.assert_not_called()
+    mock_graph.ainvoke.assert_not_called()
 
 
 def test_websocket_connect_and_broadcast(client):
@@ -90,7 +115,7 @@ def test_websocket_empty_session_id_closes_with_code(client):
 @patch("main._get_story_graph")
 def test_generate_story_empty_response_from_graph_returns_empty_string(mock_get_graph, client):
     mock_graph = MagicMock()
-    mock_graph.invoke = MagicMock(return_value={"response": ""})
+    mock_graph.ainvoke = AsyncMock(return_value={"response": ""})
     mock_get_graph.return_value = mock_graph
     r = client.post("/api/generate-story", json={"story_context": "", "user_input": "Next?"})
     assert r.status_code == 200
@@ -100,7 +125,7 @@ def test_generate_story_empty_response_from_graph_returns_empty_string(mock_get_
 @patch("main._get_story_graph")
 def test_generate_story_missing_response_key_returns_empty_string(mock_get_graph, client):
     mock_graph = MagicMock()
-    mock_graph.invoke = MagicMock(return_value={})
+    mock_graph.ainvoke = AsyncMock(return_value={})
     mock_get_graph.return_value = mock_graph
     r = client.post("/api/generate-story", json={"story_context": "", "user_input": "Next?"})
     assert r.status_code == 200
@@ -110,7 +135,7 @@ def test_generate_story_missing_response_key_returns_empty_string(mock_get_graph
 @patch("main.build_story_graph")
 def test_generate_story_builds_graph_once_then_reuses(mock_build_graph, client):
     mock_graph = MagicMock()
-    mock_graph.invoke = MagicMock(return_value={"response": "Once."})
+    mock_graph.ainvoke = AsyncMock(return_value={"response": "Once."})
     mock_build_graph.return_value = mock_graph
     import main
     main._story_graph = None
@@ -121,3 +146,21 @@ def test_generate_story_builds_graph_once_then_reuses(mock_build_graph, client):
         assert mock_build_graph.call_count == 1
     finally:
         main._story_graph = None
+
+
+@patch("main._get_story_graph")
+def test_metrics_endpoint_exposes_ws_and_generation_metrics(mock_get_graph, client):
+    mock_graph = MagicMock()
+    mock_graph.ainvoke = AsyncMock(return_value={"response": "Once upon a time."})
+    mock_get_graph.return_value = mock_graph
+    client.post("/api/generate-story", json={"user_input": "a dragon"})
+    with client.websocket_connect("/ws/story/metrics-session") as ws:
+        ws.send_bytes(b"\x7frelay")
+    r = client.get("/api/metrics")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain")
+    body = r.text
+    assert "# TYPE safetale_ws_connections gauge" in body
+    assert 'safetale_generate_story_seconds_count{stage="total"}' in body
+    assert "safetale_llm_waiting 0" in body
+    assert "safetale_ws_frames_received_total" in body
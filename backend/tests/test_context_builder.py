@@ -0,0 +1,198 @@
+"""
+Unit tests for context_builder: sections, budgets and rolling summaries.
+"""
+
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+import context_builder
+import metrics
+from context_builder import (
+    CONTEXT_TOKEN_BUDGET,
+    SECTION_CHARS,
+    PromptParts,
+    StorySummaries,
+    build_messages,
+    estimate_tokens,
+    split_recent,
+    split_sections,
+    summarize_with_llm,
+)
+from llm_client import MODEL_OPTIONS, SMALL_MODEL
+from llm_scheduler import LLMScheduler
+
+SYSTEM = "You are a friendly Story Guide."
+
+
+def _story(paragraphs: int, start: int = 0) -> str:
+    return "\n\n".join(
+        f"Part {i}: the fox met a kind owl near the river." * 4 for i in range(start, start + paragraphs)
+    )
+
+
+class RecordingSummarizer:
+    def __init__(self, fail: bool = False) -> None:
+        self.calls: list[tuple[str, str, str]] = []
+        self.fail = fail
+
+    async def __call__(self, session_id: str, summary: str, text: str) -> str:
+        self.calls.append((session_id, summary, text))
+        if self.fail:
+            raise RuntimeError("ollama down")
+        return f"summary #{len(self.calls)}"
+
+
+async def _settled(summaries: StorySummaries) -> None:
+    await asyncio.gather(*(s.task for s in summaries._sessions.values() if s.task is not None))
+
+
+def test_sections_split_paragraphs_and_long_text_at_words():
+    assert split_sections("One.\n\n\n\nTwo.\n\n  ") == ["One.", "Two."]
+    long = " ".join(["word"] * 400)
+    sections = split_sections(long)
+    assert all(len(s) <= SECTION_CHARS for s in sections)
+    assert " ".join(sections) == long
+    # Appending to the story leaves earlier sections as they were, so they keep their digests
+    assert split_sections(long + " more words")[:-1] == sections[:-1]
+    assert split_sections("x" * (SECTION_CHARS + 5)) == ["x" * SECTION_CHARS, "xxxxx"]
+
+
+def test_recent_window_keeps_latest_sections_and_always_the_last():
+    sections = ["a" * 400, "b" * 400, "c" * 400]
+    assert split_recent(sections, 250) == (["a" * 400], ["b" * 400, "c" * 400])
+    assert split_recent(sections, 10) == (["a" * 400, "b" * 400], ["c" * 400])
+    assert split_recent([], 10) == ([], [])
+
+
+def test_prompt_stays_within_budget_however_long_the_story():
+    sizes = []
+    for paragraphs in (50, 500):
+        messages = build_messages(PromptParts(SYSTEM, "What next?", _story(paragraphs), "lore " * 2000))
+        sizes.append(sum(estimate_tokens(str(m.content)) for m in messages))
+        assert messages[0].content == SYSTEM
+        context = messages[-2].content
+        assert f"Part {paragraphs - 1}:" in context
+        assert "Part 0:" not in context
+    assert max(sizes) <= CONTEXT_TOKEN_BUDGET
+    assert max(sizes) - min(sizes) < 20  # only the paragraph numbers grew
+    assert metrics.PROMPT_TOKENS.count() >= 2
+
+
+def test_history_keeps_most_recent_messages_that_fit():
+    history = [HumanMessage(content="old " * 600), AIMessage(content="older reply"), HumanMessage(content="latest")]
+    messages = build_messages(PromptParts(SYSTEM, "Next.", history=history))
+    assert [m.content for m in messages[1:]] == ["older reply", "latest", "Next."]
+
+
+def test_long_user_input_squeezes_the_optional_parts():
+    parts = PromptParts(SYSTEM, "x" * 8000, _story(20), "Dragons sleep.", [HumanMessage(content="hi")])
+    messages = build_messages(parts)
+    assert [m.content for m in messages[:-1]] == [SYSTEM]
+
+
+async def test_summary_folds_in_only_sections_that_aged_out():
+    summarizer = RecordingSummarizer()
+    summaries = StorySummaries(summarizer)
+    older = split_sections(_story(10))
+    assert summaries.summary_for("s1", older[:6]) == ""
+    await _settled(summaries)
+    assert summaries.summary_for("s1", older[:6]) == "summary #1"
+    assert summaries._sessions["s1"].task is None  # unchanged: nothing to do
+
+    summaries.summary_for("s1", older)
+    await _settled(summaries)
+    session_id, previous, text = summarizer.calls[-1]
+    assert (session_id, previous) == ("s1", "summary #1")
+    assert text == "\n\n".join(older[6:])
+    assert summaries.summary_for("s1", older) == "summary #2"
+    # Deleted text leaves a summary that covers more than needed, which is still used
+    assert summaries.summary_for("s1", older[:3]) == "summary #2"
+    assert len(summarizer.calls) == 2
+    assert metrics.STORY_SUMMARIES.value(("incremental",)) >= 2
+
+
+async def test_summary_rebuilt_when_summarized_text_is_edited():
+    summarizer = RecordingSummarizer()
+    summaries = StorySummaries(summarizer)
+    older = split_sections(_story(6))
+    summaries.summary_for("s1", older)
+    await _settled(summaries)
+    edited = ["The owl was a dragon all along."] + older[1:]
+    assert summaries.summary_for("s1", edited) == "summary #1"  # stale until the rebuild lands
+    await _settled(summaries)
+    assert summarizer.calls[-1][1:] == ("", "\n\n".join(edited))
+    assert summaries.summary_for("s1", edited) == "summary #2"
+    assert metrics.STORY_SUMMARIES.value(("full",)) >= 1
+
+
+async def test_long_backlog_summarized_in_batches():
+    summarizer = RecordingSummarizer()
+    summaries = StorySummaries(summarizer)
+    older = split_sections(_story(200))
+    summaries.summary_for("s1", older)
+    await _settled(summaries)
+    assert len(summarizer.calls) > 1
+    assert all(estimate_tokens(text) <= context_builder.SUMMARY_INPUT_TOKENS for _s, _p, text in summarizer.calls)
+    previous = [summary for _s, summary, _t in summarizer.calls[1:]]
+    assert previous == [f"summary #{i}" for i in range(1, len(summarizer.calls))]
+
+
+async def test_failed_summary_counted_and_retried():
+    summarizer = RecordingSummarizer(fail=True)
+    summaries = StorySummaries(summarizer)
+    older = split_sections(_story(4))
+    failed = metrics.STORY_SUMMARIES.value(("failed",))
+    summaries.summary_for("s1", older)
+    await _settled(summaries)
+    assert summaries.summary_for("s1", older) == ""
+    await _settled(summaries)
+    assert len(summarizer.calls) == 2
+    assert metrics.STORY_SUMMARIES.value(("failed",)) == failed + 2
+
+
+async def test_sessions_bounded_and_closed():
+    gate = asyncio.Event()
+
+    async def slow(_session_id, _summary, _text):
+        await gate.wait()
+        return "never"  # pragma: no cover
+
+    summaries = StorySummaries(slow, max_sessions=2)
+    older = split_sections(_story(4))
+    for key in ("a", "b", "c"):
+        summaries.summary_for(key, older)
+    assert list(summaries._sessions) == ["b", "c"]
+    await summaries.close()
+    assert len(summaries) == 0
+    assert StorySummaries().summary_for("a", older) == ""
+
+
+async def test_prompt_uses_session_summary_or_story_opening():
+    summarizer = RecordingSummarizer()
+    story = _story(60)
+    with patch("context_builder.summaries", StorySummaries(summarizer)):
+        build_messages(PromptParts(SYSTEM, "Next.", story, session_id="s1"))
+        build_messages(PromptParts(SYSTEM, "Next.", story))
+        await _settled(context_builder.summaries)
+        assert len(context_builder.summaries) == 2
+        context = build_messages(PromptParts(SYSTEM, "Next.", story, session_id="s1"))[-2].content
+    assert context.startswith("Story so far (summary):\nsummary #")
+
+
+async def test_summarize_with_llm_shares_the_scheduler():
+    llm = MagicMock()
+    llm.ainvoke = AsyncMock(return_value=AIMessage(content=" The fox and the owl became friends. "))
+    scheduler = LLMScheduler(concurrency=1)
+    with patch("context_builder.get_llm", return_value=llm) as get_llm, patch("llm_scheduler.scheduler", scheduler):
+        summary = await summarize_with_llm("s1", "", "The fox met an owl.")
+    get_llm.assert_called_once_with(SMALL_MODEL)
+    assert summary == "The fox and the owl became friends."
+    prompt = llm.ainvoke.call_args.args[0]
+    assert "(none yet)" in prompt and "The fox met an owl." in prompt
+    # Same num_ctx as the small tier's generations, so Ollama does not reload the model
+    options = llm.ainvoke.call_args.kwargs["options"]
+    assert options["num_predict"] == context_builder.SUMMARY_TOKENS
+    assert options["num_ctx"] == MODEL_OPTIONS[SMALL_MODEL]["num_ctx"]
+    assert scheduler.running == 0
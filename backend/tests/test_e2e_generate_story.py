@@ -2,12 +2,12 @@
 E2E tests for POST /api/generate-story.
 """
 
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
 
 def test_generate_story_success(client):
     mock_graph = MagicMock()
-    mock_graph.invoke.return_value = {"response": "The dragon smiled and flew away."}
+    mock_graph.ainvoke = AsyncMock(return_value={"response": "The dragon smiled and flew away."})
     with patch("main._get_story_graph", return_value=mock_graph):
         r = client.post(
             "/api/generate-story",
@@ -16,8 +16,8 @@ def test_generate_story_success(client):
     assert r.status_code == 200
     data = r.json()
     assert data["response"] == "The dragon smiled and flew away."
-    mock_graph.invoke.assert_called_once()
-    call_arg = mock_graph.invoke.call_args[0][0]
+    mock_graph.ainvoke.assert_called_once()
+    call_arg = mock_graph.ainvoke.call_args[0][0]
     assert call_arg["story_context"] == "Once upon a time."
     assert call_arg["user_input"] == "What does the dragon do?"
     assert call_arg["conversation_history"] == []
@@ -43,7 +43,7 @@ def test_generate_story_whitespace_only_user_input(client):
 
 def test_generate_story_empty_response_from_graph(client):
     mock_graph = MagicMock()
-    mock_graph.invoke.return_value = {"response": ""}
+    mock_graph.ainvoke = AsyncMock(return_value={"response": ""})
     with patch("main._get_story_graph", return_value=mock_graph):
         r = client.post(
             "/api/generate-story",
@@ -51,3 +51,88 @@ def test_generate_story_empty_response_from_graph(client):
         )
     assert r.status_code == 200
     assert r.json()["response"] == ""
+
+
+def _streaming_graph(*tokens):
+    from langchain_core.messages import AIMessageChunk
+
+    async def astream(initial, config, stream_mode):
+        yield "values", {**initial}
+        for token in tokens:
+            yield "messages", (AIMessageChunk(content=token), {"langgraph_node": "llm_node"})
+        yield "values", {**initial, "response": "".join(tokens)}
+
+    graph = MagicMock()
+    graph.astream = astream
+    return graph
+
+
+def test_generate_story_stream_sends_tokens_then_done(client):
+    import json
+
+    with patch("main._get_story_graph", return_value=_streaming_graph("Once ", "upon ", "a time.")):
+        with client.stream("POST", "/api/generate-story/stream", json={"user_input": "Begin."}) as r:
+            assert r.status_code == 200
+            assert r.headers["content-type"].startswith("application/x-ndjson")
+            events = [json.loads(line) for line in r.iter_lines() if line]
+    assert [e["text"] for e in events if e["event"] == "token"] == ["Once ", "upon ", "a time."]
+    assert events[-1] == {"event": "done", "text": "Once upon a time."}
+
+
+def test_generate_story_stream_empty_user_input(client):
+    r = client.post("/api/generate-story/stream", json={"user_input": "  "})
+    assert r.status_code == 200
+    assert r.json() == {"event": "done", "text": "What would you like to happen next in the story?"}
+
+
+async def test_generate_story_concurrent_duplicates_share_one_run():
+    import asyncio
+
+    import httpx
+
+    import metrics
+    from main import app
+
+    shared = metrics.SINGLE_FLIGHT_SHARED.value(("generate_story",))
+    release = asyncio.Event()
+
+    async def ainvoke(initial, config=None):
+        await release.wait()
+        return {"response": "The dragon sneezed."}
+
+    mock_graph = MagicMock()
+    mock_graph.ainvoke = AsyncMock(side_effect=ainvoke)
+    body = {"session_id": "class-1", "story_context": "A cave.", "user_input": "What happens next?"}
+    with patch("main._get_story_graph", return_value=mock_graph):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            requests = [
+                client.post("/api/generate-story", json=body),
+                client.post("/api/generate-story", json={**body, "user_input": "what happens  NEXT?"}),
+                client.post("/api/generate-story", json={**body, "session_id": "class-2"}),
+            ]
+            pending = asyncio.gather(*requests)
+            while (
+                metrics.SINGLE_FLIGHT_SHARED.value(("generate_story",)) == shared
+                or mock_graph.ainvoke.await_count < 2
+            ):
+                await asyncio.sleep(0.001)
+            release.set()
+            responses = await pending
+    assert [r.json()["response"] for r in responses] == ["The dragon sneezed."] * 3
+    # The two class-1 requests shared a run; class-2 got its own
+    assert mock_graph.ainvoke.await_count == 2
+
+
+def test_generate_story_remembers_the_session_conversation(client):
+    import main
+
+    llm = MagicMock()
+    llm.ainvoke = AsyncMock(side_effect=[MagicMock(content="The fox woke up."), MagicMock(content="The owl sang.")])
+    with patch("story_agent.get_llm", return_value=llm), patch("story_agent.search_lore") as search:
+        search.ainvoke = AsyncMock(return_value="")
+        client.post("/api/generate-story", json={"session_id": "class-1", "user_input": "Start the story."})
+        r = client.post("/api/generate-story", json={"session_id": "class-1", "user_input": "What next?"})
+    assert r.json()["response"] == "The owl sang."
+    prompt = [m.content for m in llm.ainvoke.call_args_list[1].args[0]]
+    assert prompt[1:] == ["Start the story.", "The fox woke up.", "What next?"]
+    assert main._get_story_graph(memory=True) is main._memory_graph[1]
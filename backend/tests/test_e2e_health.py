@@ -1,12 +1,16 @@
 """
-E2E tests for GET /api/health.
+E2E tests for the /api/health endpoints.
 """
 
 from unittest.mock import AsyncMock, patch
 
+import httpx
+
+from health import ProbeResult
+
 
 def test_health_healthy(client):
-    with patch("main.check_llm_responding", new_callable=AsyncMock, return_value=(True, "OK")):
+    with patch("health.check_llm_responding", new_callable=AsyncMock, return_value=(True, "OK")):
         r = client.get("/api/health")
     assert r.status_code == 200
     data = r.json()
@@ -16,10 +20,56 @@ def test_health_healthy(client):
 
 
 def test_health_unhealthy(client):
-    with patch("main.check_llm_responding", new_callable=AsyncMock, return_value=(False, "Connection refused")):
+    with patch("health.check_llm_responding", new_callable=AsyncMock, return_value=(False, "Connection refused")):
         r = client.get("/api/health")
     assert r.status_code == 200
     data = r.json()
     assert data["status"] == "unhealthy"
     assert data["llm"] == "error"
     assert data["detail"] == "Connection refused"
+
+
+def test_health_served_from_cache_until_stale(client, health_monitor):
+    with patch("health.check_llm_responding", new_callable=AsyncMock, return_value=(True, "OK")) as check:
+        assert client.get("/api/health").json()["status"] == "healthy"
+        assert client.get("/api/health").json()["status"] == "healthy"
+        assert check.await_count == 1
+        r = client.get("/api/health/deep")
+        assert check.await_count == 2
+    assert r.json()["llm"] == "ok"
+    assert r.json()["age_s"] == 0
+
+
+def _ollama_only(request):
+    if request.url.path == "/api/tags":
+        return httpx.Response(200, json={"models": [{"name": "llama3.1:8b"}]})
+    return httpx.Response(503)
+
+
+def test_liveness_unavailable_without_ollama(client):
+    with patch("health.check_llm_responding", new_callable=AsyncMock) as check:
+        r = client.get("/api/health/live")
+    assert r.status_code == 503
+    assert r.json()["status"] == "unavailable"
+    assert r.json()["ollama"]["detail"].startswith("unreachable")
+    check.assert_not_called()
+
+
+def test_liveness_degraded_without_qdrant(health_monitor, client):
+    health_monitor.transport = httpx.MockTransport(_ollama_only)
+    r = client.get("/api/health/live")
+    assert r.status_code == 200
+    assert r.json()["status"] == "degraded"
+    assert r.json()["qdrant"]["ok"] is False
+
+
+def test_readiness_needs_ollama_and_no_failed_generation(health_monitor, client):
+    health_monitor.transport = httpx.MockTransport(_ollama_only)
+    r = client.get("/api/health/ready")
+    assert r.status_code == 200
+    assert r.json() == {"status": "ready", "ollama": r.json()["ollama"], "generation": "pending"}
+
+    health_monitor.deep_result = ProbeResult(False, "model failed to load")
+    r = client.get("/api/health/ready")
+    assert r.status_code == 503
+    assert r.json()["generation"] == "error"
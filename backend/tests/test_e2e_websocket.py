@@ -2,9 +2,13 @@
 E2E tests for WebSocket /ws/story/{session_id}.
 """
 
+from unittest.mock import MagicMock, patch
+
 import pytest
 from fastapi import WebSocketDisconnect
 
+from tests.conftest import yjs_update
+
 
 def test_websocket_connect_and_broadcast(sync_client):
     """Two clients in same session; one sends bytes, the other receives."""
@@ -49,3 +53,69 @@ def test_websocket_disconnect_cleans_up(sync_client):
         ws3.send_bytes(b"after")
         # Only ws3 is in session now (ws2 was in different connection lifecycle)
         # No other client to receive; just ensure no crash.
+
+
+def test_websocket_evicted_client_frames_are_dropped(sync_client):
+    """After an ingress close, frames the evicted client still sends reach nobody and the endpoint exits cleanly."""
+    with patch("ws_manager.manager.ingress_policy", "close"), patch("ws_manager.manager.max_frame_bytes", 16):
+        with sync_client.websocket_connect("/ws/story/e2e-evicted") as peer:
+            with sync_client.websocket_connect("/ws/story/e2e-evicted") as evicted:
+                evicted.send_bytes(b"\x7f" + b"x" * 32)
+                assert evicted.receive()["code"] == 1009
+                evicted.send_bytes(b"\x7fafter-evict")
+            with sync_client.websocket_connect("/ws/story/e2e-evicted") as joiner:
+                joiner.send_bytes(b"\x7fstill-here")
+                # Had the evicted client's last frame been relayed, it would have reached the peer first
+                assert peer.receive_bytes() == b"\x7fstill-here"
+
+
+def test_websocket_sync_request_answered_by_server(sync_client):
+    """A joining client's 0x00 is answered with the full document, even if it is alone."""
+    from pycrdt import Doc, Text
+
+    with sync_client.websocket_connect("/ws/story/e2e-session-4") as ws1:
+        ws1.send_bytes(b"\x00")
+        assert ws1.receive_bytes() == b"\x00"  # cold replica: seed it
+        ws1.send_bytes(b"\x01" + yjs_update("Once upon a time", root="story"))
+    with sync_client.websocket_connect("/ws/story/e2e-session-4") as ws2:
+        ws2.send_bytes(b"\x00")
+        reply = ws2.receive_bytes()
+    assert reply[0] == 0x01
+    doc = Doc()
+    doc.apply_update(reply[1:])
+    assert str(doc.get("story", type=Text)) == "Once upon a time"
+
+
+def test_websocket_compression_negotiated_by_query(sync_client):
+    """Clients connecting with ?compress=deflate get large frames as 0x02; others get them raw."""
+    from ws_protocol import decompress_frame
+
+    big = b"\x7f" + b"a long story " * 200
+    with sync_client.websocket_connect("/ws/story/e2e-session-5") as sender:
+        with sync_client.websocket_connect("/ws/story/e2e-session-5?compress=deflate") as zipped:
+            with sync_client.websocket_connect("/ws/story/e2e-session-5") as plain:
+                sender.send_bytes(big)
+                packed = zipped.receive_bytes()
+                assert packed[0] == 0x02
+                assert decompress_frame(packed) == big
+                assert plain.receive_bytes() == big
+
+
+def test_websocket_generation_streams_to_session(sync_client):
+    """A 0x06 request runs the story graph once and both collaborators see its 0x07 events."""
+    import json
+
+    async def astream(initial, config, stream_mode):
+        yield "values", {"response": "The dragon sneezed."}
+
+    graph = MagicMock()
+    graph.astream = astream
+    with patch("main._get_story_graph", return_value=graph):
+        with sync_client.websocket_connect("/ws/story/e2e-session-6") as ws1:
+            with sync_client.websocket_connect("/ws/story/e2e-session-6") as ws2:
+                ws1.send_bytes(b"\x06" + json.dumps({"user_input": "a dragon"}).encode())
+                for ws in (ws1, ws2):
+                    start = json.loads(ws.receive_bytes()[1:])
+                    done = json.loads(ws.receive_bytes()[1:])
+                    assert start["event"] == "start"
+                    assert done == {"id": start["id"], "event": "done", "text": "The dragon sneezed."}
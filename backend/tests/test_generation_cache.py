@@ -0,0 +1,173 @@
+"""
+Unit tests for generation_cache.
+"""
+
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+import generation_cache
+import metrics
+from generation_cache import GenerationCache, close_cache, normalize, open_cache
+
+
+async def _fill(cache, user_input, *responses, context="ctx", model="m"):
+    for response in responses:
+        lookup = await cache.lookup(model, context, user_input)
+        assert lookup.response is None
+        cache.store(lookup, response)
+
+
+def _hits(result):
+    return metrics.GENERATION_CACHE_REQUESTS.value((result,))
+
+
+def test_normalize():
+    assert normalize("  What  happens\nNEXT? ") == "what happens next?"
+
+
+async def test_candidates_collected_then_rotated():
+    cache = GenerationCache(candidates=2)
+    exact = _hits("exact")
+    await _fill(cache, "What happens next?", "A dragon.", "A fox.")
+    served = [(await cache.lookup("m", "ctx", "what happens  NEXT?")).response for _ in range(3)]
+    assert served == ["A dragon.", "A fox.", "A dragon."]
+    assert _hits("exact") == exact + 3
+    # Another context or model is another prompt
+    assert (await cache.lookup("m", "other", "What happens next?")).response is None
+    assert (await cache.lookup("m2", "ctx", "What happens next?")).response is None
+
+
+async def test_store_ignores_extra_candidates():
+    cache = GenerationCache(candidates=1)
+    lookup = await cache.lookup("m", "ctx", "go")
+    cache.store(lookup, "one")
+    cache.store(lookup, "two")
+    assert (await cache.lookup("m", "ctx", "go")).response == "one"
+
+
+async def test_entries_expire_after_ttl():
+    cache = GenerationCache(ttl=10, candidates=1)
+    with patch("generation_cache.time.time", return_value=1000.0):
+        await _fill(cache, "go", "one")
+    with patch("generation_cache.time.time", return_value=1011.0):
+        assert (await cache.lookup("m", "ctx", "go")).response is None
+    assert len(cache) == 0 and cache.bytes == 0
+
+
+async def test_lru_eviction_by_entries_and_bytes():
+    cache = GenerationCache(max_entries=2, candidates=1)
+    await _fill(cache, "a", "A")
+    await _fill(cache, "b", "B")
+    await cache.lookup("m", "ctx", "a")  # a is now most recently used
+    await _fill(cache, "c", "C")
+    assert (await cache.lookup("m", "ctx", "b")).response is None
+    assert (await cache.lookup("m", "ctx", "a")).response == "A"
+
+    small = GenerationCache(max_bytes=600, candidates=1)
+    await _fill(small, "a", "x" * 200)
+    await _fill(small, "b", "y" * 200)
+    assert len(small) == 1 and small.bytes <= 600
+    assert (await small.lookup("m", "ctx", "b")).response == "y" * 200
+
+
+async def test_semantic_tier_matches_similar_inputs():
+    vectors = {"what happens next?": [1.0, 0.0], "what happens now?": [0.99, 0.05], "sing a song": [0.0, 1.0]}
+    embedder = AsyncMock(side_effect=lambda text: vectors[text])
+    cache = GenerationCache(candidates=1, embedder=embedder, similarity=0.95)
+    await _fill(cache, "What happens next?", "A dragon.")
+    semantic = _hits("semantic")
+    assert (await cache.lookup("m", "ctx", "What happens now?")).response == "A dragon."
+    assert _hits("semantic") == semantic + 1
+    assert (await cache.lookup("m", "ctx", "Sing a song")).response is None
+    assert (await cache.lookup("m", "other", "What happens now?")).response is None
+    # Exact hits do not need an embedding
+    calls = embedder.await_count
+    assert (await cache.lookup("m", "ctx", "what happens next?")).response == "A dragon."
+    assert embedder.await_count == calls
+
+
+async def test_semantic_tier_skips_partial_and_expired_entries_and_embed_failures():
+    vectors = {"a": [1.0, 0.0], "b": [1.0, 0.01], "z": [1.0, 0.0], "zero": [0.0, 1.0]}
+    embedder = AsyncMock(side_effect=lambda text: vectors[text])
+    cache = GenerationCache(candidates=2, ttl=10, embedder=embedder)
+    with patch("generation_cache.time.time", return_value=1000.0):
+        await _fill(cache, "a", "A")
+        # One of two candidates: still collecting, so "b" is not served from it
+        assert (await cache.lookup("m", "ctx", "b")).response is None
+        lookup = await cache.lookup("m", "ctx", "a")
+        assert lookup.response is None and lookup.embedding == [1.0, 0.0]
+        cache.store(lookup, "A2")
+        await _fill(cache, "z", "Z", "Z2", context="elsewhere")
+        await _fill(cache, "zero", "0", "0")
+        cache._entries[next(reversed(cache._entries))].embedding = [0.0, 0.0]
+        assert (await cache.lookup("m", "ctx", "b")).response == "A"
+    with patch("generation_cache.time.time", return_value=1011.0):
+        assert (await cache.lookup("m", "ctx", "b")).response is None
+    embedder.side_effect = RuntimeError("ollama down")
+    lookup = await cache.lookup("m", "ctx", "c")
+    assert lookup.response is None and lookup.embedding is None
+
+
+async def test_disk_cache_survives_restart(tmp_path):
+    path = tmp_path / "cache.db"
+    vectors = {"go": [0.5, 0.5], "stay": [1.0, 0.0]}
+    cache = GenerationCache(path, candidates=2, embedder=AsyncMock(side_effect=lambda text: vectors[text]))
+    await _fill(cache, "go", "one", "two")
+    await _fill(cache, "stay", "x")
+    cache.close()
+    cache.close()
+
+    restarted = GenerationCache(path, candidates=2)
+    assert len(restarted) == 2
+    assert restarted._entries[next(iter(restarted._entries))].embedding == [0.5, 0.5]
+    assert [(await restarted.lookup("m", "ctx", "go")).response for _ in range(2)] == ["one", "two"]
+    restarted.clear()
+    restarted.close()
+    assert len(GenerationCache(path)) == 0
+
+
+async def test_disk_cache_drops_expired_and_evicted_rows(tmp_path):
+    path = tmp_path / "cache.db"
+    cache = GenerationCache(path, candidates=1, ttl=10)
+    with patch("generation_cache.time.time", return_value=1000.0):
+        await _fill(cache, "old", "O")
+    await _fill(cache, "a", "A")
+    await _fill(cache, "b", "B")
+    cache.close()
+    restarted = GenerationCache(path, candidates=1, ttl=10, max_entries=1)
+    assert len(restarted) == 1
+    assert (await restarted.lookup("m", "ctx", "b")).response == "B"
+    restarted.close()
+
+
+def test_open_cache(tmp_path):
+    assert open_cache("off") is None
+    memory = open_cache("", "")
+    assert memory.embedder is None and memory._db is None
+    disk = open_cache(str(tmp_path / "c.db"), "")
+    assert disk._db is not None
+    disk.close()
+    with patch("langchain_ollama.OllamaEmbeddings") as embeddings:
+        semantic = open_cache("", "0.9")
+    assert semantic.similarity == 0.9
+    assert semantic.embedder is embeddings.return_value.aembed_query
+
+
+def test_cache_gauges():
+    cache = GenerationCache()
+    with patch("generation_cache.cache", cache):
+        assert metrics.GENERATION_CACHE_ENTRIES.value() == 0
+        assert metrics.GENERATION_CACHE_BYTES.value() == 0
+    assert metrics.GENERATION_CACHE_ENTRIES.value() == 0
+    assert metrics.GENERATION_CACHE_BYTES.value() == 0
+
+
+async def test_close_cache_finishes_pending_writes(tmp_path):
+    path = tmp_path / "cache.db"
+    cache = GenerationCache(path, candidates=1)
+    await _fill(cache, "a", "A")
+    with patch("generation_cache.cache", cache):
+        await close_cache()
+    assert cache._db is None
+    assert len(GenerationCache(path)) == 1
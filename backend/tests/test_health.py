@@ -0,0 +1,78 @@
+"""
+Unit tests for health: cheap probe caching, deep probe caching and the background loop.
+"""
+
+import asyncio
+from unittest.mock import AsyncMock, patch
+
+import httpx
+
+import metrics
+from health import HealthMonitor, ProbeResult
+
+
+def _transport(tags: dict | None = None, qdrant: int = 200, calls: list | None = None) -> httpx.MockTransport:
+    def handle(request: httpx.Request) -> httpx.Response:
+        if calls is not None:
+            calls.append(request.url.path)
+        if request.url.path == "/api/tags":
+            return httpx.Response(200, json=tags) if tags is not None else httpx.Response(500)
+        return httpx.Response(qdrant)
+
+    return httpx.MockTransport(handle)
+
+
+LLAMA = {"models": [{"name": "llama3.1:8b"}, {"name": "nomic-embed-text"}]}
+
+
+async def test_liveness_probes_are_cheap_and_cached():
+    calls = []
+    monitor = HealthMonitor(transport=_transport(LLAMA, calls=calls))
+    first, second = await asyncio.gather(monitor.liveness(), monitor.liveness())
+    assert first is second
+    assert await monitor.liveness() is first
+    assert sorted(calls) == ["/api/tags", "/readyz"]
+    assert first["ollama"].as_dict()["ok"] and first["qdrant"].ok
+    await monitor.stop()
+    assert metrics.HEALTH_PROBES.value(("ollama", "ok")) >= 1
+
+
+async def test_liveness_reports_missing_model_and_unreachable_services():
+    monitor = HealthMonitor(cheap_ttl=0, transport=_transport({"models": [{"name": "other"}]}, qdrant=503))
+    probes = await monitor.liveness()
+    assert not probes["ollama"].ok and "not pulled" in probes["ollama"].detail
+    assert not probes["qdrant"].ok
+    monitor.transport = _transport(None)
+    await monitor.stop()  # the next probe opens a client with the new transport
+    probes = await monitor.liveness()
+    assert probes["ollama"].detail.startswith("unreachable")
+    await monitor.stop()
+
+
+async def test_deep_probe_cached_and_refreshed_on_demand():
+    monitor = HealthMonitor(deep_ttl=60)
+    assert monitor.deep_status() == "pending"
+    with patch("health.check_llm_responding", AsyncMock(return_value=(False, "Connection refused"))) as check:
+        result = await monitor.deep(max_age=60)
+        assert await monitor.deep(max_age=60) is result
+        assert monitor.deep_status() == "error"
+        await monitor.deep()
+    assert check.await_count == 2
+    monitor.generation_succeeded()
+    assert monitor.deep_status() == "ok"
+    monitor.deep_result = ProbeResult(True, "old", checked_at=monitor.deep_result.checked_at - 61)
+    assert monitor.deep_status() == "pending"
+
+
+async def test_background_loop_runs_deep_probe():
+    monitor = HealthMonitor(deep_interval=0.01)
+    with patch("health.check_llm_responding", AsyncMock(return_value=(True, "OK"))) as check:
+        monitor.start()
+        for _ in range(100):
+            if check.await_count:
+                break
+            await asyncio.sleep(0.01)
+        await monitor.stop()
+    assert check.await_count >= 1
+    assert monitor.deep_result.detail == "OK"
+    await monitor.stop()  # idempotent
@@ -6,7 +6,8 @@ from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 
-from llm_client import check_llm_responding, get_llm
+import llm_client
+from llm_client import check_llm_responding, close_llm, get_llm, warm_up_llm
 
 
 def test_get_llm_default():
@@ -17,6 +18,71 @@ def test_get_llm_default():
     assert kwargs["base_url"] == "http://localhost:11434"
     assert kwargs["model"] == "llama3.1:8b"
     assert kwargs["temperature"] == 0.7
+    assert (kwargs["num_ctx"], kwargs["num_predict"]) == (4096, 384)
+
+
+@pytest.fixture(autouse=True)
+def fresh_llm():
+    with patch.dict("llm_client._llms", clear=True):
+        yield
+
+
+def test_get_llm_shared_per_model_until_config_changes():
+    first = get_llm()
+    assert get_llm() is first
+    assert first.keep_alive == "30m"
+    small = get_llm(model="llama3.2:3b")
+    assert small is not first and small.model == "llama3.2:3b"
+    assert (small.num_ctx, small.num_predict) == (2048, 192)
+    assert get_llm(model="llama3.2:3b") is small
+    assert get_llm() is first
+    assert get_llm(base_url="http://ollama:11434").base_url == "http://ollama:11434"
+    assert get_llm(keep_alive="-1").keep_alive == -1
+    assert get_llm(model="unknown:1b").num_ctx is None
+
+
+def test_model_options_keep_num_ctx():
+    options = llm_client.model_options("llama3.1:8b", num_predict=1)
+    assert options == {"temperature": 0.7, "num_ctx": 4096, "num_predict": 1}
+    assert llm_client.model_options("unknown:1b") == {"temperature": 0.7}
+
+
+def test_get_llm_pools_connections():
+    llm = get_llm()
+    limits = llm.client_kwargs["limits"]
+    assert limits.max_keepalive_connections == llm_client.LLM_MAX_KEEPALIVE_CONNECTIONS
+    assert limits.keepalive_expiry == llm_client.LLM_KEEPALIVE_EXPIRY
+
+
+async def test_close_llm_closes_clients_and_forgets_them():
+    await close_llm()  # nothing to close yet
+    llm = get_llm()
+    with patch.object(llm._async_client, "close", AsyncMock()) as aclose, patch.object(
+        llm._client, "close"
+    ) as close:
+        await close_llm()
+    aclose.assert_awaited_once()
+    close.assert_called_once()
+    assert get_llm() is not llm
+
+
+async def test_close_llm_without_clients():
+    llm_client._llms["x"] = ((), MagicMock(spec=[]))
+    await close_llm()
+    assert not llm_client._llms
+
+
+async def test_warm_up_llm_generates_one_token_per_model():
+    mock_llm = MagicMock()
+    mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content="Hi"))
+    with patch("llm_client.get_llm", return_value=mock_llm) as mock_get_llm:
+        assert await warm_up_llm() is True
+    assert [c.args for c in mock_get_llm.call_args_list] == [("llama3.1:8b",), ("llama3.2:3b",)]
+    assert mock_llm.ainvoke.call_args.kwargs == {"options": {"temperature": 0.7, "num_ctx": 2048, "num_predict": 1}}
+    # The large model still loads when the small one is missing
+    mock_llm.ainvoke.side_effect = [MagicMock(content="Hi"), ConnectionError("model not found")]
+    with patch("llm_client.get_llm", return_value=mock_llm):
+        assert await warm_up_llm() is False
 
 
 @pytest.mark.asyncio
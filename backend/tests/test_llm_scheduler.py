@@ -0,0 +1,135 @@
+"""
+Unit tests for llm_scheduler.
+"""
+
+import asyncio
+from collections import deque
+
+import pytest
+
+import metrics
+from llm_scheduler import LLMOverloaded, LLMScheduler
+
+
+async def _hold(scheduler, session_id, order, release):
+    async with scheduler.slot(session_id):
+        order.append(session_id)
+        await release.wait()
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def test_concurrency_limit_and_round_robin_across_sessions():
+    scheduler = LLMScheduler(concurrency=1)
+    order: list[str] = []
+    release = asyncio.Event()
+    first = asyncio.create_task(_hold(scheduler, "busy", order, release))
+    await _settle()
+    sessions = ("busy", "busy", "busy", "quiet", "other")
+    tasks = [asyncio.create_task(_hold(scheduler, s, order, release)) for s in sessions]
+    await _settle()
+    assert scheduler.running == 1 and scheduler.queued == 5
+    assert metrics.LLM_WAITING.value() >= 0
+    release.set()
+    await asyncio.gather(first, *tasks)
+    # The busy session does not get to run its whole backlog before the others
+    assert order == ["busy", "busy", "quiet", "other", "busy", "busy"]
+    assert scheduler.running == 0 and scheduler.queued == 0
+
+
+async def test_sheds_load_with_retry_after():
+    scheduler = LLMScheduler(concurrency=1, max_queue=2, max_queue_per_session=1)
+    release = asyncio.Event()
+    order: list[str] = []
+    running = asyncio.create_task(_hold(scheduler, "a", order, release))
+    waiting = [asyncio.create_task(_hold(scheduler, s, order, release)) for s in ("a", "b")]
+    await _settle()
+    rejected = metrics.LLM_REJECTED.value(("session",))
+    with pytest.raises(LLMOverloaded) as session_full:
+        await scheduler._acquire("a")
+    assert session_full.value.status == 429
+    assert metrics.LLM_REJECTED.value(("session",)) == rejected + 1
+    with pytest.raises(LLMOverloaded) as queue_full:
+        await scheduler._acquire("c")
+    assert queue_full.value.status == 503
+    # Expected 5 s per generation, 2 queued ahead + this one, 1 slot
+    assert queue_full.value.retry_after == 15
+    release.set()
+    await asyncio.gather(running, *waiting)
+
+
+async def test_waiter_timeout_and_cancellation_leave_queue_consistent():
+    scheduler = LLMScheduler(concurrency=1, queue_timeout=0.01)
+    release = asyncio.Event()
+    order: list[str] = []
+    running = asyncio.create_task(_hold(scheduler, "a", order, release))
+    await _settle()
+    with pytest.raises(LLMOverloaded) as timed_out:
+        await scheduler._acquire("b")
+    assert timed_out.value.status == 503
+    scheduler.queue_timeout = 10
+    cancelled = asyncio.create_task(scheduler._acquire("b"))
+    kept = asyncio.create_task(_hold(scheduler, "c", order, release))
+    await _settle()
+    cancelled.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
+    assert scheduler.queued == 1
+    release.set()
+    await asyncio.gather(running, kept)
+    assert order == ["a", "c"]
+    assert scheduler.running == 0
+
+
+async def test_slot_passed_on_when_admitted_waiter_is_cancelled():
+    scheduler = LLMScheduler(concurrency=1)
+    release = asyncio.Event()
+    order: list[str] = []
+    await scheduler._acquire("a")
+    admitted_then_cancelled = asyncio.create_task(scheduler._acquire("b"))
+    later = asyncio.create_task(_hold(scheduler, "c", order, release))
+    await _settle()
+    scheduler._release()  # "a" finishes and hands the slot to "b"...
+    admitted_then_cancelled.cancel()  # ...which goes away before it runs
+    with pytest.raises(asyncio.CancelledError):
+        await admitted_then_cancelled
+    release.set()
+    await later
+    assert order == ["c"]
+    assert scheduler.running == 0 and scheduler.queued == 0
+
+
+async def test_release_skips_waiters_that_already_gave_up():
+    scheduler = LLMScheduler(concurrency=1)
+    await scheduler._acquire("a")
+    loop = asyncio.get_running_loop()
+    stale = loop.create_future()
+    stale.cancel()
+    scheduler._waiting["b"] = deque([stale])
+    scheduler._queued = 1
+    scheduler._release()
+    assert scheduler.running == 0 and scheduler.queued == 0
+    scheduler._forget("b", stale)  # already gone
+
+
+async def test_expire_ignores_a_waiter_already_admitted():
+    scheduler = LLMScheduler(concurrency=1)
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(None)
+    scheduler._expire("a", future)
+    assert future.result() is None
+
+
+async def test_callers_without_a_session_do_not_share_a_lane():
+    scheduler = LLMScheduler(concurrency=1, max_queue_per_session=1)
+    release = asyncio.Event()
+    order: list[str] = []
+    tasks = [asyncio.create_task(_hold(scheduler, "", order, release)) for _ in range(3)]
+    await _settle()
+    assert scheduler.running == 1 and scheduler.queued == 2
+    release.set()
+    await asyncio.gather(*tasks)
+    assert order == ["", "", ""]
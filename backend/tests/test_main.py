@@ -55,3 +55,21 @@ async def test_websocket_story_disconnect_after_receive():
     with patch("main.ws_manager", ws_manager):
         await websocket_story(ws, "unit-session")
     ws_manager.disconnect.assert_called_once_with(ws, "unit-session")
+
+
+@pytest.mark.asyncio
+async def test_websocket_story_refused_connection_skips_receive_loop():
+    """When the manager refuses a connection (limits reached) the handler returns at once."""
+    ws = MagicMock()
+    ws.receive_bytes = AsyncMock()
+    ws_manager = MagicMock()
+    ws_manager.connect = AsyncMock(return_value=False)
+    ws_manager.disconnect = MagicMock()
+    with patch("main.ws_manager", ws_manager):
+        await websocket_story(ws, "full-session")
+    ws.receive_bytes.assert_not_called()
+    ws_manager.disconnect.assert_not_called()
+
+
+def test_lifespan_starts_llm_warm_up(client, no_llm_warm_up):
+    no_llm_warm_up.assert_awaited_once()
@@ -0,0 +1,76 @@
+"""Tests for the in-process metrics registry."""
+
+import pytest
+
+from metrics import Counter, Gauge, Histogram, Metric, Registry
+
+
+def test_counter_renders_labelled_samples():
+    c = Counter("frames_total", "Frames", labelnames=("kind",))
+    c.inc(labels=("update",))
+    c.inc(2, labels=("update",))
+    c.inc(labels=('a"b\\c\nd',))
+    assert c.value(("update",)) == 3
+    assert c.value(("missing",)) == 0
+    lines = c.render()
+    assert lines[0] == "# HELP frames_total Frames"
+    assert lines[1] == "# TYPE frames_total counter"
+    assert 'frames_total{kind="update"} 3' in lines
+    assert 'frames_total{kind="a\\"b\\\\c\\nd"} 1' in lines
+
+
+def test_gauge_set_inc_dec():
+    g = Gauge("depth", "Depth")
+    g.set(5)
+    g.inc()
+    g.dec(2.5)
+    assert g.value() == 3.5
+    assert g.render()[-1] == "depth 3.5"
+
+
+def test_gauge_function_is_read_at_scrape_time():
+    g = Gauge("open", "Open")
+    items = [1, 2]
+    g.set_function(lambda: len(items))
+    items.append(3)
+    assert g.value() == 3
+    assert g.render()[-1] == "open 3"
+
+
+def test_histogram_buckets_are_cumulative():
+    h = Histogram("latency_seconds", "Latency", labelnames=("stage",), buckets=(0.1, 1.0))
+    h.observe(0.05, ("llm",))
+    h.observe(0.5, ("llm",))
+    h.observe(5, ("llm",))
+    assert h.count(("llm",)) == 3
+    assert h.count(("rag",)) == 0
+    lines = h.render()
+    assert 'latency_seconds_bucket{stage="llm",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{stage="llm",le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{stage="llm",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{stage="llm"} 5.55' in lines
+    assert 'latency_seconds_count{stage="llm"} 3' in lines
+
+
+def test_histogram_time_observes_even_on_error():
+    h = Histogram("t", "T")
+    with pytest.raises(RuntimeError):
+        with h.time():
+            raise RuntimeError("boom")
+    assert h.count() == 1
+
+
+def test_registry_rejects_duplicates_and_renders_all():
+    r = Registry()
+    r.register(Counter("a_total", "A")).inc()
+    r.register(Gauge("b", "B")).set(1)
+    with pytest.raises(ValueError):
+        r.register(Counter("a_total", "A again"))
+    text = r.render()
+    assert text.endswith("\n")
+    assert "a_total 1" in text and "b 1" in text
+
+
+def test_base_metric_has_no_samples():
+    with pytest.raises(NotImplementedError):
+        Metric("x", "X").render()
@@ -0,0 +1,56 @@
+"""
+Unit tests for model_router: tier choice, overload fallback and failover.
+"""
+
+from unittest.mock import patch
+
+import metrics
+import model_router
+from llm_scheduler import LLMScheduler
+from model_router import LARGE, SMALL, ModelTier, choose_tier, fallback_for, is_complex
+
+
+def test_simple_turns_go_to_the_small_model():
+    assert not is_complex("The fox finds a key.")
+    routed = metrics.LLM_ROUTES.value(("small", "simple"))
+    assert choose_tier("The fox finds a key.") is SMALL
+    assert metrics.LLM_ROUTES.value(("small", "simple")) == routed + 1
+
+
+def test_long_or_complex_turns_go_to_the_large_model():
+    assert is_complex("The fox walks through the whispering forest looking for the lost golden key " * 3)
+    assert is_complex("The fox wakes. The owl sings. The river floods!")
+    assert is_complex("Explain why the owl hid the key")
+    assert choose_tier("Why did the owl hide the key?") is LARGE
+    assert metrics.LLM_ROUTES.value(("large", "complex")) >= 1
+
+
+def test_latency_hint_overrides_the_input():
+    assert choose_tier("Explain why the owl hid the key", "fast") is SMALL
+    assert choose_tier("Go on.", "quality") is LARGE
+    assert metrics.LLM_ROUTES.value(("large", "hint")) >= 1
+
+
+async def test_large_turns_fall_back_to_small_while_the_queue_is_backed_up():
+    busy = LLMScheduler(concurrency=1)
+    busy._queued = model_router.LARGE_FALLBACK_QUEUE
+    with patch("llm_scheduler.scheduler", busy):
+        assert choose_tier("Go on.", "quality") is SMALL
+        assert choose_tier("Why did the owl hide the key?") is SMALL
+    assert metrics.LLM_ROUTES.value(("small", "overload")) >= 2
+
+
+def test_failover_to_the_other_tier():
+    failovers = metrics.LLM_ROUTES.value(("small", "failover"))
+    assert fallback_for(LARGE) is SMALL
+    assert fallback_for(SMALL) is LARGE
+    assert metrics.LLM_ROUTES.value(("small", "failover")) == failovers + 1
+    # A single-model deployment has nothing to fail over to
+    with patch("model_router.SMALL", ModelTier("small", LARGE.model)):
+        assert fallback_for(LARGE) is None
+
+
+def test_prompt_fits_next_to_the_reply():
+    with patch.dict("model_router.MODEL_OPTIONS", {"tiny:1b": {"num_ctx": 1024, "num_predict": 256}}):
+        assert ModelTier("small", "tiny:1b").prompt_budget == 768
+    assert LARGE.prompt_budget == model_router.CONTEXT_TOKEN_BUDGET
@@ -0,0 +1,28 @@
+"""
+Unit tests for rate_limit.
+"""
+
+from rate_limit import TokenBucket
+
+
+def test_bucket_starts_full_and_refills_up_to_capacity():
+    bucket = TokenBucket(rate=10, capacity=20, now=0)
+    assert bucket.available(20, 0)
+    assert not bucket.available(21, 0)
+    assert bucket.consume(20, 0) == 0
+    assert not bucket.available(1, 0)
+    assert bucket.available(5, 0.5)
+    assert bucket.tokens == 5
+    bucket.consume(0, 100)
+    assert bucket.tokens == 20
+
+
+def test_consume_into_debt_returns_wait():
+    bucket = TokenBucket(rate=8, capacity=8, now=0)
+    assert bucket.consume(12, 0) == 0.5
+    assert not bucket.available(0, 0.25)
+    assert bucket.available(0, 0.5)
+
+
+def test_default_clock():
+    assert TokenBucket(rate=1, capacity=1).available(1, float("inf"))
@@ -0,0 +1,160 @@
+"""
+Unit tests for session_awareness and the awareness channel in ws_manager.
+"""
+
+import asyncio
+import json
+
+import pytest
+
+from session_awareness import SessionAwareness, decode_awareness, encode_awareness, parse_client_state
+from tests.conftest import mock_ws, stalled_ws
+from ws_manager import ConnectionManager
+
+
+def test_encode_and_decode_round_trip():
+    frame = encode_awareness({"1.1": b'{"cursor": 3}', "1.2": None})
+    assert frame[0] == 0x05
+    assert json.loads(frame[1:]) == {"1.1": {"cursor": 3}, "1.2": None}
+    assert decode_awareness(frame) == {"1.1": b'{"cursor":3}', "1.2": None}
+
+
+def test_decode_rejects_non_objects():
+    with pytest.raises(ValueError):
+        decode_awareness(b"\x05[1]")
+    with pytest.raises(ValueError):
+        decode_awareness(b'\x05{"1.1":NaN}')
+    with pytest.raises(ValueError):
+        decode_awareness(b"\x05{")
+    with pytest.raises(ValueError):
+        decode_awareness(b"\x05" + b"[" * 100_000 + b"]" * 100_000)
+
+
+def test_parse_client_state():
+    assert parse_client_state(b"", 10) is None
+    assert parse_client_state(b'{"a":1}', 10) == b'{"a":1}'
+    with pytest.raises(ValueError):
+        parse_client_state(b'{"a":"long"}', 10)
+    with pytest.raises(ValueError):
+        parse_client_state(b"{nope", 10)
+    # Re-serialized, so only what a browser's JSON.parse accepts is spliced into frames
+    assert parse_client_state(b'{ "a" : 1 }', 20) == b'{"a":1}'
+    assert parse_client_state('{"a":"é"}'.encode("utf-16"), 40) == '{"a":"é"}'.encode("utf-8")
+    for payload in (b'{"a":NaN}', b'{"a":Infinity}', b"-Infinity"):
+        with pytest.raises(ValueError):
+            parse_client_state(payload, 20)
+    with pytest.raises(ValueError):
+        parse_client_state(b"1E5", 5)  # re-serialized as 100000.0
+    with pytest.raises(ValueError):
+        parse_client_state(b"[" * 2000 + b"]" * 2000, 5000)  # would raise RecursionError
+
+
+def test_set_tracks_latest_state_and_diff():
+    awareness = SessionAwareness()
+    assert awareness.set("a", b"1") is True
+    assert awareness.set("a", b"2") is True
+    assert awareness.set("a", b"2") is False
+    assert awareness.set("b", None) is False
+    assert awareness.take_diff() == {"a": b"2"}
+    assert not awareness.take_diff()
+    assert awareness.set("a", None) is True
+    assert not awareness.states
+    assert awareness.take_diff() == {"a": None}
+
+
+def test_merge_updates_states_without_dirtying():
+    awareness = SessionAwareness()
+    awareness.merge({"remote": b"1"})
+    assert awareness.states == {"remote": b"1"}
+    awareness.merge({"remote": None, "gone": None})
+    assert not awareness.states
+    assert not awareness.take_diff()
+
+
+def _awareness(frame):
+    assert frame[0] == 0x05
+    return json.loads(frame[1:])
+
+
+@pytest.mark.asyncio
+async def test_awareness_is_throttled_and_sent_as_diffs():
+    manager = ConnectionManager(awareness_hz=1000)
+    ws1, ws2 = mock_ws(), mock_ws()
+    await manager.connect(ws1, "s1")
+    await manager.connect(ws2, "s1")
+    key1 = manager._sessions["s1"][ws1].awareness_key
+    key2 = manager._sessions["s1"][ws2].awareness_key
+    await manager.handle_frame(ws1, "s1", b'\x05{"cursor":1}')
+    await manager.handle_frame(ws1, "s1", b'\x05{"cursor":2}')
+    await manager.handle_frame(ws1, "s1", b"\x05{bad")
+    await manager.handle_frame(ws1, "s1", b"\x05" + b"[" * 2000 + b"]" * 2000)  # too deep: dropped
+    await manager.handle_frame(ws1, "s1", b"\x05" + b"x" * 5000)
+    await manager.handle_frame(mock_ws(), "s1", b'\x05{"cursor":9}')
+    ws2.send_bytes.assert_not_called()
+    await asyncio.sleep(0.01)
+    await manager.flush()
+    ws2.send_bytes.assert_awaited_once()
+    assert _awareness(ws2.send_bytes.await_args.args[0]) == {key1: {"cursor": 2}}
+    ws1.send_bytes.assert_not_called()  # a sender never gets its own state back
+    # Both change in the same tick: each gets only the other's state
+    await manager.handle_frame(ws1, "s1", b'\x05{"cursor":3}')
+    await manager.handle_frame(ws2, "s1", b'\x05{"typing":true}')
+    await asyncio.sleep(0.01)
+    await manager.flush()
+    assert _awareness(ws1.send_bytes.await_args.args[0]) == {key2: {"typing": True}}
+    assert _awareness(ws2.send_bytes.await_args.args[0]) == {key1: {"cursor": 3}}
+    # Nothing is persisted or kept in the document replica
+    assert manager.document("s1").is_empty()
+    manager.disconnect(ws1, "s1")
+    await asyncio.sleep(0.01)
+    await manager.flush()
+    assert _awareness(ws2.send_bytes.await_args.args[0]) == {key1: None}
+    manager.disconnect(ws2, "s1")
+    assert "s1" not in manager._awareness
+
+
+@pytest.mark.asyncio
+async def test_awareness_waits_for_idle_queue_and_joiners_get_snapshot():
+    manager = ConnectionManager(awareness_hz=1000)
+    sender, slow = mock_ws(), stalled_ws()
+    await manager.connect(sender, "s1")
+    await manager.connect(slow, "s1")
+    await manager.broadcast_to_session("s1", b"\x01doc")
+    await asyncio.sleep(0)  # slow's writer takes the frame and stalls
+    await manager.broadcast_to_session("s1", b"\x01more")
+    await manager.handle_frame(sender, "s1", b'\x05{"cursor":1}')
+    await asyncio.sleep(0.01)
+    await manager.handle_frame(sender, "s1", b'\x05{"cursor":2}')
+    await asyncio.sleep(0.01)
+    conn = manager._sessions["s1"][slow]
+    # Document frames keep the queue; awareness waits, newest state only
+    assert conn.queue.qsize() == 1
+    assert conn.awareness == {manager._sessions["s1"][sender].awareness_key: b'{"cursor":2}'}
+    joiner = mock_ws()
+    await manager.connect(joiner, "s1")
+    await asyncio.sleep(0)
+    joiner.send_bytes.assert_awaited_once()
+    assert list(_awareness(joiner.send_bytes.await_args.args[0]).values()) == [{"cursor": 2}]
+    for ws in (sender, slow, joiner):
+        manager.disconnect(ws, "s1")
+
+
+@pytest.mark.asyncio
+async def test_awareness_is_sent_after_backlog_drains():
+    manager = ConnectionManager(awareness_hz=1000)
+    sender, peer = mock_ws(), mock_ws()
+    await manager.connect(sender, "s1")
+    await manager.connect(peer, "s1")
+    await manager.broadcast_to_session("s1", b"\x01doc", exclude=sender)
+    await manager.handle_frame(sender, "s1", b'\x05{"cursor":1}')
+    manager._flush_awareness("s1")
+    manager._flush_awareness("s1")  # nothing new: no frame
+    manager._flush_awareness("unknown")
+    await manager.flush()
+    await manager.flush()
+    frames = [c.args[0] for c in peer.send_bytes.await_args_list]
+    assert frames[0] == b"\x01doc"
+    assert list(_awareness(frames[1]).values()) == [{"cursor": 1}]
+    assert len(frames) == 2
+    manager.disconnect(sender, "s1")
+    manager.disconnect(peer, "s1")
@@ -0,0 +1,266 @@
+"""
+Unit tests for session_bus and cross-worker fan-out in ws_manager.
+"""
+
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from pycrdt import Doc
+
+from session_bus import (
+    OP_PUBLISH,
+    InProcessBroker,
+    InProcessBus,
+    SessionBus,
+    UnixSocketBus,
+    encode_message,
+)
+from tests.conftest import mock_ws, yjs_update, yjs_updates
+from ws_manager import ConnectionManager
+
+
+async def _settle(*managers):
+    for _ in range(5):
+        await asyncio.sleep(0.01)
+        for m in managers:
+            await m.flush()
+
+
+def test_encode_message_layout():
+    msg = encode_message(OP_PUBLISH, "s1", b"\x01x")
+    assert msg[0] == OP_PUBLISH
+    assert msg.endswith(b"s1\x01x")
+
+
+@pytest.mark.asyncio
+async def test_base_bus_start_stop_and_deliver_without_handler():
+    bus = SessionBus()
+    await bus.start()
+    bus._deliver("s1", b"x")
+    await bus.stop()
+
+
+@pytest.mark.asyncio
+async def test_in_process_bus_reaches_other_worker():
+    broker = InProcessBroker()
+    worker1 = ConnectionManager(bus=InProcessBus(broker))
+    worker2 = ConnectionManager(bus=InProcessBus(broker))
+    ws1, ws2 = mock_ws(), mock_ws()
+    await worker1.connect(ws1, "s1")
+    await worker2.connect(ws2, "s1")
+    frame = b"\x01" + yjs_update("Once")
+    await worker1.handle_frame(ws1, "s1", frame)
+    await _settle(worker1, worker2)
+    ws2.send_bytes.assert_called_with(frame)
+    assert not worker2.document("s1").is_empty()
+    await worker2.handle_frame(ws2, "s1", b"hello")
+    await _settle(worker1, worker2)
+    ws1.send_bytes.assert_called_with(b"hello")
+
+
+@pytest.mark.asyncio
+async def test_in_process_bus_late_worker_resyncs_replica():
+    broker = InProcessBroker()
+    worker1 = ConnectionManager(bus=InProcessBus(broker))
+    worker2 = ConnectionManager(bus=InProcessBus(broker))
+    ws1 = mock_ws()
+    await worker1.connect(ws1, "s1")
+    await worker1.handle_frame(ws1, "s1", b"\x01" + yjs_update("Once"))
+    joiner = mock_ws()
+    await worker2.connect(joiner, "s1")
+    await _settle(worker1, worker2)
+    assert worker2.document("s1").encode_state() == worker1.document("s1").encode_state()
+
+
+@pytest.mark.asyncio
+async def test_in_process_bus_catch_up_reaches_only_the_resyncing_worker():
+    broker = InProcessBroker()
+    worker1 = ConnectionManager(bus=InProcessBus(broker))
+    worker2 = ConnectionManager(bus=InProcessBus(broker))
+    ws1, ws2 = mock_ws(), mock_ws()
+    await worker1.connect(ws1, "s1")
+    await worker2.connect(ws2, "s1")
+    await worker1.handle_frame(ws1, "s1", b"\x01" + yjs_update("Once"))
+    await _settle(worker1, worker2)
+    ws1.send_bytes.reset_mock()
+    ws2.send_bytes.reset_mock()
+    # A late worker's join is answered with its diff only; clients already in sync get nothing
+    worker3 = ConnectionManager(bus=InProcessBus(broker))
+    await worker3.connect(mock_ws(), "s1")
+    await _settle(worker1, worker2, worker3)
+    assert worker3.document("s1").text("t") == "Once"
+    ws1.send_bytes.assert_not_called()
+    ws2.send_bytes.assert_not_called()
+    # Edits a worker made while cut off go back to the others and their clients
+    offline = Doc()
+    offline.apply_update(worker3.document("s1").encode_state())
+    worker3._apply("s1", yjs_updates(" upon", doc=offline)[0])
+    worker3._resync("s1")
+    await _settle(worker1, worker2, worker3)
+    assert worker1.document("s1").text("t") == worker2.document("s1").text("t") == "Once upon"
+    assert ws1.send_bytes.call_args[0][0][0] == ws2.send_bytes.call_args[0][0][0] == 0x01
+    worker1._on_bus_frame("s1", b"\x00\x01")  # truncated request, ignored
+    worker1._on_bus_frame("s1", b"\x08" + bytes(8) + b"not an update")  # addressed elsewhere
+    worker1._on_bus_frame("s1", b"\x08" + worker1._bus_id + b"not an update")  # undecodable
+
+
+@pytest.mark.asyncio
+async def test_in_process_bus_coalesced_frames_published():
+    broker = InProcessBroker()
+    worker1 = ConnectionManager(bus=InProcessBus(broker), coalesce_window_ms=10_000)
+    worker2 = ConnectionManager(bus=InProcessBus(broker))
+    ws1, ws2 = mock_ws(), mock_ws()
+    await worker1.connect(ws1, "s1")
+    await worker2.connect(ws2, "s1")
+    await worker1.handle_frame(ws1, "s1", b"\x01" + yjs_update("Once"))
+    await _settle(worker1, worker2)
+    assert ws2.send_bytes.call_args[0][0][0] == 0x01
+
+
+@pytest.mark.asyncio
+async def test_in_process_bus_unsubscribes_last_connection():
+    broker = InProcessBroker()
+    bus = InProcessBus(broker)
+    worker = ConnectionManager(bus=bus)
+    ws = mock_ws()
+    await worker.connect(ws, "s1")
+    assert bus in broker.subscribers["s1"]
+    worker.disconnect(ws, "s1")
+    assert "s1" not in broker.subscribers
+    bus.unsubscribe("s1")
+
+
+@pytest.mark.asyncio
+async def test_unix_socket_bus_between_workers(tmp_path):
+    path = str(tmp_path / "bus.sock")
+    bus1, bus2 = UnixSocketBus(path), UnixSocketBus(path)
+    worker1 = ConnectionManager(bus=bus1)
+    worker2 = ConnectionManager(bus=bus2)
+    await worker1.start()
+    await worker2.start()
+    try:
+        assert bus1._broker is not None and bus2._broker is None
+        ws1, ws2 = mock_ws(), mock_ws()
+        await worker1.connect(ws1, "s1")
+        await worker2.connect(ws2, "s1")
+        await _settle(worker1, worker2)
+        frame = b"\x01" + yjs_update("Once")
+        await worker2.handle_frame(ws2, "s1", frame)
+        await _settle(worker1, worker2)
+        ws1.send_bytes.assert_called_with(frame)
+        worker1.disconnect(ws1, "s1")
+        await _settle(worker1, worker2)
+        assert len(bus1._broker._subscribers["s1"]) == 1
+    finally:
+        await worker2.stop()
+        await worker1.stop()
+
+
+@pytest.mark.asyncio
+async def test_unix_socket_bus_broker_failover(tmp_path):
+    path = str(tmp_path / "bus.sock")
+    bus1, bus2 = UnixSocketBus(path), UnixSocketBus(path)
+    worker2 = ConnectionManager(bus=bus2)
+    with patch("session_bus.RECONNECT_DELAY", 0.01):
+        await bus1.start()
+        await worker2.start()
+        ws2 = mock_ws()
+        await worker2.connect(ws2, "s1")
+        await worker2.handle_frame(ws2, "s1", b"\x01" + yjs_update("Once"))
+        await bus1.stop()  # the broker's worker goes away
+        for _ in range(50):
+            await asyncio.sleep(0.01)
+            if bus2._broker is not None and bus2._writer is not None:
+                break
+        assert bus2._broker is not None
+        bus3 = UnixSocketBus(path)
+        worker3 = ConnectionManager(bus=bus3)
+        await worker3.start()
+        ws3 = mock_ws()
+        await worker3.connect(ws3, "s1")
+        await _settle(worker2, worker3)
+        assert not worker3.document("s1").is_empty()
+        await worker3.stop()
+        await worker2.stop()
+
+
+@pytest.mark.asyncio
+async def test_unix_socket_bus_waits_for_broker(tmp_path):
+    path = str(tmp_path / "bus.sock")
+    bus = UnixSocketBus(path)
+    attempts = []
+    real_connect = bus._connect
+
+    async def flaky_connect():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ConnectionRefusedError()
+        await real_connect()
+
+    with patch("session_bus.RECONNECT_DELAY", 0), patch.object(bus, "_connect", flaky_connect):
+        await bus.start()
+    assert len(attempts) == 2
+    bus.publish("s1", b"x")
+    await bus.stop()
+    bus.unsubscribe("s1")  # no-op once stopped
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("greeting", [b"", encode_message(OP_PUBLISH, "s1", b"x")])
+async def test_unix_socket_bus_rejects_broker_without_handshake(tmp_path, greeting):
+    path = str(tmp_path / "bus.sock")
+
+    async def serve(reader, writer):
+        writer.write(greeting)
+
+    server = await asyncio.start_unix_server(serve, path=path)
+    bus = UnixSocketBus(path)
+    try:
+        with patch("session_bus.CONNECT_TIMEOUT", 0.05), patch.object(bus, "_try_lock", return_value=False):
+            with pytest.raises(ConnectionError):
+                await bus._connect()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_unix_socket_broker_ignores_unknown_unsubscribe(tmp_path):
+    from session_bus import OP_UNSUBSCRIBE, UnixSocketBroker, read_message
+
+    path = str(tmp_path / "bus.sock")
+    broker = UnixSocketBroker(path)
+    await broker.start()
+    reader, writer = await asyncio.open_unix_connection(path)
+    await read_message(reader)
+    writer.write(encode_message(OP_UNSUBSCRIBE, "never-subscribed"))
+    await writer.drain()
+    writer.close()
+    await asyncio.sleep(0.01)
+    assert not broker._subscribers
+    await broker.stop()
+    await broker.stop()
+
+
+@pytest.mark.asyncio
+async def test_in_process_bus_relays_awareness_between_workers():
+    broker = InProcessBroker()
+    worker1 = ConnectionManager(bus=InProcessBus(broker), awareness_hz=1000)
+    worker2 = ConnectionManager(bus=InProcessBus(broker), awareness_hz=1000)
+    ws1, ws2 = mock_ws(), mock_ws()
+    await worker1.connect(ws1, "s1")
+    await worker2.connect(ws2, "s1")
+    key = worker1._sessions["s1"][ws1].awareness_key
+    await worker1.handle_frame(ws1, "s1", b'\x05{"cursor":1}')
+    await _settle(worker1, worker2)
+    ws2.send_bytes.assert_called_with(b'\x05{"%s":{"cursor":1}}' % key.encode())
+    joiner = mock_ws()
+    await worker2.connect(joiner, "s1")
+    await _settle(worker1, worker2)
+    joiner.send_bytes.assert_called_with(b'\x05{"%s":{"cursor":1}}' % key.encode())
+    worker2._on_bus_frame("s1", b"\x05not json")  # ignored
+    worker1.disconnect(ws1, "s1")
+    await _settle(worker1, worker2)
+    ws2.send_bytes.assert_called_with(b'\x05{"%s":null}' % key.encode())
+    assert worker2._awareness["s1"].states == {}
@@ -0,0 +1,45 @@
+"""
+Unit tests for session_doc.
+"""
+
+from pycrdt import Doc, Text
+
+from session_doc import SessionDoc
+from tests.conftest import yjs_update, yjs_updates
+
+
+def test_new_session_doc_is_empty():
+    assert SessionDoc().is_empty()
+
+
+def test_apply_update_and_encode_full_state():
+    replica = SessionDoc()
+    update = yjs_update("Once upon a time")
+    assert replica.apply_update(update) is True
+    assert not replica.is_empty()
+    joiner = Doc()
+    joiner.apply_update(replica.encode_state())
+    assert str(joiner.get("t", type=Text)) == "Once upon a time"
+
+
+def test_apply_update_rejects_garbage():
+    replica = SessionDoc()
+    assert replica.apply_update(b"not a yjs update") is False
+    assert replica.is_empty()
+
+
+def test_encode_state_diff_against_state_vector():
+    replica = SessionDoc()
+    doc = Doc()
+    (update,) = yjs_updates("Once", doc=doc)
+    replica.apply_update(update)
+    assert replica.state_vector() == doc.get_state()
+    diff = replica.encode_state(doc.get_state())
+    assert len(diff) < len(replica.encode_state())
+
+
+def test_encode_state_invalid_state_vector_falls_back_to_full_state():
+    replica = SessionDoc()
+    update = yjs_update("Once")
+    replica.apply_update(update)
+    assert replica.encode_state(b"\xff\xff") == replica.encode_state()
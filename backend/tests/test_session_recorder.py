@@ -0,0 +1,62 @@
+"""
+Unit tests for session_recorder.
+"""
+
+import pytest
+
+from session_recorder import (
+    RECORD_FRAME,
+    RECORD_JOIN,
+    RECORD_LEAVE,
+    TrafficRecorder,
+    open_recorder,
+    read_recording,
+)
+
+
+def test_records_round_trip(tmp_path):
+    recorder = TrafficRecorder(tmp_path / "rec")
+    recorder.join("class/7", 1)
+    recorder.join("class/7", 2, compress=True)
+    recorder.frame("class/7", 1, b"\x01update")
+    recorder.leave("class/7", 2)
+    recorder.close()
+    session_id, records = read_recording(recorder.path("class/7"))
+    assert session_id == "class/7"
+    assert [r[1:] for r in records] == [
+        (RECORD_JOIN, 1, b""),
+        (RECORD_JOIN, 2, b"deflate"),
+        (RECORD_FRAME, 1, b"\x01update"),
+        (RECORD_LEAVE, 2, b""),
+    ]
+    assert records[0][0] <= records[-1][0]
+
+
+def test_reopened_session_appends_without_new_header(tmp_path):
+    recorder = TrafficRecorder(tmp_path)
+    recorder.frame("s1", 1, b"a")
+    recorder.close_session("s1")
+    recorder.close_session("s1")
+    recorder.frame("s1", 2, b"b")
+    recorder.close()
+    _session, records = read_recording(recorder.path("s1"))
+    assert [r[3] for r in records] == [b"a", b"b"]
+
+
+def test_truncated_record_ignored_and_bad_file_rejected(tmp_path):
+    recorder = TrafficRecorder(tmp_path)
+    recorder.frame("s1", 1, b"first")
+    recorder.frame("s1", 1, b"second")
+    recorder.close()
+    path = recorder.path("s1")
+    path.write_bytes(path.read_bytes()[:-3])
+    assert [r[3] for r in read_recording(path)[1]] == [b"first"]
+    bogus = tmp_path / "bogus.rec"
+    bogus.write_bytes(b"not a recording")
+    with pytest.raises(ValueError):
+        read_recording(bogus)
+
+
+def test_open_recorder(tmp_path):
+    assert open_recorder("") is None
+    assert isinstance(open_recorder(str(tmp_path)), TrafficRecorder)
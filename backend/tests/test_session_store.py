@@ -0,0 +1,173 @@
+"""
+Unit tests for session_store.
+"""
+
+import time
+from unittest.mock import patch
+
+import pytest
+from pycrdt import Doc, Text
+
+import session_store
+from session_store import FileSessionStore, SessionStore, SQLiteSessionStore, open_store
+from tests.conftest import yjs_updates
+
+
+def _text(snapshot, tail):
+    doc = Doc()
+    for update in ([snapshot] if snapshot else []) + tail:
+        doc.apply_update(update)
+    return str(doc.get("t", type=Text))
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "file":
+        s = FileSessionStore(tmp_path / "sessions")
+    else:
+        s = SQLiteSessionStore(tmp_path / "sessions.db")
+    yield s
+    s.close()
+
+
+def test_load_unknown_session_is_empty(store):
+    assert store.load("nope") == (None, [])
+
+
+def test_append_then_load_returns_log(store):
+    updates = yjs_updates("Once", " upon")
+    for u in updates:
+        store.append("s1", u)
+    snapshot, tail = store.load("s1")
+    assert snapshot is None
+    assert tail == updates
+    assert store.load("s2") == (None, [])
+
+
+def test_compact_folds_log_into_snapshot(store):
+    for u in yjs_updates("Once", " upon", " a time"):
+        store.append("s1", u)
+    store.compact("s1")
+    snapshot, tail = store.load("s1")
+    assert tail == []
+    assert _text(snapshot, tail) == "Once upon a time"
+
+
+def test_compact_keeps_updates_appended_meanwhile(store):
+    first, second, third = yjs_updates("Once", " upon", " a time")
+    store.append("s1", first)
+    store.append("s1", second)
+    real_merge = session_store.merge_updates
+
+    def merge_while_appending(*updates):
+        store.append("s1", third)
+        return real_merge(*updates)
+
+    with patch("session_store.merge_updates", side_effect=merge_while_appending):
+        store.compact("s1")
+    snapshot, tail = store.load("s1")
+    assert tail == [third]
+    assert _text(snapshot, tail) == "Once upon a time"
+
+
+def test_sqlite_workers_compacting_at_once_lose_nothing(tmp_path):
+    first, second, third = yjs_updates("Once", " upon", " a time")
+    worker1 = SQLiteSessionStore(tmp_path / "sessions.db")
+    worker2 = SQLiteSessionStore(tmp_path / "sessions.db")
+    worker1.append("s1", first)
+    worker1.append("s1", second)
+    real_merge = session_store.merge_updates
+
+    def other_worker_compacts(*updates):
+        # worker2 sees one more update and finishes its compaction first
+        worker2.append("s1", third)
+        with patch("session_store.merge_updates", real_merge):
+            worker2.compact("s1")
+        return real_merge(*updates)
+
+    with patch("session_store.merge_updates", side_effect=other_worker_compacts):
+        worker1.compact("s1")
+    # worker1's stale snapshot did not replace the newer one
+    for worker in (worker1, worker2):
+        snapshot, tail = worker.load("s1")
+        assert tail == []
+        assert _text(snapshot, tail) == "Once upon a time"
+    worker1.close()
+    worker2.close()
+
+
+def test_compact_empty_log_no_op(store):
+    store.compact("s1")
+    assert store.load("s1") == (None, [])
+
+
+def test_file_store_ignores_torn_record(tmp_path):
+    store = FileSessionStore(tmp_path)
+    update = yjs_updates("Once")[0]
+    store.append("s1", update)
+    store.flush()
+    with open(store._dir("s1") / "log.bin", "ab") as f:
+        f.write(b"\x00\x00\x00\xff partial")
+    assert store.load("s1") == (None, [update])
+
+
+@pytest.mark.parametrize("first", ["load", "append"])
+def test_file_store_cuts_torn_record_before_appending(tmp_path, first):
+    first_update, *later = yjs_updates("Once", " upon", " a time")
+    crashed = FileSessionStore(tmp_path)
+    crashed.append("s1", first_update)
+    crashed.close()
+    log_path = crashed._dir("s1") / "log.bin"
+    with open(log_path, "ab") as f:
+        f.write(b"\x00\x00\x00\xff partial")
+    store = FileSessionStore(tmp_path)
+    if first == "load":
+        assert store.load("s1") == (None, [first_update])
+    for update in later:
+        store.append("s1", update)
+    store.flush()
+    assert FileSessionStore(tmp_path).load("s1") == (None, [first_update, *later])
+    store.compact("s1")
+    assert b"partial" not in log_path.read_bytes()
+    assert _text(*store.load("s1")) == "Once upon a time"
+
+
+def test_file_store_writes_appends_in_the_background(tmp_path):
+    store = FileSessionStore(tmp_path, flush_interval=0)
+    update = yjs_updates("Once")[0]
+    log_path = store._dir("s1") / "log.bin"
+    store.append("s1", update)
+    for _ in range(200):
+        if log_path.exists() and log_path.stat().st_size:
+            break
+        time.sleep(0.01)
+    assert log_path.read_bytes()[4:] == update
+    store.close()
+    store.close()  # idempotent
+
+
+def test_base_store_close_is_no_op():
+    SessionStore().flush()
+    SessionStore().close()
+
+
+def test_open_store(tmp_path):
+    assert open_store("") is None
+    db = open_store(str(tmp_path / "s.db"))
+    assert isinstance(db, SQLiteSessionStore)
+    db.close()
+    assert isinstance(open_store(str(tmp_path / "dir")), FileSessionStore)
+
+
+def test_sqlite_store_writes_appends_in_the_background(tmp_path):
+    store = SQLiteSessionStore(tmp_path / "sessions.db", flush_interval=0)
+    other_worker = SQLiteSessionStore(tmp_path / "sessions.db")
+    update = yjs_updates("Once")[0]
+    store.append("s1", update)
+    for _ in range(200):
+        if other_worker.load("s1")[1]:
+            break
+        time.sleep(0.01)
+    assert other_worker.load("s1") == (None, [update])
+    store.close()
+    other_worker.close()
@@ -0,0 +1,65 @@
+"""
+Unit tests for single_flight.
+"""
+
+import asyncio
+
+import pytest
+
+import metrics
+from single_flight import SingleFlight
+
+
+async def test_concurrent_calls_share_one_run():
+    flight = SingleFlight("test")
+    release = asyncio.Event()
+    runs = []
+
+    async def work():
+        runs.append(1)
+        await release.wait()
+        return "story"
+
+    shared = metrics.SINGLE_FLIGHT_SHARED.value(("test",))
+    callers = [asyncio.create_task(flight.run("k", work)) for _ in range(3)]
+    other = asyncio.create_task(flight.run("other", work))
+    await asyncio.sleep(0)
+    assert len(flight) == 2
+    release.set()
+    assert await asyncio.gather(*callers, other) == ["story"] * 4
+    assert len(runs) == 2
+    assert metrics.SINGLE_FLIGHT_SHARED.value(("test",)) == shared + 2
+    assert len(flight) == 0
+    # Finished runs are not reused
+    assert await flight.run("k", work) == "story"
+    assert len(runs) == 3
+
+
+async def test_errors_reach_every_caller_and_key_is_released():
+    flight = SingleFlight("test")
+
+    async def work():
+        await asyncio.sleep(0)
+        raise RuntimeError("ollama down")
+
+    results = await asyncio.gather(flight.run("k", work), flight.run("k", work), return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert len(flight) == 0
+
+
+async def test_cancelled_caller_does_not_cancel_shared_run():
+    flight = SingleFlight("test")
+    release = asyncio.Event()
+
+    async def work():
+        await release.wait()
+        return "story"
+
+    first = asyncio.create_task(flight.run("k", work))
+    second = asyncio.create_task(flight.run("k", work))
+    await asyncio.sleep(0)
+    first.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await first
+    release.set()
+    assert await second == "story"
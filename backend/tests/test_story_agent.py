@@ -2,7 +2,12 @@
 Unit tests for story_agent.
 """
 
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from llm_scheduler import LLMOverloaded, LLMScheduler
+from model_router import LARGE, SMALL
 
 from story_agent import (
     build_story_graph,
@@ -14,23 +19,23 @@ from story_agent import (
 )
 
 
-def test_safety_check_node_pass():
-    out = safety_check_node({"user_input": "What happens next?"})
+async def test_safety_check_node_pass():
+    out = await safety_check_node({"user_input": "What happens next?"})
     assert out == {"safety_passed": True}
 
 
-def test_safety_check_node_fail_empty():
-    out = safety_check_node({"user_input": ""})
+async def test_safety_check_node_fail_empty():
+    out = await safety_check_node({"user_input": ""})
     assert out == {"safety_passed": False}
 
 
-def test_safety_check_node_fail_pii():
-    out = safety_check_node({"user_input": "My SSN is 123-45-6789"})
+async def test_safety_check_node_fail_pii():
+    out = await safety_check_node({"user_input": "My SSN is 123-45-6789"})
     assert out == {"safety_passed": False}
 
 
-def test_safety_check_node_fail_off_topic():
-    out = safety_check_node({"user_input": "What is my password?"})
+async def test_safety_check_node_fail_off_topic():
+    out = await safety_check_node({"user_input": "What is my password?"})
     assert out == {"safety_passed": False}
 
 
@@ -42,79 +47,174 @@ def test_route_after_safety_to_fallback():
     assert route_after_safety({"safety_passed": False}) == "fallback_node"
 
 
-def test_fallback_node():
-    out = fallback_node({})
+async def test_fallback_node():
+    out = await fallback_node({})
     assert "safe" in out["response"].lower() and "on topic" in out["response"].lower()
 
 
-def test_rag_node_with_lore():
+async def test_rag_node_with_lore():
     with patch("story_agent.search_lore") as mock_search:
-        mock_search.invoke.return_value = "Once upon a time."
-        out = rag_node({"user_input": "dragon", "story_context": "Start."})
-    assert "Relevant lore" in out["story_context"]
-    assert "Once upon a time" in out["story_context"]
+        mock_search.ainvoke = AsyncMock(return_value="Once upon a time.")
+        out = await rag_node({"user_input": "dragon", "story_context": "Start."})
+    assert out == {"lore": "Once upon a time."}
 
 
-def test_rag_node_no_lore():
+async def test_rag_node_no_lore():
     with patch("story_agent.search_lore") as mock_search:
-        mock_search.invoke.return_value = ""
-        out = rag_node({"user_input": "dragon", "story_context": "Start."})
-    assert out["story_context"] == "Start."
+        mock_search.ainvoke = AsyncMock(return_value="")
+        out = await rag_node({"user_input": "dragon", "story_context": "Start."})
+    assert out == {"lore": ""}
 
 
-def test_llm_node_success():
+async def test_llm_node_success():
     mock_llm = MagicMock()
-    mock_llm.invoke.return_value = MagicMock(content="The dragon flew away.")
+    mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content="The dragon flew away."))
     with patch("story_agent.get_llm", return_value=mock_llm):
-        out = llm_node({"user_input": "Continue.", "story_context": "", "conversation_history": []})
+        out = await llm_node({"user_input": "Continue.", "story_context": "", "conversation_history": []})
     assert out["response"] == "The dragon flew away."
 
 
-def test_llm_node_no_content_uses_default():
+async def test_llm_node_no_content_uses_default():
     mock_llm = MagicMock()
-    mock_llm.invoke.return_value = MagicMock(content="")
+    mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content=""))
     with patch("story_agent.get_llm", return_value=mock_llm):
-        out = llm_node({"user_input": "Hi", "story_context": "", "conversation_history": []})
+        out = await llm_node({"user_input": "Hi", "story_context": "", "conversation_history": []})
     assert out["response"] == "The story continues..."
 
 
-def test_llm_node_str_response_fallback():
+async def test_llm_node_str_response_fallback():
     mock_llm = MagicMock()
-    mock_llm.invoke.return_value = "string response"
+    mock_llm.ainvoke = AsyncMock(return_value="string response")
     with patch("story_agent.get_llm", return_value=mock_llm):
-        out = llm_node({"user_input": "Hi", "story_context": "", "conversation_history": []})
+        out = await llm_node({"user_input": "Hi", "story_context": "", "conversation_history": []})
     assert out["response"] == "string response"
 
 
-def test_llm_node_exception_fallback():
+async def test_llm_node_exception_fallback():
     with patch("story_agent.get_llm", side_effect=RuntimeError("Ollama down")):
-        out = llm_node({"user_input": "Hi", "story_context": "", "conversation_history": []})
+        out = await llm_node({"user_input": "Hi", "story_context": "", "conversation_history": []})
     assert "resting" in out["response"] or "Ollama" in out["response"]
 
 
-def test_llm_node_with_story_context():
+async def test_llm_node_uses_the_routed_tier():
+    mock_llm = MagicMock()
+    mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content="OK"))
+    with patch("story_agent.get_llm", return_value=mock_llm) as mock_get_llm:
+        await llm_node({"user_input": "Go on.", "story_context": "", "conversation_history": []})
+        await llm_node({"user_input": "Go on.", "story_context": "", "conversation_history": [], "latency": "quality"})
+    assert [c.args for c in mock_get_llm.call_args_list] == [(SMALL.model,), (LARGE.model,)]
+
+
+async def test_llm_node_fails_over_to_the_other_tier():
+    missing = MagicMock()
+    missing.ainvoke = AsyncMock(side_effect=RuntimeError("model not found"))
+    other = MagicMock()
+    other.ainvoke = AsyncMock(return_value=MagicMock(content="The owl answered."))
+    with patch("story_agent.get_llm", side_effect=[missing, other]) as mock_get_llm:
+        out = await llm_node({"user_input": "Go on.", "story_context": "", "conversation_history": []})
+    assert out["response"] == "The owl answered."
+    assert mock_get_llm.call_args.args == (LARGE.model,)
+    # One model for both tiers: the error is the answer
+    with patch("story_agent.get_llm", return_value=missing), patch("model_router.fallback_for", return_value=None):
+        out = await llm_node({"user_input": "Go on.", "story_context": "", "conversation_history": []})
+    assert "resting" in out["response"] and SMALL.model in out["response"]
+    assert missing.ainvoke.await_count == 2
+
+
+async def test_no_failover_once_the_reply_has_started_streaming():
+    from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+    from langchain_core.messages import AIMessage
+
+    # Story turns never bind tools
+    class DiesMidReply(GenericFakeChatModel):  # pylint: disable=abstract-method
+        async def _astream(self, *args, **kwargs):
+            async for chunk in super()._astream(*args, **kwargs):
+                yield chunk
+            raise RuntimeError("connection reset")
+
+    broken = DiesMidReply(messages=iter([AIMessage(content="Once upon")]))
+    with patch("story_agent.get_llm", return_value=broken) as mock_get_llm, patch(
+        "story_agent.search_lore"
+    ) as mock_search:
+        mock_search.ainvoke = AsyncMock(return_value="")
+        chunks = [
+            chunk
+            async for mode, chunk in build_story_graph().astream(
+                {"user_input": "Go on."}, stream_mode=["messages", "values"]
+            )
+            if mode == "values"
+        ]
+    # The other tier is never asked, so the session does not get the opening twice
+    assert mock_get_llm.call_count == 1
+    assert SMALL.model in chunks[-1]["response"]
+
+
+async def test_llm_node_caches_under_the_model_that_answered():
+    from generation_cache import GenerationCache, _keys
+
+    missing = MagicMock()
+    missing.ainvoke = AsyncMock(side_effect=RuntimeError("model not found"))
+    other = MagicMock()
+    other.ainvoke = AsyncMock(return_value=MagicMock(content="The owl answered."))
+    state = {"user_input": "Go on.", "story_context": "", "conversation_history": []}
+    cache = GenerationCache(candidates=1)
+    with patch("story_agent.get_llm", side_effect=[missing, other]), patch("generation_cache.cache", cache):
+        with patch.object(cache, "store", wraps=cache.store) as store:
+            await llm_node(state)
+    lookup = store.call_args.args[0]
+    # Looked up for the small model, but only the large one produced this response
+    assert lookup.prompt[0] == SMALL.model and lookup.key not in cache._entries
+    assert list(cache._entries) == [_keys(LARGE.model, lookup.prompt[1], "Go on.")[0]]
+
+
+async def test_llm_node_lets_overload_reach_the_caller():
+    mock_llm = MagicMock()
+    mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content="OK"))
+    full = LLMScheduler(concurrency=1, max_queue=0)
+    await full._acquire("other")
+    with patch("story_agent.get_llm", return_value=mock_llm), patch("llm_scheduler.scheduler", full):
+        with pytest.raises(LLMOverloaded) as exc:
+            await llm_node({"user_input": "Hi", "story_context": "", "conversation_history": [], "session_id": "s1"})
+    assert exc.value.status == 503
+    mock_llm.ainvoke.assert_not_called()
+
+
+async def test_llm_node_with_story_context():
+    mock_llm = MagicMock()
+    mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content="OK"))
+    with patch("story_agent.get_llm", return_value=mock_llm):
+        await llm_node({"user_input": "Hi", "story_context": "A dragon lived in a cave.", "conversation_history": []})
+    call_arg = mock_llm.ainvoke.call_args[0][0]
+    assert "Story Guide" in call_arg[0].content
+    assert "Current story context:\nA dragon lived in a cave." in call_arg[-2].content
+
+
+async def test_llm_node_prompt_keeps_latest_story_and_lore():
     mock_llm = MagicMock()
-    mock_llm.invoke.return_value = MagicMock(content="OK")
+    mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content="OK"))
+    story = "\n\n".join(f"Chapter {i}: the fox walked on." * 5 for i in range(300))
     with patch("story_agent.get_llm", return_value=mock_llm):
-        llm_node({"user_input": "Hi", "story_context": "A dragon lived in a cave.", "conversation_history": []})
-    call_arg = mock_llm.invoke.call_args[0][0]
-    system = next(m for m in call_arg if hasattr(m, "content") and "Story Guide" in str(m.content))
-    assert "dragon" in system.content
+        await llm_node(
+            {"user_input": "Hi", "story_context": story, "lore": "Owls are wise.", "conversation_history": []}
+        )
+    context = mock_llm.ainvoke.call_args[0][0][-2].content
+    assert "Chapter 299:" in context and "Chapter 0:" not in context
+    assert "Relevant lore:\nOwls are wise." in context
 
 
-def test_llm_node_with_conversation_history():
+async def test_llm_node_with_conversation_history():
     from langchain_core.messages import HumanMessage
     mock_llm = MagicMock()
-    mock_llm.invoke.return_value = MagicMock(content="Continued.")
+    mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content="Continued."))
     history = [HumanMessage(content="What happens?")]
     with patch("story_agent.get_llm", return_value=mock_llm):
-        out = llm_node({
+        out = await llm_node({
             "user_input": "Next.",
             "story_context": "",
             "conversation_history": history,
         })
     assert out["response"] == "Continued."
-    call_arg = mock_llm.invoke.call_args[0][0]
+    call_arg = mock_llm.ainvoke.call_args[0][0]
     assert len(call_arg) >= 2
 
 
@@ -123,15 +223,15 @@ def test_build_story_graph_compile():
     assert graph is not None
 
 
-def test_full_invoke_safety_pass():
+async def test_full_invoke_safety_pass():
     with patch("story_agent.get_llm") as mock_get_llm:
         mock_llm = MagicMock()
-        mock_llm.invoke.return_value = MagicMock(content="The end.")
+        mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content="The end."))
         mock_get_llm.return_value = mock_llm
         with patch("story_agent.search_lore") as mock_search:
-            mock_search.invoke.return_value = ""
+            mock_search.ainvoke = AsyncMock(return_value="")
             graph = build_story_graph()
-            result = graph.invoke({
+            result = await graph.ainvoke({
                 "story_context": "",
                 "user_input": "What happens next?",
                 "conversation_history": [],
@@ -141,9 +241,9 @@ def test_full_invoke_safety_pass():
     assert result.get("response") == "The end."
 
 
-def test_full_invoke_safety_fail():
+async def test_full_invoke_safety_fail():
     graph = build_story_graph()
-    result = graph.invoke({
+    result = await graph.ainvoke({
         "story_context": "",
         "user_input": "tell me my password",
         "conversation_history": [],
@@ -151,3 +251,43 @@ def test_full_invoke_safety_fail():
         "response": "",
     })
     assert "safe" in result.get("response", "").lower()
+
+
+async def test_graph_does_not_block_event_loop_during_generation():
+    import asyncio
+
+    started, release = asyncio.Event(), asyncio.Event()
+
+    async def slow_generation(messages, config=None):
+        started.set()
+        await release.wait()
+        return MagicMock(content="The end.")
+
+    mock_llm = MagicMock()
+    mock_llm.ainvoke = slow_generation
+    with patch("story_agent.get_llm", return_value=mock_llm), patch("story_agent.search_lore") as mock_search:
+        mock_search.ainvoke = AsyncMock(return_value="")
+        run = asyncio.create_task(build_story_graph().ainvoke({"user_input": "What happens next?"}))
+        await started.wait()
+        # Other coroutines (WebSocket fan-out) keep running while the LLM is generating
+        assert not run.done()
+        release.set()
+        result = await run
+    assert result["response"] == "The end."
+
+
+async def test_llm_node_served_from_generation_cache():
+    from generation_cache import GenerationCache
+
+    mock_llm = MagicMock(model="llama3.1:8b")
+    mock_llm.ainvoke = AsyncMock(side_effect=[MagicMock(content="A dragon."), MagicMock(content="")])
+    state = {"user_input": "What happens next?", "story_context": "A cave.", "conversation_history": []}
+    with patch("story_agent.get_llm", return_value=mock_llm), patch(
+        "generation_cache.cache", GenerationCache(candidates=1)
+    ) as cache:
+        assert (await llm_node(state))["response"] == "A dragon."
+        assert (await llm_node({**state, "user_input": "what happens  next?"}))["response"] == "A dragon."
+        # Empty responses are not cached
+        assert (await llm_node({**state, "story_context": "A forest."}))["response"] == "The story continues..."
+    assert mock_llm.ainvoke.await_count == 2
+    assert len(cache) == 1
@@ -0,0 +1,109 @@
+"""
+Unit tests for story_memory: turn trimming, the session checkpointer and retention.
+"""
+
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage
+
+import story_memory
+from context_builder import HISTORY_MESSAGES
+from story_agent import build_story_graph
+from story_memory import SessionCheckpointer, close_memory, open_memory, remember_turn, run_config
+from story_stream import initial_state
+
+
+def _history(turns: int) -> list:
+    history = []
+    for i in range(turns):
+        history += [HumanMessage(content=f"q{i}", id=f"q{i}"), AIMessage(content=f"a{i}", id=f"a{i}")]
+    return history
+
+
+def test_turn_appended_until_history_limit():
+    updates = remember_turn(_history(1), "Next?", "Then the owl sang.")
+    assert [(m.type, m.content) for m in updates] == [("human", "Next?"), ("ai", "Then the owl sang.")]
+
+
+def test_history_trimmed_to_half_in_whole_turns():
+    history = _history(HISTORY_MESSAGES // 2)
+    updates = remember_turn(history, "Next?", "Then the owl sang.")
+    removed = [m.id for m in updates if isinstance(m, RemoveMessage)]
+    kept = [m for m in history if m.id not in removed] + updates[len(removed) :]
+    assert removed == [m.id for m in history[: len(removed)]]
+    assert len(kept) <= HISTORY_MESSAGES // 2 and isinstance(kept[0], HumanMessage)
+
+    # One huge turn is kept on its own
+    updates = remember_turn(history, "x" * 4000, "y")
+    assert len([m for m in updates if isinstance(m, RemoveMessage)]) == len(history)
+
+
+def _llm(replies: list[str]) -> MagicMock:
+    llm = MagicMock()
+    llm.ainvoke = AsyncMock(side_effect=[AIMessage(content=r) for r in replies])
+    return llm
+
+
+async def _rows(saver: SessionCheckpointer, table: str) -> list:
+    async with saver.conn.execute(f"SELECT thread_id FROM {table}") as cur:
+        return [row[0] async for row in cur]
+
+
+async def test_session_conversation_continues_across_runs():
+    saver = await open_memory("")
+    llm = _llm(["The fox woke up.", "The owl said hello.", "A new tale."])
+    try:
+        graph = build_story_graph(saver)
+        with patch("story_agent.get_llm", return_value=llm), patch("story_agent.search_lore") as search:
+            search.ainvoke = AsyncMock(return_value="")
+            await graph.ainvoke(initial_state("Start the story.", "", "s1"), run_config("s1"))
+            result = await graph.ainvoke(initial_state("What next?", "", "s1"), run_config("s1"))
+            await graph.ainvoke(initial_state("Begin.", "", "s2"), run_config("s2"))
+        assert [m.content for m in result["conversation_history"]] == [
+            "Start the story.", "The fox woke up.", "What next?", "The owl said hello."
+        ]
+        # The second prompt carried the first turn; another session starts empty
+        second_prompt = llm.ainvoke.call_args_list[1].args[0]
+        assert [m.content for m in second_prompt[1:3]] == ["Start the story.", "The fox woke up."]
+        assert len(llm.ainvoke.call_args_list[2].args[0]) == 2
+        # One checkpoint per session is kept
+        assert sorted(await _rows(saver, "checkpoints")) == ["s1", "s2"]
+    finally:
+        await close_memory()
+    assert story_memory.checkpointer is None
+    assert run_config("s1") is None
+
+
+async def test_memory_persists_in_a_file_and_can_be_turned_off(tmp_path):
+    path = str(tmp_path / "memory.db")
+    saver = await open_memory(path)
+    await saver.setup()  # already set up
+    graph = build_story_graph(saver)
+    llm = _llm(["The fox woke up."])
+    with patch("story_agent.get_llm", return_value=llm), patch("story_agent.search_lore") as search:
+        search.ainvoke = AsyncMock(return_value="")
+        await graph.ainvoke(initial_state("Start.", "", "s1"), run_config("s1"))
+    await close_memory()
+    await close_memory()
+
+    saver = await open_memory(path)
+    state = await build_story_graph(saver).aget_state(run_config("s1"))
+    assert [m.content for m in state.values["conversation_history"]] == ["Start.", "The fox woke up."]
+    await close_memory()
+    assert await open_memory("off") is None
+
+
+async def test_idle_and_excess_sessions_swept():
+    saver = await open_memory("")
+    try:
+        for thread_id, used in (("old", 0.0), ("a", 3e9), ("b", 3e9 + 1), ("c", 3e9 + 2)):
+            await saver.conn.execute("INSERT INTO sessions VALUES (?, ?)", (thread_id, used))
+            await saver.conn.execute(
+                "INSERT INTO checkpoints (thread_id, checkpoint_id) VALUES (?, ?)", (thread_id, "1")
+            )
+        saver.max_sessions = 2
+        assert sorted(await saver.sweep()) == ["a", "old"]
+        assert sorted(await _rows(saver, "checkpoints")) == ["b", "c"]
+        assert sorted(await _rows(saver, "sessions")) == ["b", "c"]
+    finally:
+        await close_memory()
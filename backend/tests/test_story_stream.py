@@ -0,0 +1,259 @@
+"""
+Unit tests for story_stream: generation over the session WebSocket.
+"""
+
+import asyncio
+import json
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from pycrdt import Text
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+
+import story_agent
+from llm_scheduler import LLMOverloaded
+from story_stream import EMPTY_INPUT_PROMPT, StoryGenerations, ndjson_stream
+from tests.conftest import mock_ws
+from ws_manager import ConnectionManager
+
+
+def _events(ws):
+    return [json.loads(c.args[0][1:]) for c in ws.send_bytes.call_args_list if c.args[0][0] == 0x07]
+
+
+def _request(text, **extra):
+    return b"\x06" + json.dumps({"user_input": text, **extra}).encode()
+
+
+@pytest.fixture
+def fake_llm():
+    replies = iter([AIMessage(content="Once upon a time"), AIMessage(content="The end")])
+    with patch("story_agent.get_llm", lambda *_args: GenericFakeChatModel(messages=replies)), patch(
+        "story_agent.search_lore"
+    ) as search:
+        search.ainvoke = AsyncMock(return_value="")
+        yield
+
+
+async def _session(graph=None, clients=2, **options):
+    manager = ConnectionManager()
+    generations = StoryGenerations(manager, lambda: graph or story_agent.build_story_graph(), **options)
+    manager.set_generate_handler(generations.request)
+    sockets = [mock_ws() for _ in range(clients)]
+    for ws in sockets:
+        await manager.connect(ws, "s1")
+    return manager, generations, sockets
+
+
+async def _finish(manager, generations):
+    for _ in range(50):
+        if not generations._sessions:
+            break
+        await asyncio.sleep(0.01)
+    await manager.flush()
+
+
+@pytest.mark.asyncio
+async def test_generation_streams_tokens_to_every_client(fake_llm):
+    manager, generations, (asker, peer) = await _session()
+    with patch("story_stream.TOKEN_FLUSH_INTERVAL", 0):
+        await manager.handle_frame(asker, "s1", _request("a dragon"))
+        await _finish(manager, generations)
+    for ws in (asker, peer):
+        events = _events(ws)
+        assert events[0] == {"id": events[0]["id"], "event": "start"}
+        tokens = [e["text"] for e in events if e["event"] == "token"]
+        assert len(tokens) > 1 and "".join(tokens) == "Once upon a time"
+        assert events[-1] == {"id": events[0]["id"], "event": "done", "text": "Once upon a time"}
+
+
+@pytest.mark.asyncio
+async def test_tokens_are_batched(fake_llm):
+    manager, generations, (asker, _peer) = await _session()
+    # Tokens arriving within one TOKEN_FLUSH_INTERVAL share an event; on a slow run (e.g. under
+    # coverage) the fake LLM's tokens could straddle a flush, so the interval is made unreachable
+    with patch("story_stream.TOKEN_FLUSH_INTERVAL", 60):
+        await manager.handle_frame(asker, "s1", _request("a dragon"))
+        await _finish(manager, generations)
+    assert [e["event"] for e in _events(asker)] == ["start", "token", "done"]
+
+
+@pytest.mark.asyncio
+async def test_story_context_defaults_to_session_document():
+    graph = MagicMock()
+    seen = []
+
+    async def astream(initial, config, stream_mode):
+        seen.append((initial["story_context"], initial["latency"]))
+        yield "values", {"response": "ok"}
+
+    graph.astream = astream
+    manager, generations, (asker, _peer) = await _session(graph)
+    manager.document("s1")._doc.get("story", type=Text).insert(0, "Once")
+    await manager.handle_frame(asker, "s1", _request("next"))
+    await _finish(manager, generations)
+    await manager.handle_frame(asker, "s1", _request("next", story_context="Given", latency="fast"))
+    await _finish(manager, generations)
+    await manager.handle_frame(asker, "s1", _request("next", latency="turbo"))
+    await _finish(manager, generations)
+    assert seen == [("Once", ""), ("Given", "fast"), ("Once", "")]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_are_joined_queued_or_refused():
+    release = asyncio.Event()
+    graph = MagicMock()
+
+    async def astream(initial, config, stream_mode):
+        await release.wait()
+        yield "messages", (AIMessage(content=""), {"langgraph_node": "llm_node"})
+        yield "messages", (AIMessage(content="lore"), {"langgraph_node": "rag_node"})
+        yield "values", {"response": initial["user_input"].upper()}
+
+    graph.astream = astream
+    manager, generations, (a, b, c) = await _session(graph, clients=3, max_queued=1)
+    await manager.handle_frame(a, "s1", _request("dragon"))
+    await manager.handle_frame(b, "s1", _request("dragon"))
+    await manager.handle_frame(b, "s1", _request("castle"))
+    await manager.handle_frame(c, "s1", _request("castle"))
+    await manager.handle_frame(c, "s1", _request("forest"))
+    await manager.flush()
+    replies = [e["event"] for e in _events(b) + _events(c) if e["event"] != "start"]
+    assert replies == ["joined", "queued", "joined", "busy"]
+    release.set()
+    await _finish(manager, generations)
+    done = [e["text"] for e in _events(a) if e["event"] == "done"]
+    assert done == ["DRAGON", "CASTLE"]
+
+
+@pytest.mark.asyncio
+async def test_invalid_requests_answered_to_sender_only():
+    manager, generations, (asker, peer) = await _session(MagicMock())
+    await manager.handle_frame(asker, "s1", b"\x06not json")
+    await manager.handle_frame(asker, "s1", b"\x06[1]")
+    await manager.handle_frame(asker, "s1", b"\x06" + b"[" * 2000 + b"]" * 2000)
+    await manager.handle_frame(asker, "s1", _request("   "))
+    await manager.flush()
+    events = _events(asker)
+    assert [e["event"] for e in events] == ["error", "error", "error", "error"]
+    assert events[-1]["text"] == EMPTY_INPUT_PROMPT
+    peer.send_bytes.assert_not_called()
+    assert not generations._sessions
+
+
+@pytest.mark.asyncio
+async def test_graph_failure_reported_to_session():
+    graph = MagicMock()
+    graph.astream = MagicMock(side_effect=RuntimeError("ollama down"))
+    manager, generations, (asker, peer) = await _session(graph)
+    await manager.handle_frame(asker, "s1", _request("a dragon"))
+    await _finish(manager, generations)
+    assert [e["event"] for e in _events(peer)] == ["start", "error"]
+
+
+async def test_overload_reported_as_busy_with_retry_after():
+    graph = MagicMock()
+    graph.astream = MagicMock(side_effect=LLMOverloaded(503, 9))
+    manager, generations, (asker, peer) = await _session(graph)
+    await manager.handle_frame(asker, "s1", _request("a dragon"))
+    await _finish(manager, generations)
+    assert _events(peer)[-1] == {"id": _events(peer)[0]["id"], "event": "busy", "retry_after": 9}
+
+
+@pytest.mark.asyncio
+async def test_queue_abandoned_when_everyone_leaves_and_stop_cancels():
+    release = asyncio.Event()
+    graph = MagicMock()
+
+    async def astream(initial, config, stream_mode):
+        await release.wait()
+        yield "values", {"response": "x"}
+
+    graph.astream = astream
+    manager, generations, (a, b) = await _session(graph)
+    await manager.handle_frame(a, "s1", _request("one"))
+    await manager.handle_frame(a, "s1", _request("two"))
+    manager.disconnect(a, "s1")
+    manager.disconnect(b, "s1")
+    release.set()
+    await _finish(manager, generations)
+    assert not generations._sessions
+
+    release.clear()
+    manager, generations, (a, _b) = await _session(graph)
+    await manager.handle_frame(a, "s1", _request("one"))
+    await asyncio.sleep(0)
+    await generations.stop()
+    assert not generations._sessions
+
+
+@pytest.mark.asyncio
+async def test_generate_frames_ignored_without_handler():
+    manager = ConnectionManager()
+    ws = mock_ws()
+    await manager.connect(ws, "s1")
+    await manager.handle_frame(ws, "s1", _request("a dragon"))
+    manager.send(mock_ws(), "s1", b"\x07{}")  # unknown socket
+    await manager.flush()
+    ws.send_bytes.assert_not_called()
+    assert manager.session_size("s1") == 1
+
+
+async def _collect(stream):
+    return [json.loads(line) async for line in stream]
+
+
+async def _connected():
+    await asyncio.Event().wait()
+    return {"type": "http.request"}  # pragma: no cover
+
+
+async def test_ndjson_stream_yields_events_and_reports_failures():
+    async def events():
+        yield {"event": "token", "text": "Once"}
+        yield {"event": "done", "text": "Once"}
+
+    assert await _collect(ndjson_stream(events(), _connected)) == [
+        {"event": "token", "text": "Once"},
+        {"event": "done", "text": "Once"},
+    ]
+
+    async def failing():
+        yield {"event": "token", "text": "Once"}
+        raise RuntimeError("ollama down")
+
+    lines = await _collect(ndjson_stream(failing(), _connected))
+    assert lines[-1]["event"] == "error"
+
+    async def overloaded():
+        raise LLMOverloaded(429, 4)
+        yield  # pragma: no cover
+
+    assert await _collect(ndjson_stream(overloaded(), _connected)) == [{"event": "busy", "retry_after": 4}]
+
+
+async def test_ndjson_stream_cancels_generation_when_client_disconnects():
+    gone = asyncio.Event()
+    cancelled = []
+    messages = [{"type": "http.request"}, {"type": "http.disconnect"}]
+
+    async def receive():
+        if len(messages) == 1:
+            await gone.wait()
+        return messages.pop(0)
+
+    async def events():
+        yield {"event": "token", "text": "Once"}
+        try:
+            await asyncio.Event().wait()  # Ollama still thinking
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        yield {"event": "done", "text": "never"}  # pragma: no cover
+
+    stream = ndjson_stream(events(), receive)
+    assert json.loads(await stream.__anext__())["text"] == "Once"
+    gone.set()
+    assert [line async for line in stream] == []
+    assert cancelled == [True]
@@ -2,11 +2,26 @@
 Unit tests for ws_manager.
 """
 
+import asyncio
 from unittest.mock import AsyncMock, MagicMock
 
 import pytest
 
-from ws_manager import ConnectionManager
+import metrics
+from tests.conftest import mock_ws, stalled_ws, yjs_update
+from ws_manager import (
+    CLOSE_FRAME_TOO_LARGE,
+    CLOSE_HEARTBEAT_TIMEOUT,
+    CLOSE_RATE_LIMITED,
+    CLOSE_SLOW_CONSUMER,
+    INGRESS_CLOSE,
+    INGRESS_DELAY,
+    INGRESS_DROP,
+    SLOW_CONSUMER_COALESCE,
+    SLOW_CONSUMER_DISCONNECT,
+    SLOW_CONSUMER_DROP,
+    ConnectionManager,
+)
 
 
 @pytest.fixture
@@ -48,6 +63,7 @@ async def test_broadcast_to_session_excludes_sender(manager):
     await manager.connect(ws1, "s1")
     await manager.connect(ws2, "s1")
     await manager.broadcast_to_session("s1", b"hello", exclude=ws1)
+    await manager.flush()
     ws2.send_bytes.assert_called_once_with(b"hello")
     ws1.send_bytes.assert_not_called()
 
@@ -59,6 +75,7 @@ async def test_broadcast_sends_str_as_utf8(manager):
     ws.send_bytes = AsyncMock()
     await manager.connect(ws, "s1")
     await manager.broadcast_to_session("s1", "hello", exclude=None)
+    await manager.flush()
     ws.send_bytes.assert_called_once_with(b"hello")
 
 
@@ -78,9 +95,831 @@ async def test_broadcast_dead_connection_removed(manager):
     ws2.send_bytes = AsyncMock(side_effect=Exception("broken"))
     await manager.connect(ws1, "s1")
     await manager.connect(ws2, "s1")
+    dead = metrics.WS_DEAD_SOCKETS.value()
+    sent = metrics.WS_FRAMES_OUT.value()
     await manager.broadcast_to_session("s1", b"hello", exclude=None)
+    await manager.flush()
     ws1.send_bytes.assert_called_once_with(b"hello")
+    assert metrics.WS_DEAD_SOCKETS.value() == dead + 1
+    assert metrics.WS_FRAMES_OUT.value() == sent + 1
     assert ws2 not in manager._sessions.get("s1", [])
     await manager.broadcast_to_session("s1", b"second", exclude=None)
+    await manager.flush()
     assert ws1.send_bytes.call_count == 2
     ws1.send_bytes.assert_any_call(b"second")
+
+
+def test_unknown_slow_consumer_policy_rejected():
+    with pytest.raises(ValueError):
+        ConnectionManager(slow_consumer_policy="ignore")
+    with pytest.raises(ValueError):
+        ConnectionManager(ingress_policy="ignore")
+
+
+@pytest.mark.asyncio
+async def test_slow_peer_does_not_block_others(manager):
+    slow = stalled_ws()
+    fast = MagicMock()
+    fast.accept = AsyncMock()
+    received = asyncio.Event()
+    fast.send_bytes = AsyncMock(side_effect=lambda data: received.set())
+    await manager.connect(slow, "s1")
+    await manager.connect(fast, "s1")
+    await manager.broadcast_to_session("s1", b"hello")
+    await asyncio.wait_for(received.wait(), timeout=1)
+    fast.send_bytes.assert_called_once_with(b"hello")
+    manager.disconnect(slow, "s1")
+    manager.disconnect(fast, "s1")
+
+
+@pytest.mark.asyncio
+async def test_slow_consumer_drop_policy():
+    manager = ConnectionManager(queue_size=1, slow_consumer_policy=SLOW_CONSUMER_DROP)
+    slow = stalled_ws()
+    await manager.connect(slow, "s1")
+    dropped = metrics.WS_DROPPED_FRAMES.value()
+    await manager.broadcast_to_session("s1", b"a")
+    await asyncio.sleep(0)  # writer takes "a" and stalls
+    await manager.broadcast_to_session("s1", b"b")
+    await manager.broadcast_to_session("s1", b"c")
+    conn = manager._sessions["s1"][slow]
+    assert conn.dropped == 1
+    assert metrics.WS_DROPPED_FRAMES.value() == dropped + 1
+    assert conn.queue.get_nowait() == b"b"
+    conn.queue.task_done()
+    manager.disconnect(slow, "s1")
+
+
+@pytest.mark.asyncio
+async def test_slow_consumer_disconnect_policy():
+    manager = ConnectionManager(queue_size=1, slow_consumer_policy=SLOW_CONSUMER_DISCONNECT)
+    slow = stalled_ws()
+    await manager.connect(slow, "s1")
+    await manager.broadcast_to_session("s1", b"a")
+    await asyncio.sleep(0)
+    await manager.broadcast_to_session("s1", b"b")
+    await manager.broadcast_to_session("s1", b"c")
+    assert "s1" not in manager._sessions
+    await asyncio.sleep(0)
+    slow.close.assert_called_once_with(code=CLOSE_SLOW_CONSUMER)
+
+
+@pytest.mark.asyncio
+async def test_slow_consumer_disconnect_ignores_close_error():
+    manager = ConnectionManager(queue_size=1, slow_consumer_policy=SLOW_CONSUMER_DISCONNECT)
+    slow = stalled_ws()
+    slow.close = AsyncMock(side_effect=RuntimeError("already closed"))
+    await manager.connect(slow, "s1")
+    await manager.broadcast_to_session("s1", b"a")
+    await asyncio.sleep(0)
+    await manager.broadcast_to_session("s1", b"b")
+    await manager.broadcast_to_session("s1", b"c")
+    await asyncio.sleep(0)
+    slow.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_slow_consumer_coalesce_policy_merges_updates():
+    manager = ConnectionManager(queue_size=2, slow_consumer_policy=SLOW_CONSUMER_COALESCE)
+    slow = stalled_ws()
+    await manager.connect(slow, "s1")
+    await manager.broadcast_to_session("s1", b"\x00")
+    await asyncio.sleep(0)
+    for text in ("once", "upon", "a time"):
+        await manager.broadcast_to_session("s1", b"\x01" + yjs_update(text))
+    conn = manager._sessions["s1"][slow]
+    assert conn.dropped == 0
+    assert conn.queue.qsize() == 1
+    frame = conn.queue.get_nowait()
+    conn.queue.task_done()
+    assert frame[0] == 0x01
+    manager.disconnect(slow, "s1")
+
+
+@pytest.mark.asyncio
+async def test_slow_consumer_coalesce_policy_drops_unmergeable_overflow():
+    manager = ConnectionManager(queue_size=1, slow_consumer_policy=SLOW_CONSUMER_COALESCE)
+    slow = stalled_ws()
+    await manager.connect(slow, "s1")
+    await manager.broadcast_to_session("s1", b"a")
+    await asyncio.sleep(0)
+    await manager.broadcast_to_session("s1", b"b")
+    await manager.broadcast_to_session("s1", b"c")
+    conn = manager._sessions["s1"][slow]
+    assert conn.dropped == 1
+    assert conn.queue.get_nowait() == b"b"
+    conn.queue.task_done()
+    manager.disconnect(slow, "s1")
+
+
+@pytest.mark.asyncio
+async def test_disconnect_unknown_websocket_keeps_session(manager):
+    ws = MagicMock()
+    ws.accept = AsyncMock()
+    await manager.connect(ws, "s1")
+    manager.disconnect(MagicMock(), "s1")
+    assert ws in manager._sessions["s1"]
+    manager.disconnect(ws, "s1")
+
+
+@pytest.mark.asyncio
+async def test_handle_frame_update_applied_and_relayed(manager):
+    ws1, ws2 = mock_ws(), mock_ws()
+    await manager.connect(ws1, "s1")
+    await manager.connect(ws2, "s1")
+    frame = b"\x01" + yjs_update("Once")
+    await manager.handle_frame(ws1, "s1", frame)
+    await manager.flush()
+    ws2.send_bytes.assert_called_once_with(frame)
+    ws1.send_bytes.assert_not_called()
+    assert not manager.document("s1").is_empty()
+
+
+@pytest.mark.asyncio
+async def test_handle_frame_sync_request_answered_by_server(manager):
+    ws1, ws2, joiner = mock_ws(), mock_ws(), mock_ws()
+    await manager.connect(ws1, "s1")
+    await manager.connect(ws2, "s1")
+    await manager.handle_frame(ws1, "s1", b"\x01" + yjs_update("Once"))
+    await manager.connect(joiner, "s1")
+    await manager.handle_frame(joiner, "s1", b"\x00")
+    await manager.flush()
+    joiner.send_bytes.assert_called_once()
+    reply = joiner.send_bytes.call_args[0][0]
+    assert reply == b"\x01" + manager.document("s1").encode_state()
+    # Peers are not asked to resend the document
+    assert ws1.send_bytes.call_count == 0
+    assert ws2.send_bytes.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_handle_frame_sync_request_on_cold_replica_asks_requester(manager):
+    ws = mock_ws()
+    await manager.connect(ws, "s1")
+    await manager.handle_frame(ws, "s1", b"\x00")
+    await manager.flush()
+    ws.send_bytes.assert_called_once_with(b"\x00")
+
+
+async def _cold_session(manager, peers, joiners):
+    """Peers that already hold the story, on a replica that has not seen it (e.g. after a restart)."""
+    peer_ws = [mock_ws() for _ in range(peers)]
+    joiner_ws = [mock_ws() for _ in range(joiners)]
+    for ws in peer_ws + joiner_ws:
+        await manager.connect(ws, "s1")
+    return peer_ws, joiner_ws
+
+
+@pytest.mark.asyncio
+async def test_cold_sync_requests_go_to_one_elected_peer(manager):
+    (old, other), joiners = await _cold_session(manager, 2, 3)
+    for joiner in joiners:
+        await manager.handle_frame(joiner, "s1", b"\x00")
+    await manager.flush()
+    old.send_bytes.assert_called_once_with(b"\x00" + manager.document("s1").state_vector())
+    other.send_bytes.assert_not_called()
+    update = yjs_update("Once")
+    await manager.handle_frame(old, "s1", b"\x08" + update)
+    await manager.flush()
+    for joiner in joiners:
+        assert joiner.send_bytes.call_args_list[-1].args[0] == b"\x01" + update
+    other.send_bytes.assert_not_called()
+    assert not manager.document("s1").is_empty()
+    assert "s1" not in manager._syncs
+
+
+@pytest.mark.asyncio
+async def test_cold_sync_peer_edits_while_elected_reach_everyone(manager):
+    (old, other), (joiner,) = await _cold_session(manager, 2, 1)
+    await manager.handle_frame(joiner, "s1", b"\x00")
+    elected = manager._syncs["s1"].peer.websocket
+    bystander = other if elected is old else old
+    keystroke = b"\x01" + yjs_update("a")
+    await manager.handle_frame(elected, "s1", keystroke)
+    await manager.flush()
+    # An ordinary update is fanned out, and the sync is still waiting for the 0x08 answer
+    assert bystander.send_bytes.call_args.args[0] == keystroke
+    assert joiner.send_bytes.call_args.args[0] == keystroke
+    assert manager._syncs["s1"].peer.websocket is elected
+    await manager.handle_frame(elected, "s1", b"\x08" + yjs_update("Once"))
+    assert "s1" not in manager._syncs
+
+
+@pytest.mark.asyncio
+async def test_late_or_empty_sync_reply_only_seeds_the_replica(manager):
+    (old, other), (joiner,) = await _cold_session(manager, 2, 1)
+    await manager.handle_frame(joiner, "s1", b"\x00")
+    elected = manager._syncs["s1"].peer.websocket
+    late = other if elected is old else old
+    await manager.handle_frame(late, "s1", b"\x08")
+    await manager.handle_frame(late, "s1", b"\x08" + yjs_update("Once"))
+    await manager.handle_frame(mock_ws(), "s1", b"\x08" + yjs_update("x"))
+    await manager.flush()
+    assert not manager.document("s1").is_empty()
+    assert "s1" in manager._syncs
+    assert joiner.send_bytes.call_args.args[0] == b"\x00"
+
+
+@pytest.mark.asyncio
+async def test_cold_sync_prefers_least_loaded_peer(manager):
+    (old, other), (joiner,) = await _cold_session(manager, 2, 1)
+    manager._put(manager._sessions["s1"][old], b"backlog")
+    await manager.handle_frame(joiner, "s1", b"\x00")
+    assert manager._syncs["s1"].peer is manager._sessions["s1"][other]
+    await manager.flush()
+
+
+@pytest.mark.asyncio
+async def test_cold_sync_falls_back_to_next_peer_on_timeout():
+    manager = ConnectionManager(sync_peer_timeout=0.01)
+    (old, other), (joiner,) = await _cold_session(manager, 2, 1)
+    await manager.handle_frame(joiner, "s1", b"\x00")
+    await asyncio.sleep(0.05)
+    await manager.flush()
+    # Neither answers: each is asked once, then the request is given up
+    assert old.send_bytes.call_args.args[0][0] == 0x00
+    assert other.send_bytes.call_args.args[0][0] == 0x00
+    assert old.send_bytes.call_count == other.send_bytes.call_count == 1
+    assert "s1" not in manager._syncs
+    manager._sync_timeout("s1")  # a stale timer is harmless
+
+
+@pytest.mark.asyncio
+async def test_cold_sync_moves_on_when_peer_or_requesters_leave(manager):
+    (old, other), (joiner,) = await _cold_session(manager, 2, 1)
+    await manager.handle_frame(joiner, "s1", b"\x00")
+    manager.disconnect(old, "s1")
+    assert manager._syncs["s1"].peer is manager._sessions["s1"][other]
+    manager.disconnect(joiner, "s1")
+    assert "s1" not in manager._syncs
+    manager.disconnect(other, "s1")
+
+
+@pytest.mark.asyncio
+async def test_cold_sync_reply_skips_requesters_that_left(manager):
+    (old,), (stays, leaves) = await _cold_session(manager, 1, 2)
+    await manager.handle_frame(stays, "s1", b"\x00")
+    await manager.handle_frame(leaves, "s1", b"\x00")
+    manager.disconnect(leaves, "s1")
+    manager.disconnect(old, "s1")  # no peer left to ask
+    assert "s1" not in manager._syncs
+    (old,), (joiner,) = await _cold_session(manager, 1, 1)
+    await manager.handle_frame(joiner, "s1", b"\x00")
+    manager._syncs["s1"].requesters.add(leaves)
+    await manager.handle_frame(old, "s1", b"\x08" + yjs_update("Once"))
+    assert "s1" not in manager._syncs
+
+
+@pytest.mark.asyncio
+async def test_handle_frame_sync_request_from_unknown_socket_ignored(manager):
+    await manager.handle_frame(mock_ws(), "s1", b"\x00")
+    assert "s1" not in manager._sessions
+
+
+@pytest.mark.asyncio
+async def test_document_outlives_connections(manager):
+    ws = mock_ws()
+    await manager.connect(ws, "s1")
+    await manager.handle_frame(ws, "s1", b"\x01" + yjs_update("Once"))
+    manager.disconnect(ws, "s1")
+    rejoin = mock_ws()
+    await manager.connect(rejoin, "s1")
+    await manager.handle_frame(rejoin, "s1", b"\x00")
+    await manager.flush()
+    assert rejoin.send_bytes.call_args[0][0][0] == 0x01
+
+
+@pytest.mark.asyncio
+async def test_handle_frame_other_types_relayed(manager):
+    ws1, ws2 = mock_ws(), mock_ws()
+    await manager.connect(ws1, "s1")
+    await manager.connect(ws2, "s1")
+    await manager.handle_frame(ws1, "s1", b"hello")
+    await manager.flush()
+    ws2.send_bytes.assert_called_once_with(b"hello")
+    assert "s1" not in manager._docs
+
+
+@pytest.mark.asyncio
+async def test_coalescing_merges_burst_into_one_frame():
+    from pycrdt import Doc, Text
+
+    manager = ConnectionManager(coalesce_window_ms=10)
+    sender, peer = mock_ws(), mock_ws()
+    await manager.connect(sender, "s1")
+    await manager.connect(peer, "s1")
+    doc = Doc()
+    updates = []
+    doc.observe(lambda event: updates.append(event.update))
+    text = doc.get("t", type=Text)
+    for ch in "Once":
+        text += ch
+    for update in updates:
+        await manager.handle_frame(sender, "s1", b"\x01" + update)
+    peer.send_bytes.assert_not_called()
+    await asyncio.sleep(0.05)
+    await manager.flush()
+    peer.send_bytes.assert_called_once()
+    sender.send_bytes.assert_not_called()
+    replica = Doc()
+    replica.apply_update(peer.send_bytes.call_args[0][0][1:])
+    assert str(replica.get("t", type=Text)) == "Once"
+
+
+@pytest.mark.asyncio
+async def test_coalescing_byte_cap_flushes_immediately():
+    manager = ConnectionManager(coalesce_window_ms=10_000, coalesce_max_bytes=1)
+    sender, peer = mock_ws(), mock_ws()
+    await manager.connect(sender, "s1")
+    await manager.connect(peer, "s1")
+    frame = b"\x01" + yjs_update("Once")
+    await manager.handle_frame(sender, "s1", frame)
+    assert "s1" not in manager._pending
+    await manager.flush()
+    peer.send_bytes.assert_called_once_with(frame)
+
+
+@pytest.mark.asyncio
+async def test_coalescing_several_senders_sent_to_everyone():
+    manager = ConnectionManager(coalesce_window_ms=10_000)
+    ws1, ws2 = mock_ws(), mock_ws()
+    await manager.connect(ws1, "s1")
+    await manager.connect(ws2, "s1")
+    await manager.handle_frame(ws1, "s1", b"\x01" + yjs_update("Once"))
+    await manager.handle_frame(ws2, "s1", b"\x01" + yjs_update("upon"))
+    await manager.flush()
+    assert ws1.send_bytes.call_count == 1
+    assert ws2.send_bytes.call_count == 1
+    assert ws1.send_bytes.call_args == ws2.send_bytes.call_args
+
+
+@pytest.mark.asyncio
+async def test_flush_updates_unknown_session_no_op(manager):
+    manager._flush_updates("nonexistent")
+    assert manager._pending == {}
+
+
+@pytest.mark.asyncio
+async def test_updates_persisted_and_cold_session_reloaded(tmp_path):
+    from session_store import FileSessionStore
+
+    store = FileSessionStore(tmp_path)
+    manager = ConnectionManager(store=store)
+    ws = mock_ws()
+    await manager.connect(ws, "s1")
+    update = yjs_update("Once")
+    await manager.handle_frame(ws, "s1", b"\x01" + update)
+    await manager.handle_frame(ws, "s1", b"\x01garbage")
+    assert store.load("s1") == (None, [update])
+
+    restarted = ConnectionManager(store=store)
+    rejoin = mock_ws()
+    await restarted.connect(rejoin, "s1")
+    assert restarted._state["s1"].log_count == 1
+    await restarted.handle_frame(rejoin, "s1", b"\x00")
+    await restarted.flush()
+    assert rejoin.send_bytes.call_args[0][0] == b"\x01" + restarted.document("s1").encode_state()
+    await restarted.handle_frame(rejoin, "s1", b"\x01" + yjs_update("upon"))
+    manager.disconnect(ws, "s1")
+    restarted.disconnect(rejoin, "s1")
+    await restarted.stop()  # writes the buffered append and closes the store
+    assert store._closed and len(store._buffers) == 0 and len(store.load("s1")[1]) == 2
+
+
+@pytest.mark.asyncio
+async def test_client_traffic_recorded_per_session(tmp_path):
+    from session_recorder import RECORD_FRAME, RECORD_JOIN, RECORD_LEAVE, TrafficRecorder, read_recording
+
+    recorder = TrafficRecorder(tmp_path)
+    manager = ConnectionManager(recorder=recorder)
+    ws1, ws2 = mock_ws(), mock_ws()
+    await manager.connect(ws1, "s1")
+    await manager.connect(ws2, "s1", compress=True)
+    await manager.handle_frame(ws1, "s1", b"\x7fhello")
+    await manager.handle_frame(mock_ws(), "s1", b"\x7fstranger")
+    manager.disconnect(ws1, "s1")
+    manager.disconnect(ws2, "s1")
+    assert "s1" not in recorder._files
+    await manager.connect(ws1, "s1")
+    await manager.stop()
+    assert not recorder._files
+    _session, records = read_recording(recorder.path("s1"))
+    assert [(kind, payload) for _t, kind, _c, payload in records] == [
+        (RECORD_JOIN, b""),
+        (RECORD_JOIN, b"deflate"),
+        (RECORD_FRAME, b"\x7fhello"),
+        (RECORD_LEAVE, b""),
+        (RECORD_LEAVE, b""),
+        (RECORD_JOIN, b""),
+    ]
+    assert records[0][2] == records[2][2] == records[3][2] != records[1][2]
+
+
+@pytest.mark.asyncio
+async def test_cold_session_reloads_snapshot_once(tmp_path):
+    from session_store import FileSessionStore
+
+    store = FileSessionStore(tmp_path)
+    for update in (yjs_update("Once"), yjs_update("upon")):
+        store.append("s1", update)
+    store.compact("s1")
+    manager = ConnectionManager(store=store)
+    ws1, ws2 = mock_ws(), mock_ws()
+    await asyncio.gather(manager.connect(ws1, "s1"), manager.connect(ws2, "s1"))
+    assert not manager.document("s1").is_empty()
+    assert manager._state["s1"].log_count == 0
+    manager.disconnect(ws1, "s1")
+    manager.disconnect(ws2, "s1")
+
+
+@pytest.mark.asyncio
+async def test_log_compacted_in_background_after_threshold(tmp_path):
+    from session_store import FileSessionStore
+
+    store = FileSessionStore(tmp_path)
+    manager = ConnectionManager(store=store, compact_max_updates=2)
+    ws = mock_ws()
+    await manager.connect(ws, "s1")
+    await manager.handle_frame(ws, "s1", b"\x01" + yjs_update("Once"))
+    await manager.handle_frame(ws, "s1", b"\x01" + yjs_update("upon"))
+    assert manager._state["s1"].compacting
+    await asyncio.gather(*manager._background)
+    snapshot, tail = store.load("s1")
+    assert snapshot and tail == []
+    assert not manager._state["s1"].compacting
+    manager.disconnect(ws, "s1")
+
+
+@pytest.mark.asyncio
+async def test_compaction_failure_is_retried_later(tmp_path):
+    from session_store import FileSessionStore
+
+    store = FileSessionStore(tmp_path)
+    store.compact = MagicMock(side_effect=OSError("disk full"))
+    manager = ConnectionManager(store=store, compact_max_bytes=1)
+    ws = mock_ws()
+    await manager.connect(ws, "s1")
+    await manager.handle_frame(ws, "s1", b"\x01" + yjs_update("Once"))
+    await asyncio.gather(*manager._background)
+    assert not manager._state["s1"].compacting
+    assert store.load("s1")[1]
+    manager.disconnect(ws, "s1")
+
+
+@pytest.mark.asyncio
+async def test_large_frames_compressed_once_for_capable_peers():
+    from ws_protocol import compress_frame, decompress_frame
+
+    manager = ConnectionManager(compress_min_bytes=100)
+    sender, plain, zipped1, zipped2 = mock_ws(), mock_ws(), mock_ws(), mock_ws()
+    await manager.connect(sender, "s1")
+    await manager.connect(plain, "s1")
+    await manager.connect(zipped1, "s1", compress=True)
+    await manager.connect(zipped2, "s1", compress=True)
+    big = b"x" * 500
+    await manager.broadcast_to_session("s1", b"small", exclude=sender)
+    await manager.broadcast_to_session("s1", big, exclude=sender)
+    await manager.flush()
+    plain.send_bytes.assert_called_with(big)
+    zipped1.send_bytes.assert_any_call(b"small")
+    assert zipped1.send_bytes.call_args[0][0] == compress_frame(big)
+    assert decompress_frame(zipped2.send_bytes.call_args[0][0]) == big
+
+
+@pytest.mark.asyncio
+async def test_sync_reply_compressed_for_capable_client():
+    from ws_protocol import decompress_frame
+
+    manager = ConnectionManager(compress_min_bytes=10)
+    writer = mock_ws()
+    joiner = mock_ws()
+    await manager.connect(writer, "s1")
+    await manager.handle_frame(writer, "s1", b"\x01" + yjs_update("Once upon a time"))
+    await manager.connect(joiner, "s1", compress=True)
+    await manager.handle_frame(joiner, "s1", b"\x00")
+    await manager.flush()
+    reply = joiner.send_bytes.call_args[0][0]
+    assert reply[0] == 0x02
+    assert decompress_frame(reply) == b"\x01" + manager.document("s1").encode_state()
+
+
+@pytest.mark.asyncio
+async def test_compressed_client_frame_inflated_and_applied(manager):
+    from ws_protocol import compress_frame
+
+    ws1, ws2 = mock_ws(), mock_ws()
+    await manager.connect(ws1, "s1", compress=True)
+    await manager.connect(ws2, "s1")
+    frame = b"\x01" + yjs_update("Once")
+    await manager.handle_frame(ws1, "s1", compress_frame(frame))
+    await manager.flush()
+    ws2.send_bytes.assert_called_once_with(frame)
+    assert not manager.document("s1").is_empty()
+
+
+@pytest.mark.asyncio
+async def test_invalid_or_nested_compressed_frames_dropped(manager):
+    from ws_protocol import compress_frame
+
+    ws1, ws2 = mock_ws(), mock_ws()
+    await manager.connect(ws1, "s1")
+    await manager.connect(ws2, "s1")
+    await manager.handle_frame(ws1, "s1", b"\x02garbage")
+    await manager.handle_frame(ws1, "s1", compress_frame(compress_frame(b"\x01x")))
+    await manager.flush()
+    ws2.send_bytes.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_connection_limit_per_session():
+    from ws_manager import CLOSE_SESSION_FULL
+
+    manager = ConnectionManager(max_connections_per_session=1)
+    ws1, ws2, other = mock_ws(), mock_ws(), mock_ws()
+    ws2.close = AsyncMock()
+    assert await manager.connect(ws1, "s1") is True
+    assert await manager.connect(ws2, "s1") is False
+    ws2.close.assert_called_once_with(code=CLOSE_SESSION_FULL)
+    assert ws2 not in manager._sessions["s1"]
+    assert await manager.connect(other, "s2") is True
+
+
+@pytest.mark.asyncio
+async def test_global_connection_limit():
+    manager = ConnectionManager(max_connections=1)
+    ws1, ws2 = mock_ws(), mock_ws()
+    ws2.close = AsyncMock()
+    assert await manager.connect(ws1, "s1") is True
+    assert await manager.connect(ws2, "s2") is False
+    manager.disconnect(ws1, "s1")
+    assert not manager._connections
+
+
+@pytest.mark.asyncio
+async def test_buffered_bytes_budget_applies_slow_consumer_policy():
+    manager = ConnectionManager(slow_consumer_policy=SLOW_CONSUMER_DROP, max_buffered_bytes_per_session=10)
+    slow = stalled_ws()
+    await manager.connect(slow, "s1")
+    await manager.broadcast_to_session("s1", b"x" * 8)
+    await asyncio.sleep(0)  # in flight, no longer buffered
+    await manager.broadcast_to_session("s1", b"x" * 8)  # idle queue always takes one frame
+    await manager.broadcast_to_session("s1", b"x" * 8)  # over the session budget
+    conn = manager._sessions["s1"][slow]
+    assert conn.dropped == 1
+    assert conn.buffered == 8
+    assert manager.stats()["buffered_bytes"] == 8
+    manager.disconnect(slow, "s1")
+    assert manager.stats()["buffered_bytes"] == 0
+
+
+@pytest.mark.asyncio
+async def test_global_buffered_bytes_budget():
+    manager = ConnectionManager(slow_consumer_policy=SLOW_CONSUMER_COALESCE, max_buffered_bytes=10)
+    slow = stalled_ws()
+    await manager.connect(slow, "s1")
+    await manager.broadcast_to_session("s1", b"a")
+    await asyncio.sleep(0)
+    await manager.broadcast_to_session("s1", b"x" * 8)
+    await manager.broadcast_to_session("s1", b"y" * 8)
+    conn = manager._sessions["s1"][slow]
+    assert conn.dropped == 1
+    assert conn.queue.qsize() == 1
+    manager.disconnect(slow, "s1")
+
+
+@pytest.mark.asyncio
+async def test_evict_idle_drops_replicas_without_connections():
+    manager = ConnectionManager(session_idle_ttl=60)
+    ws = mock_ws()
+    await manager.connect(ws, "busy")
+    await manager.handle_frame(ws, "busy", b"\x01" + yjs_update("Once"))
+    idle = mock_ws()
+    await manager.connect(idle, "idle")
+    await manager.handle_frame(idle, "idle", b"\x01" + yjs_update("Once"))
+    manager.disconnect(idle, "idle")
+    now = manager._state["idle"].last_active
+    assert manager.evict_idle(now + 30) == 0
+    assert manager.evict_idle(now + 61) == 1
+    assert "idle" not in manager._docs and "idle" not in manager.stats()["per_session"]
+    assert "busy" in manager._docs
+    manager.disconnect(ws, "busy")
+
+
+@pytest.mark.asyncio
+async def test_evict_idle_skips_compacting_sessions():
+    manager = ConnectionManager(session_idle_ttl=0)
+    manager.document("s1")
+    manager._state["s1"].compacting = True
+    assert manager.evict_idle() == 0
+    manager._state["s1"].compacting = False
+    assert manager.evict_idle() == 1
+
+
+@pytest.mark.asyncio
+async def test_stats_reports_sessions_and_memory(manager):
+    ws1, ws2 = mock_ws(), mock_ws()
+    await manager.connect(ws1, "s1")
+    await manager.connect(ws2, "s1")
+    update = yjs_update("Once")
+    await manager.handle_frame(ws1, "s1", b"\x01" + update)
+    stats = manager.stats()
+    assert stats["sessions"] == 1
+    assert stats["documents"] == 1
+    assert stats["connections"] == 2
+    assert stats["per_session"]["s1"]["connections"] == 2
+    assert stats["per_session"]["s1"]["doc_bytes"] == len(update)
+    await manager.flush()
+    manager.disconnect(ws1, "s1")
+    manager.disconnect(ws2, "s1")
+    assert manager.stats()["connections"] == 0
+
+
+@pytest.mark.asyncio
+async def test_start_runs_idle_sweeper():
+    from unittest.mock import patch
+
+    manager = ConnectionManager(session_idle_ttl=0)
+    manager.document("s1")
+    with patch("ws_manager.SWEEP_INTERVAL", 0.01):
+        await manager.start()
+        await asyncio.sleep(0.05)
+        await manager.stop()
+    assert "s1" not in manager._docs
+    await manager.stop()
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_pings_quiet_connections_and_reaps_silent_ones():
+    manager = ConnectionManager(heartbeat_interval=20, heartbeat_timeout=60, queue_size=2)
+    quiet, busy, chatty, stuck = mock_ws(), mock_ws(), mock_ws(), mock_ws()
+    for ws in (quiet, busy, chatty, stuck):
+        await manager.connect(ws, "s1")
+    conns = manager._sessions["s1"]
+    now = conns[busy].last_seen
+    busy.close = AsyncMock()
+    manager._put(conns[busy], b"in flight")
+    manager._put(conns[stuck], b"in flight")
+    manager._put(conns[stuck], b"in flight")
+    conns[chatty].last_seen = now + 15
+    assert manager.heartbeat(now + 20) == 0
+    assert conns[quiet].queue.get_nowait() == b"\x03"
+    # A receive-only client behind frames in flight is pinged too
+    assert [conns[busy].queue.get_nowait() for _ in range(2)] == [b"in flight", b"\x03"]
+    assert conns[chatty].queue.empty()
+    timeouts = metrics.WS_HEARTBEAT_TIMEOUTS.value()
+    assert manager.heartbeat(now + 60) == 2
+    # stuck's queue was full, so it was never pinged and is not reaped
+    assert list(manager._sessions["s1"]) == [chatty, stuck]
+    assert metrics.WS_HEARTBEAT_TIMEOUTS.value() == timeouts + 2
+    await asyncio.sleep(0)
+    busy.close.assert_awaited_once_with(code=CLOSE_HEARTBEAT_TIMEOUT)
+    manager.disconnect(chatty, "s1")
+    manager.disconnect(stuck, "s1")
+
+
+@pytest.mark.asyncio
+async def test_client_ping_is_answered_and_not_relayed(manager):
+    ws1, ws2 = mock_ws(), mock_ws()
+    await manager.connect(ws1, "s1")
+    await manager.connect(ws2, "s1")
+    manager._sessions["s1"][ws1].last_seen = 0
+    await manager.handle_frame(ws1, "s1", b"\x03")
+    await manager.handle_frame(ws1, "s1", b"\x04")
+    assert manager._sessions["s1"][ws1].last_seen > 0
+    await manager.handle_frame(mock_ws(), "s1", b"\x03")  # unknown socket: ignored
+    await manager.flush()
+    ws1.send_bytes.assert_awaited_once_with(b"\x04")
+    ws2.send_bytes.assert_not_called()
+    manager.disconnect(ws1, "s1")
+    manager.disconnect(ws2, "s1")
+
+
+@pytest.mark.asyncio
+async def test_start_runs_heartbeat_unless_disabled():
+    manager = ConnectionManager(heartbeat_interval=0.01, heartbeat_timeout=0.02)
+    ws = mock_ws()
+    await manager.connect(ws, "s1")
+    await manager.start()
+    await asyncio.sleep(0.1)
+    await manager.stop()
+    assert "s1" not in manager._sessions
+    disabled = ConnectionManager(heartbeat_interval=0)
+    await disabled.start()
+    assert disabled._heartbeat is None
+    await disabled.stop()
+
+
+def _limited(policy, **limits):
+    options = {
+        "ingress_frames_per_sec": 0,
+        "ingress_bytes_per_sec": 0,
+        "session_ingress_frames_per_sec": 0,
+        "session_ingress_bytes_per_sec": 0,
+    }
+    options.update(limits)
+    return ConnectionManager(ingress_policy=policy, **options)
+
+
+@pytest.mark.asyncio
+async def test_oversized_frames_dropped_or_closed():
+    manager = _limited(INGRESS_DROP, max_frame_bytes=8)
+    sender, peer = mock_ws(), mock_ws()
+    await manager.connect(sender, "s1")
+    await manager.connect(peer, "s1")
+    dropped = metrics.WS_INGRESS_LIMITED.value(("frame_size", "drop"))
+    await manager.handle_frame(sender, "s1", b"\x7f" + b"x" * 8)
+    await manager.handle_frame(sender, "s1", b"\x7fsmall")
+    await manager.flush()
+    peer.send_bytes.assert_called_once_with(b"\x7fsmall")
+    assert manager._sessions["s1"][sender].rejected == 1
+    assert metrics.WS_INGRESS_LIMITED.value(("frame_size", "drop")) == dropped + 1
+
+    manager = _limited(INGRESS_CLOSE, max_frame_bytes=8)
+    sender = mock_ws()
+    sender.close = AsyncMock()
+    await manager.connect(sender, "s1")
+    await manager.handle_frame(sender, "s1", b"\x7f" + b"x" * 8)
+    await asyncio.sleep(0)
+    sender.close.assert_awaited_once_with(code=CLOSE_FRAME_TOO_LARGE)
+    assert "s1" not in manager._sessions
+
+
+@pytest.mark.asyncio
+async def test_compressed_frames_limited_by_inflated_size():
+    from ws_protocol import compress_frame
+
+    manager = _limited(INGRESS_DROP, max_frame_bytes=1024, ingress_bytes_per_sec=1000)
+    sender, peer = mock_ws(), mock_ws()
+    await manager.connect(sender, "s1")
+    await manager.connect(peer, "s1")
+    bomb = compress_frame(b"\x7f" + b"x" * 10_000)
+    assert len(bomb) < 100
+    await manager.handle_frame(sender, "s1", bomb)
+    # Under the cap, but the inflated bytes empty the byte bucket (2000 tokens of burst)
+    fits = b"\x7f" + b"y" * 1000
+    await manager.handle_frame(sender, "s1", compress_frame(fits))
+    await manager.handle_frame(sender, "s1", compress_frame(fits))
+    await manager.handle_frame(sender, "s1", b"\x02not zlib")
+    await manager.flush()
+    assert [c.args[0] for c in peer.send_bytes.call_args_list] == [fits]
+    assert manager._sessions["s1"][sender].rejected == 2
+
+    manager = _limited(INGRESS_CLOSE, max_frame_bytes=1024)
+    sender = mock_ws()
+    sender.close = AsyncMock()
+    await manager.connect(sender, "s1")
+    await manager.handle_frame(sender, "s1", bomb)
+    await asyncio.sleep(0)
+    sender.close.assert_awaited_once_with(code=CLOSE_FRAME_TOO_LARGE)
+    await manager.handle_frame(sender, "s1", bomb)  # no longer connected: dropped quietly
+
+
+@pytest.mark.asyncio
+async def test_connection_rate_limit_drops_frames():
+    manager = _limited(INGRESS_DROP, ingress_frames_per_sec=1, session_ingress_bytes_per_sec=1000)
+    sender, peer = mock_ws(), mock_ws()
+    await manager.connect(sender, "s1")
+    await manager.connect(peer, "s1")
+    for i in range(4):
+        await manager.handle_frame(sender, "s1", b"\x7f%d" % i)
+    await manager.flush()
+    # Burst of INGRESS_BURST_SECONDS (2) frames, the rest dropped
+    assert [c.args[0] for c in peer.send_bytes.call_args_list] == [b"\x7f0", b"\x7f1"]
+    assert manager._sessions["s1"][sender].rejected == 2
+
+
+@pytest.mark.asyncio
+async def test_session_rate_limit_closes_offender():
+    manager = _limited(INGRESS_CLOSE, session_ingress_bytes_per_sec=4)
+    a, b = mock_ws(), mock_ws()
+    b.close = AsyncMock()
+    await manager.connect(a, "s1")
+    await manager.connect(b, "s1")
+    await manager.handle_frame(a, "s1", b"\x7fabcde")
+    await manager.handle_frame(b, "s1", b"\x7fabc")
+    await asyncio.sleep(0)
+    b.close.assert_awaited_once_with(code=CLOSE_RATE_LIMITED)
+    assert list(manager._sessions["s1"]) == [a]
+
+
+@pytest.mark.asyncio
+async def test_delay_policy_holds_frames_until_bucket_refills():
+    manager = _limited(INGRESS_DELAY, ingress_frames_per_sec=10)
+    sender, peer = mock_ws(), mock_ws()
+    await manager.connect(sender, "s1")
+    await manager.connect(peer, "s1")
+    start = asyncio.get_running_loop().time()
+    for i in range(23):
+        await manager.handle_frame(sender, "s1", b"\x7f%d" % i)
+    # 20 frames of burst, then three more at 10 frames/s
+    assert asyncio.get_running_loop().time() - start >= 0.2
+    await manager.flush()
+    assert peer.send_bytes.call_count == 23
+    # A client that leaves while its frame is held never gets it relayed
+    task = asyncio.create_task(manager.handle_frame(sender, "s1", b"\x7flate"))
+    await asyncio.sleep(0)
+    manager.disconnect(sender, "s1")
+    await task
+    await manager.flush()
+    assert peer.send_bytes.call_count == 23
+    manager.disconnect(peer, "s1")
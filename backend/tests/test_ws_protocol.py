@@ -0,0 +1,67 @@
+"""
+Unit tests for ws_protocol.
+"""
+
+from pycrdt import Doc, Text
+
+from tests.conftest import yjs_updates
+from ws_protocol import SYNC_REQUEST, SYNC_UPDATE, coalesce_frames, frame_type
+
+
+def test_frame_type():
+    assert frame_type(b"") is None
+    assert frame_type(b"\x00") == SYNC_REQUEST
+    assert frame_type(b"\x01abc") == SYNC_UPDATE
+
+
+def test_coalesce_frames_merges_updates_and_keeps_others():
+    updates = yjs_updates("Once", " upon", " a time")
+    frames = [b"\x01" + u for u in updates]
+    frames.insert(1, b"\x00")
+    out = coalesce_frames(frames)
+    assert len(out) == 2
+    assert out[1] == b"\x00"
+    replica = Doc()
+    replica.apply_update(out[0][1:])
+    assert str(replica.get("t", type=Text)) == "Once upon a time"
+
+
+def test_coalesce_frames_single_update_unchanged():
+    updates = yjs_updates("Once")
+    frames = [b"\x00", b"\x01" + updates[0]]
+    assert coalesce_frames(frames) == frames
+
+
+def test_coalesce_frames_unmergeable_unchanged():
+    frames = [b"\x01garbage", b"\x01more"]
+    assert coalesce_frames(frames) == frames
+
+
+def test_compress_roundtrip():
+    from ws_protocol import COMPRESSED, compress_frame, decompress_frame
+
+    frame = b"\x01" + b"once upon a time " * 100
+    packed = compress_frame(frame)
+    assert packed[0] == COMPRESSED
+    assert len(packed) < len(frame)
+    assert decompress_frame(packed) == frame
+
+
+def test_decompress_rejects_corrupt_frame():
+    import pytest
+
+    from ws_protocol import decompress_frame
+
+    with pytest.raises(ValueError):
+        decompress_frame(b"\x02not zlib")
+
+
+def test_decompress_rejects_oversized_frame():
+    import pytest
+
+    from ws_protocol import FrameTooLarge, compress_frame, decompress_frame
+
+    with pytest.raises(FrameTooLarge):
+        decompress_frame(compress_frame(b"\x01" + b"x" * 1000), max_size=100)
+    with pytest.raises(ValueError):
+        decompress_frame(compress_frame(b"\x01" + b"x" * 1000)[:-4])
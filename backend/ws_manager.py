@@ -1,45 +1,960 @@
 """
 WebSocket connection manager for story sessions.
 Broadcasts every message from one client to all others in the same session.
+Keeps a server-side Yjs replica per session so sync requests are answered here;
+while the replica is cold they go to one elected peer instead of the whole session.
+Each connection has its own bounded outbound queue drained by a writer task,
+so a slow or stalled peer never holds up the rest of the session.
+Bursty Yjs updates can optionally be coalesced per session into one frame.
+With a SessionStore configured, updates are also persisted and cold sessions reload from disk.
+With a SessionBus configured, frames also reach clients of the same session on other workers.
+Connection counts and queued bytes are bounded, and idle sessions are evicted after a TTL.
+Quiet connections are pinged, and ones that stop answering are reaped.
+Awareness (presence) frames are throttled per session and only sent when a peer's queue is idle.
+Client frames pass size and token-bucket rate limits (per connection and per session) before any fan-out.
+Story generation requests are handed to a registered handler (see story_stream).
+With a TrafficRecorder configured, client traffic is logged per session for replay.
 """
 
-from collections import defaultdict
-from typing import DefaultDict
+import asyncio
+import itertools
+import os
+import time
+from typing import Callable
 
 from fastapi import WebSocket
 
+import metrics
+from session_awareness import (
+    AwarenessEntries,
+    SessionAwareness,
+    decode_awareness,
+    encode_awareness,
+    parse_client_state,
+)
+from rate_limit import TokenBucket
+from session_bus import SessionBus, UnixSocketBus
+from session_doc import SessionDoc
+from session_recorder import TrafficRecorder, open_recorder
+from session_store import COMPACT_MAX_BYTES, COMPACT_MAX_UPDATES, SessionStore, open_store
+from ws_protocol import (
+    AWARENESS,
+    COMPRESS_MIN_BYTES,
+    COMPRESSED,
+    GENERATE,
+    PING,
+    PONG,
+    SYNC_REPLY,
+    SYNC_REQUEST,
+    SYNC_UPDATE,
+    coalesce_frames,
+    FrameTooLarge,
+    compress_frame,
+    decompress_frame,
+    frame_type,
+)
+
+SEND_QUEUE_SIZE = 256
+
+# What to do when a peer's outbound queue is full
+SLOW_CONSUMER_DROP = "drop"
+SLOW_CONSUMER_DISCONNECT = "disconnect"
+SLOW_CONSUMER_COALESCE = "coalesce"
+SLOW_CONSUMER_POLICIES = (SLOW_CONSUMER_DROP, SLOW_CONSUMER_DISCONNECT, SLOW_CONSUMER_COALESCE)
+
+# Update coalescing: 0 disables it, otherwise updates are buffered this long
+COALESCE_WINDOW_MS = 0
+COALESCE_MAX_BYTES = 32 * 1024
+
+# Directory or *.db file for durable sessions; empty keeps sessions in memory only
+SESSION_STORE_PATH = os.environ.get("SAFETALE_SESSION_STORE", "")
+
+# Unix socket shared by all uvicorn workers; empty runs a single-worker manager
+SESSION_BUS_PATH = os.environ.get("SAFETALE_SESSION_BUS", "")
+
+# Directory for traffic recordings (see scripts/ws_replay.py); empty disables recording
+RECORD_PATH = os.environ.get("SAFETALE_RECORD_DIR", "")
+
+# Connections over a limit are refused with CLOSE_SESSION_FULL
+MAX_CONNECTIONS = 10_000
+MAX_CONNECTIONS_PER_SESSION = 100
+# Bytes waiting in outbound queues; past a budget the slow-consumer policy applies
+MAX_BUFFERED_BYTES = 256 * 1024 * 1024
+MAX_BUFFERED_BYTES_PER_SESSION = 8 * 1024 * 1024
+# Sessions without connections are dropped from memory after this many seconds
+SESSION_IDLE_TTL = 30 * 60
+SWEEP_INTERVAL = 60
+# A connection silent for HEARTBEAT_INTERVAL seconds is pinged; one silent for
+# HEARTBEAT_TIMEOUT is closed with CLOSE_HEARTBEAT_TIMEOUT. 0 disables heartbeats.
+HEARTBEAT_INTERVAL = 20
+HEARTBEAT_TIMEOUT = 60
+
+# Awareness diffs go out at most this many times per second per session
+AWARENESS_HZ = 10
+AWARENESS_MAX_BYTES = 4096
+
+# How long an elected peer has to answer a sync request before the next peer is asked
+SYNC_PEER_TIMEOUT = 2.0
+
+# Ingress limits on client frames; a rate of 0 disables that limit.
+# Buckets hold INGRESS_BURST_SECONDS worth of tokens, so short bursts (a paste) pass untouched.
+MAX_FRAME_BYTES = 2 * 1024 * 1024
+INGRESS_FRAMES_PER_SEC = 100
+INGRESS_BYTES_PER_SEC = 1024 * 1024
+SESSION_INGRESS_FRAMES_PER_SEC = 1000
+SESSION_INGRESS_BYTES_PER_SEC = 4 * 1024 * 1024
+INGRESS_BURST_SECONDS = 2.0
+
+# What to do with a frame over an ingress limit. "delay" holds the client's receive
+# loop until the bucket refills (oversized frames are dropped); the others act at once.
+INGRESS_DELAY = "delay"
+INGRESS_DROP = "drop"
+INGRESS_CLOSE = "close"
+INGRESS_POLICIES = (INGRESS_DELAY, INGRESS_DROP, INGRESS_CLOSE)
+
+# "Try again later": the client reconnects and resyncs from scratch
+CLOSE_SLOW_CONSUMER = 1013
+CLOSE_FRAME_TOO_LARGE = 1009
+CLOSE_SESSION_FULL = 4001
+CLOSE_HEARTBEAT_TIMEOUT = 4002
+CLOSE_RATE_LIMITED = 4003
+
+# Frames the server handles itself; they are never relayed to peers
+SERVER_FRAMES = (PING, PONG, AWARENESS, SYNC_REQUEST, GENERATE, SYNC_REPLY)
+
+PING_FRAME = bytes([PING])
+PONG_FRAME = bytes([PONG])
+
+_connection_ids = itertools.count(1)
+
+# Catch-up between workers: a bus 0x00 is flag + requester id + state vector, and the
+# answer is a 0x08 addressed to that requester, so only its own clients receive the diff
+BUS_ID_BYTES = 8
+RESYNC_ANSWER_ONLY = 0
+RESYNC_ASK_BACK = 1
+EMPTY_UPDATE = b"\x00\x00"
+
+GenerateHandler = Callable[[str, WebSocket, bytes], None]
+
+
+# Per-socket state touched on every frame, kept as plain attributes
+class Connection:  # pylint: disable=too-many-instance-attributes
+    """A client socket with its own outbound queue and writer task."""
+
+    def __init__(self, websocket: WebSocket, session_id: str, queue_size: int, compress: bool = False) -> None:
+        self.id = next(_connection_ids)
+        self.websocket = websocket
+        self.session_id = session_id
+        self.compress = compress
+        self.queue: asyncio.Queue[bytes] = asyncio.Queue(maxsize=queue_size)
+        self.writer: asyncio.Task | None = None
+        self.buffered = 0
+        self.dropped = 0
+        self.last_seen = time.monotonic()
+        self.pinged_at = 0.0
+        # Unique across workers on one machine, so it can travel over the session bus
+        self.awareness_key = f"{os.getpid()}.{self.id}"
+        # Awareness entries waiting for the queue to go idle
+        self.awareness: AwarenessEntries = {}
+        self.frame_bucket: TokenBucket | None = None
+        self.byte_bucket: TokenBucket | None = None
+        self.rejected = 0
+
+
+class PendingUpdates:
+    """Update frames buffered for one session during a coalescing window."""
+
+    def __init__(self) -> None:
+        self.frames: list[bytes] = []
+        self.senders: set[WebSocket] = set()
+        self.size = 0
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class PendingSync:
+    """Sync requests waiting on one elected peer while the session's replica is cold."""
+
+    def __init__(self) -> None:
+        self.requesters: set[WebSocket] = set()
+        self.peer: Connection | None = None
+        self.tried: set[int] = set()
+        self.timer: asyncio.TimerHandle | None = None
+
+
+# Counters and ingress buckets of one session, updated in place on the hot path
+class SessionState:  # pylint: disable=too-many-instance-attributes
+    """Bookkeeping for one session: activity, memory and update-log growth since the last compaction."""
 
-class ConnectionManager:
     def __init__(self) -> None:
-        self._sessions: DefaultDict[str, list[WebSocket]] = defaultdict(list)
+        self.last_active = time.monotonic()
+        self.buffered = 0
+        self.doc_bytes = 0
+        self.log_count = 0
+        self.log_size = 0
+        self.compacting = False
+        self.frame_bucket: TokenBucket | None = None
+        self.byte_bucket: TokenBucket | None = None
 
-    async def connect(self, websocket: WebSocket, session_id: str) -> None:
+
+# Every limit is a keyword with a module default, so tests and workers override only what they need
+class ConnectionManager:  # pylint: disable=too-many-instance-attributes
+    def __init__(  # pylint: disable=too-many-arguments,too-many-locals
+        self,
+        *,
+        queue_size: int = SEND_QUEUE_SIZE,
+        slow_consumer_policy: str = SLOW_CONSUMER_COALESCE,
+        coalesce_window_ms: float = COALESCE_WINDOW_MS,
+        coalesce_max_bytes: int = COALESCE_MAX_BYTES,
+        store: SessionStore | None = None,
+        compact_max_updates: int = COMPACT_MAX_UPDATES,
+        compact_max_bytes: int = COMPACT_MAX_BYTES,
+        bus: SessionBus | None = None,
+        compress_min_bytes: int = COMPRESS_MIN_BYTES,
+        max_connections: int = MAX_CONNECTIONS,
+        max_connections_per_session: int = MAX_CONNECTIONS_PER_SESSION,
+        max_buffered_bytes: int = MAX_BUFFERED_BYTES,
+        max_buffered_bytes_per_session: int = MAX_BUFFERED_BYTES_PER_SESSION,
+        session_idle_ttl: float = SESSION_IDLE_TTL,
+        heartbeat_interval: float = HEARTBEAT_INTERVAL,
+        heartbeat_timeout: float = HEARTBEAT_TIMEOUT,
+        awareness_hz: float = AWARENESS_HZ,
+        awareness_max_bytes: int = AWARENESS_MAX_BYTES,
+        sync_peer_timeout: float = SYNC_PEER_TIMEOUT,
+        max_frame_bytes: int = MAX_FRAME_BYTES,
+        ingress_policy: str = INGRESS_DELAY,
+        ingress_frames_per_sec: float = INGRESS_FRAMES_PER_SEC,
+        ingress_bytes_per_sec: float = INGRESS_BYTES_PER_SEC,
+        session_ingress_frames_per_sec: float = SESSION_INGRESS_FRAMES_PER_SEC,
+        session_ingress_bytes_per_sec: float = SESSION_INGRESS_BYTES_PER_SEC,
+        recorder: TrafficRecorder | None = None,
+    ) -> None:
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {slow_consumer_policy}")
+        if ingress_policy not in INGRESS_POLICIES:
+            raise ValueError(f"Unknown ingress policy: {ingress_policy}")
+        self.queue_size = queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.coalesce_window_ms = coalesce_window_ms
+        self.coalesce_max_bytes = coalesce_max_bytes
+        self.store = store
+        self.compact_max_updates = compact_max_updates
+        self.compact_max_bytes = compact_max_bytes
+        self.bus = bus
+        self.compress_min_bytes = compress_min_bytes
+        self.max_connections = max_connections
+        self.max_connections_per_session = max_connections_per_session
+        self.max_buffered_bytes = max_buffered_bytes
+        self.max_buffered_bytes_per_session = max_buffered_bytes_per_session
+        self.session_idle_ttl = session_idle_ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.awareness_hz = awareness_hz
+        self.awareness_max_bytes = awareness_max_bytes
+        self.sync_peer_timeout = sync_peer_timeout
+        self.max_frame_bytes = max_frame_bytes
+        self.ingress_policy = ingress_policy
+        self.ingress_frames_per_sec = ingress_frames_per_sec
+        self.ingress_bytes_per_sec = ingress_bytes_per_sec
+        self.session_ingress_frames_per_sec = session_ingress_frames_per_sec
+        self.session_ingress_bytes_per_sec = session_ingress_bytes_per_sec
+        self.recorder = recorder
+        self._bus_id = os.urandom(BUS_ID_BYTES)
+        if bus is not None:
+            bus.set_handler(self._on_bus_frame, self._resync)
+        self._sessions: dict[str, dict[WebSocket, Connection]] = {}
+        self._docs: dict[str, SessionDoc] = {}
+        self._pending: dict[str, PendingUpdates] = {}
+        self._state: dict[str, SessionState] = {}
+        self._awareness: dict[str, SessionAwareness] = {}
+        self._syncs: dict[str, PendingSync] = {}
+        self._generate: GenerateHandler | None = None
+        self._connections: dict[int, Connection] = {}
+        self._buffered = 0
+        self._background: set[asyncio.Task] = set()
+        self._sweeper: asyncio.Task | None = None
+        self._heartbeat: asyncio.Task | None = None
+
+    def set_generate_handler(self, handler: GenerateHandler | None) -> None:
+        """Register the callback for 0x06 story generation requests: (session_id, websocket, payload)."""
+        self._generate = handler
+
+    async def start(self) -> None:
+        if self.bus is not None:
+            await self.bus.start()
+        self._sweeper = asyncio.create_task(self._sweep_loop())
+        if self.heartbeat_interval > 0:
+            self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        if self.bus is not None:
+            await self.bus.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.store is not None:
+            # Stops the store's writer thread after writing what it buffered
+            await asyncio.to_thread(self.store.close)
+
+    async def connect(self, websocket: WebSocket, session_id: str, compress: bool = False) -> bool:
+        """
+        Accept a client; with compress=True it receives large frames as 0x02 compressed frames.
+        Returns False (and closes the socket) when a connection limit is reached.
+        """
         await websocket.accept()
-        self._sessions[session_id].append(websocket)
+        if (
+            len(self._connections) >= self.max_connections
+            or len(self._sessions.get(session_id, ())) >= self.max_connections_per_session
+        ):
+            await self._close(websocket, CLOSE_SESSION_FULL)
+            return False
+        await self._load_document(session_id)
+        conn = Connection(websocket, session_id, self.queue_size, compress)
+        conn.frame_bucket = self._bucket(self.ingress_frames_per_sec)
+        conn.byte_bucket = self._bucket(self.ingress_bytes_per_sec)
+        state = self._session_state(session_id)
+        if session_id not in self._sessions:
+            state.frame_bucket = self._bucket(self.session_ingress_frames_per_sec)
+            state.byte_bucket = self._bucket(self.session_ingress_bytes_per_sec)
+        conn.writer = asyncio.create_task(self._write_loop(conn))
+        if session_id not in self._sessions and self.bus is not None:
+            self.bus.subscribe(session_id)
+            self._resync(session_id)
+        self._sessions.setdefault(session_id, {})[websocket] = conn
+        self._connections[conn.id] = conn
+        self._session_state(session_id).last_active = time.monotonic()
+        if self.recorder is not None:
+            self.recorder.join(session_id, conn.id, compress)
+        awareness = self._awareness.get(session_id)
+        if awareness is not None and awareness.states:
+            self._send_awareness(conn, dict(awareness.states))
+        return True
 
     def disconnect(self, websocket: WebSocket, session_id: str) -> None:
-        if session_id not in self._sessions:
+        """Remove a client in O(1); safe to call more than once for the same socket."""
+        conns = self._sessions.get(session_id)
+        if conns is None:
             return
-        self._sessions[session_id] = [ws for ws in self._sessions[session_id] if ws != websocket]
-        if not self._sessions[session_id]:
+        conn = conns.pop(websocket, None)
+        if conn is not None:
+            awareness = self._awareness.get(session_id)
+            if awareness is not None and awareness.set(conn.awareness_key, None):
+                self._schedule_awareness(session_id, awareness)
+            self._forget_sync(session_id, conn)
+            if self.recorder is not None:
+                self.recorder.leave(session_id, conn.id)
+        if not conns:
             del self._sessions[session_id]
+            if self.recorder is not None:
+                self.recorder.close_session(session_id)
+            # Tell other workers this worker's clients left, then forget the session's presence
+            self._flush_awareness(session_id)
+            self._awareness.pop(session_id, None)
+            if self.bus is not None:
+                self.bus.unsubscribe(session_id)
+        if conn is not None:
+            self._connections.pop(conn.id, None)
+            self._session_state(session_id).last_active = time.monotonic()
+            self._stop(conn)
+
+    def evict_idle(self, now: float | None = None) -> int:
+        """Drop replicas of sessions that have had no connections for session_idle_ttl seconds."""
+        now = time.monotonic() if now is None else now
+        evicted = 0
+        for session_id, state in list(self._state.items()):
+            if session_id in self._sessions or state.compacting:
+                continue
+            if now - state.last_active < self.session_idle_ttl:
+                continue
+            self._flush_updates(session_id)
+            self._docs.pop(session_id, None)
+            self._awareness.pop(session_id, None)
+            del self._state[session_id]
+            evicted += 1
+        return evicted
+
+    def heartbeat(self, now: float | None = None) -> int:
+        """Ping connections quiet for heartbeat_interval; reap pinged ones still silent after heartbeat_timeout."""
+        now = time.monotonic() if now is None else now
+        reaped = 0
+        for conn in list(self._connections.values()):
+            silent = now - conn.last_seen
+            # Only a connection pinged since it was last heard from has had the chance to answer
+            if silent >= self.heartbeat_timeout and conn.pinged_at >= conn.last_seen:
+                metrics.WS_HEARTBEAT_TIMEOUTS.inc()
+                self._evict(conn, conn.session_id, CLOSE_HEARTBEAT_TIMEOUT)
+                reaped += 1
+            elif silent >= self.heartbeat_interval and not conn.queue.full():
+                # Queued behind any frames in flight, so a receive-only client on a slow link is pinged too
+                self._put(conn, PING_FRAME)
+                conn.pinged_at = now
+        return reaped
+
+    def stats(self) -> dict:
+        """Cheap view of live sessions and their memory; nothing is encoded or copied."""
+        now = time.monotonic()
+        return {
+            "sessions": len(self._sessions),
+            "documents": len(self._docs),
+            "connections": len(self._connections),
+            "buffered_bytes": self._buffered,
+            "per_session": {
+                session_id: {
+                    "connections": len(self._sessions.get(session_id, ())),
+                    "buffered_bytes": state.buffered,
+                    "doc_bytes": state.doc_bytes,
+                    "idle_seconds": round(now - state.last_active, 1),
+                }
+                for session_id, state in self._state.items()
+            },
+        }
+
+    def is_connected(self, websocket: WebSocket, session_id: str) -> bool:
+        """False once the socket has disconnected or been evicted (its frames are then dropped)."""
+        return websocket in self._sessions.get(session_id, ())
+
+    def session_size(self, session_id: str) -> int:
+        """Number of clients connected to the session on this worker."""
+        return len(self._sessions.get(session_id, ()))
+
+    def send(self, websocket: WebSocket, session_id: str, data: bytes) -> None:
+        """Queue a frame for one client of the session; unknown sockets are ignored."""
+        conn = self._sessions.get(session_id, {}).get(websocket)
+        if conn is not None:
+            self._enqueue(conn, session_id, data)
+
+    def document(self, session_id: str) -> SessionDoc:
+        """Return the session's replica; it outlives its connections so a lone client can rejoin."""
+        doc = self._docs.get(session_id)
+        if doc is None:
+            doc = self._docs[session_id] = SessionDoc()
+            self._session_state(session_id)
+        return doc
+
+    async def handle_frame(self, websocket: WebSocket, session_id: str, data: bytes) -> None:
+        """Dispatch one client frame by its type byte."""
+        now = time.monotonic()
+        self._session_state(session_id).last_active = now
+        conn = self._sessions.get(session_id, {}).get(websocket)
+        metrics.WS_FRAMES_IN.inc()
+        metrics.WS_BYTES_IN.inc(len(data))
+        if conn is None:
+            return  # never connected, or evicted with frames still in flight
+        conn.last_seen = now
+        if self.recorder is not None:
+            self.recorder.frame(session_id, conn.id, data)
+        if not await self._admit(conn, session_id, len(data), now):
+            return
+        kind = frame_type(data)
+        if kind == COMPRESSED:
+            inflated = await self._inflate(conn, session_id, data, now)
+            if inflated is None:
+                return
+            data, kind = inflated, frame_type(inflated)
+        if kind in SERVER_FRAMES:
+            self._handle_server_frame(conn, session_id, kind, data[1:])
+            return
+        if kind == SYNC_UPDATE and len(data) > 1:
+            if self._apply(session_id, data[1:]):
+                self._persist(session_id, data[1:])
+            if self.coalesce_window_ms > 0:
+                self._buffer_update(websocket, session_id, data)
+                return
+        await self.broadcast_to_session(session_id, data, exclude=websocket)
+
+    async def _inflate(self, conn: Connection, session_id: str, data: bytes, now: float) -> bytes | None:
+        """The frame inside a 0x02 frame, or None if it is corrupt, too large or over the ingress limits."""
+        try:
+            inner = decompress_frame(data, self.max_frame_bytes)
+        except FrameTooLarge:
+            self._reject(conn, session_id, "frame_size")
+            return None
+        except ValueError:
+            return None
+        # Peers get the inflated frame, so the byte limits are charged for it too
+        extra = max(len(inner) - len(data), 0)
+        if not await self._admit(conn, session_id, extra, now, frames=0):
+            return None
+        if frame_type(inner) == COMPRESSED:
+            return None  # nested compression is not part of the protocol
+        return inner
+
+    def _handle_server_frame(self, conn: Connection, session_id: str, kind: int, payload: bytes) -> None:
+        if kind == PING:
+            self._enqueue(conn, session_id, PONG_FRAME)
+        elif kind == AWARENESS:
+            self._update_awareness(conn, session_id, payload)
+        elif kind == SYNC_REQUEST:
+            self._answer_sync(conn, session_id, payload)
+        elif kind == GENERATE:
+            if self._generate is not None:
+                self._generate(session_id, conn.websocket, payload)
+        elif kind == SYNC_REPLY and payload:
+            self._sync_reply(conn, session_id, payload)
 
     async def broadcast_to_session(
         self, session_id: str, message: bytes | str, exclude: WebSocket | None = None
     ) -> None:
-        if session_id not in self._sessions:
-            return
+        """Queue message for every peer in the session; never waits on a socket."""
         data: bytes = message.encode("utf-8") if isinstance(message, str) else message
-        dead: list[WebSocket] = []
-        for ws in self._sessions[session_id]:
+        self._fan_out(session_id, data, exclude)
+        if self.bus is not None:
+            self.bus.publish(session_id, data)
+
+    async def flush(self) -> None:
+        """Send any coalesced updates, then wait until every queued frame has been handed to its socket."""
+        for session_id in list(self._pending):
+            self._flush_updates(session_id)
+        queues = [conn.queue for conns in self._sessions.values() for conn in conns.values()]
+        await asyncio.gather(*(q.join() for q in queues))
+
+    async def _load_document(self, session_id: str) -> None:
+        """Rebuild a cold session's replica from its snapshot and log tail."""
+        if self.store is None or session_id in self._docs:
+            return
+        snapshot, tail = await asyncio.to_thread(self.store.load, session_id)
+        if session_id in self._docs:
+            return  # another connection loaded it while we were reading
+        if snapshot:
+            self._apply(session_id, snapshot)
+        state = self._session_state(session_id)
+        for update in tail:
+            self._apply(session_id, update)
+            state.log_count += 1
+            state.log_size += len(update)
+
+    def _session_state(self, session_id: str) -> SessionState:
+        state = self._state.get(session_id)
+        if state is None:
+            state = self._state[session_id] = SessionState()
+        return state
+
+    def _apply(self, session_id: str, update: bytes) -> bool:
+        """Apply an update to the session replica, tracking its approximate size."""
+        if not self.document(session_id).apply_update(update):
+            return False
+        self._session_state(session_id).doc_bytes += len(update)
+        return True
+
+    def _persist(self, session_id: str, update: bytes) -> None:
+        """Append to the session log; compact in a worker thread once it grows past the threshold."""
+        if self.store is None:
+            return
+        self.store.append(session_id, update)
+        state = self._session_state(session_id)
+        state.log_count += 1
+        state.log_size += len(update)
+        if state.compacting or (
+            state.log_count < self.compact_max_updates and state.log_size < self.compact_max_bytes
+        ):
+            return
+        state.compacting = True
+        state.log_count = state.log_size = 0
+        task = asyncio.create_task(self._compact(session_id, state))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _compact(self, session_id: str, state: SessionState) -> None:
+        try:
+            await asyncio.to_thread(self.store.compact, session_id)
+        except Exception:
+            pass  # the log is left as is and compaction is retried after the next threshold
+        finally:
+            state.compacting = False
+
+    def _fan_out(self, session_id: str, data: bytes, exclude: WebSocket | None) -> None:
+        conns = self._sessions.get(session_id)
+        if not conns:
+            return
+        start = time.perf_counter()
+        compressed: bytes | None = None
+        for ws, conn in list(conns.items()):
             if ws is exclude:
                 continue
+            if conn.compress and len(data) >= self.compress_min_bytes:
+                # Compress once per broadcast, not once per peer
+                if compressed is None:
+                    compressed = compress_frame(data)
+                self._enqueue(conn, session_id, compressed)
+                continue
+            self._enqueue(conn, session_id, data)
+        metrics.WS_FANOUT_SECONDS.observe(time.perf_counter() - start)
+
+    def _buffer_update(self, websocket: WebSocket, session_id: str, data: bytes) -> None:
+        """Hold an update frame until the session's window closes or its byte cap is reached."""
+        pending = self._pending.get(session_id)
+        if pending is None:
+            pending = self._pending[session_id] = PendingUpdates()
+            loop = asyncio.get_running_loop()
+            pending.timer = loop.call_later(self.coalesce_window_ms / 1000, self._flush_updates, session_id)
+        pending.frames.append(data)
+        pending.senders.add(websocket)
+        pending.size += len(data)
+        if pending.size >= self.coalesce_max_bytes:
+            self._flush_updates(session_id)
+
+    def _flush_updates(self, session_id: str) -> None:
+        """Merge the session's buffered updates and fan them out as one frame."""
+        pending = self._pending.pop(session_id, None)
+        if pending is None:
+            return
+        if pending.timer is not None:
+            pending.timer.cancel()
+        # A lone sender already has its own updates; with several senders each gets
+        # the merged frame back, which Yjs applies as a no-op for its own part.
+        exclude = next(iter(pending.senders)) if len(pending.senders) == 1 else None
+        for frame in coalesce_frames(pending.frames):
+            self._fan_out(session_id, frame, exclude)
+            if self.bus is not None:
+                self.bus.publish(session_id, frame)
+
+    def _on_bus_frame(self, session_id: str, frame: bytes) -> None:
+        """Handle a frame published by another worker for a session we have clients in."""
+        kind = frame_type(frame)
+        if kind == AWARENESS:
+            self._relay_awareness(session_id, frame)
+            return
+        if kind == SYNC_REQUEST:
+            self._answer_resync(session_id, frame[1:])
+            return
+        if kind == SYNC_REPLY:
+            self._apply_resync(session_id, frame[1:])
+            return
+        if kind == SYNC_UPDATE and len(frame) > 1:
+            # The originating worker persists it; here it only updates the replica
+            self._apply(session_id, frame[1:])
+        self._fan_out(session_id, frame, None)
+
+    def _answer_resync(self, session_id: str, payload: bytes) -> None:
+        """Send a resyncing worker the diff it is missing and, if it asks, our state vector in return."""
+        if len(payload) < 1 + BUS_ID_BYTES:
+            return
+        flag, requester = payload[0], payload[1 : 1 + BUS_ID_BYTES]
+        doc = self.document(session_id)
+        diff = doc.encode_state(payload[1 + BUS_ID_BYTES :])
+        if diff != EMPTY_UPDATE:
+            self.bus.publish(session_id, bytes([SYNC_REPLY]) + requester + diff)
+        if flag == RESYNC_ASK_BACK:
+            self._publish_resync(session_id, RESYNC_ANSWER_ONLY)
+
+    def _apply_resync(self, session_id: str, payload: bytes) -> None:
+        """Apply a catch-up diff addressed to this worker and pass it on to local clients, who missed it too."""
+        if payload[:BUS_ID_BYTES] != self._bus_id:
+            return
+        update = payload[BUS_ID_BYTES:]
+        if self._apply(session_id, update):
+            self._fan_out(session_id, bytes([SYNC_UPDATE]) + update, None)
+
+    def _publish_resync(self, session_id: str, flag: int) -> None:
+        doc = self.document(session_id)
+        self.bus.publish(session_id, bytes([SYNC_REQUEST, flag]) + self._bus_id + doc.state_vector())
+
+    @staticmethod
+    def _bucket(rate: float) -> TokenBucket | None:
+        return TokenBucket(rate, rate * INGRESS_BURST_SECONDS) if rate > 0 else None
+
+    async def _admit(self, conn: Connection, session_id: str, size: int, now: float, frames: int = 1) -> bool:
+        """Apply the frame size cap and ingress rate limits; False means the frame is discarded."""
+        if size > self.max_frame_bytes:
+            return self._reject(conn, session_id, "frame_size")
+        state = self._session_state(session_id)
+        checks = [
+            (limit, bucket, amount)
+            for limit, bucket, amount in (
+                ("connection_frames", conn.frame_bucket, frames),
+                ("connection_bytes", conn.byte_bucket, size),
+                ("session_frames", state.frame_bucket, frames),
+                ("session_bytes", state.byte_bucket, size),
+            )
+            if bucket is not None
+        ]
+        if self.ingress_policy == INGRESS_DELAY:
+            waits = [(bucket.consume(amount, now), limit) for limit, bucket, amount in checks]
+            wait, limit = max(waits, default=(0.0, ""))
+            if wait <= 0:
+                return True
+            metrics.WS_INGRESS_LIMITED.inc(labels=(limit, INGRESS_DELAY))
+            await asyncio.sleep(wait)
+            # The client may have gone (or been evicted) while we held its frame
+            return self._sessions.get(session_id, {}).get(conn.websocket) is conn
+        for limit, bucket, amount in checks:
+            if not bucket.available(amount, now):
+                return self._reject(conn, session_id, limit)
+        for _limit, bucket, amount in checks:
+            bucket.consume(amount, now)
+        return True
+
+    def _reject(self, conn: Connection, session_id: str, limit: str) -> bool:
+        conn.rejected += 1
+        if self.ingress_policy == INGRESS_CLOSE:
+            metrics.WS_INGRESS_LIMITED.inc(labels=(limit, INGRESS_CLOSE))
+            code = CLOSE_FRAME_TOO_LARGE if limit == "frame_size" else CLOSE_RATE_LIMITED
+            self._evict(conn, session_id, code)
+        else:
+            metrics.WS_INGRESS_LIMITED.inc(labels=(limit, INGRESS_DROP))
+        return False
+
+    def _update_awareness(self, conn: Connection, session_id: str, payload: bytes) -> None:
+        """Keep the client's latest presence state; peers get it on the session's next awareness tick."""
+        try:
+            state = parse_client_state(payload, self.awareness_max_bytes)
+        except ValueError:
+            return
+        awareness = self._awareness.get(session_id)
+        if awareness is None:
+            awareness = self._awareness[session_id] = SessionAwareness()
+        if awareness.set(conn.awareness_key, state):
+            self._schedule_awareness(session_id, awareness)
+
+    def _schedule_awareness(self, session_id: str, awareness: SessionAwareness) -> None:
+        if awareness.timer is None:
+            loop = asyncio.get_running_loop()
+            awareness.timer = loop.call_later(1 / self.awareness_hz, self._flush_awareness, session_id)
+
+    def _flush_awareness(self, session_id: str) -> None:
+        """Send what changed since the last tick: one shared frame, minus each sender's own entry."""
+        awareness = self._awareness.get(session_id)
+        if awareness is None:
+            return
+        if awareness.timer is not None:
+            awareness.timer.cancel()
+            awareness.timer = None
+        diff = awareness.take_diff()
+        if not diff:
+            return
+        frame = encode_awareness(diff)
+        for conn in self._sessions.get(session_id, {}).values():
+            if conn.awareness_key in diff:
+                own = {key: state for key, state in diff.items() if key != conn.awareness_key}
+                if own:
+                    self._send_awareness(conn, own)
+                continue
+            self._send_awareness(conn, diff, frame)
+        if self.bus is not None:
+            self.bus.publish(session_id, frame)
+
+    def _relay_awareness(self, session_id: str, frame: bytes) -> None:
+        """Remember another worker's awareness diff (for later joiners) and pass it to local clients."""
+        try:
+            diff = decode_awareness(frame)
+        except ValueError:
+            return
+        awareness = self._awareness.get(session_id)
+        if awareness is None:
+            awareness = self._awareness[session_id] = SessionAwareness()
+        awareness.merge(diff)
+        for conn in self._sessions.get(session_id, {}).values():
+            self._send_awareness(conn, diff, frame)
+
+    def _send_awareness(self, conn: Connection, entries: AwarenessEntries, frame: bytes | None = None) -> None:
+        """
+        Queue awareness only behind an idle queue, so it never delays document frames.
+        Otherwise entries wait on the connection, newest state per client, until the writer catches up.
+        """
+        if conn.awareness or not conn.queue.empty():
+            conn.awareness.update(entries)
+            return
+        self._put(conn, frame or encode_awareness(entries))
+
+    def _resync(self, session_id: str) -> None:
+        """Exchange state with other workers after (re)subscribing, since frames may have been missed."""
+        self._publish_resync(session_id, RESYNC_ASK_BACK)
+
+    def _answer_sync(self, conn: Connection, session_id: str, state_vector: bytes) -> None:
+        """Reply to a sync request with one update sent to the requester only."""
+        doc = self.document(session_id)
+        if doc.is_empty():
+            # Cold replica (e.g. after a restart): ask the requester to seed it with its own state,
+            # and one elected peer for the document the requester is missing
+            self._enqueue(conn, session_id, bytes([SYNC_REQUEST]))
+            self._route_sync(conn, session_id)
+            return
+        self._send_reply(conn, session_id, bytes([SYNC_UPDATE]) + doc.encode_state(state_vector))
+
+    def _send_reply(self, conn: Connection, session_id: str, reply: bytes) -> None:
+        if conn.compress and len(reply) >= self.compress_min_bytes:
+            reply = compress_frame(reply)
+        self._enqueue(conn, session_id, reply)
+
+    def _route_sync(self, conn: Connection, session_id: str) -> None:
+        """Join the session's pending sync, or start one, so a join storm costs one peer transfer."""
+        pending = self._syncs.get(session_id)
+        if pending is not None:
+            pending.requesters.add(conn.websocket)
+            return
+        pending = self._syncs[session_id] = PendingSync()
+        pending.requesters.add(conn.websocket)
+        self._ask_next_peer(session_id)
+
+    def _ask_next_peer(self, session_id: str) -> None:
+        """Send the sync request to the least-loaded, longest-connected peer not yet tried."""
+        pending = self._syncs[session_id]
+        if pending.timer is not None:
+            pending.timer.cancel()
+        candidates = [
+            c
+            for ws, c in self._sessions.get(session_id, {}).items()
+            if ws not in pending.requesters and c.id not in pending.tried
+        ]
+        if not candidates:
+            del self._syncs[session_id]
+            return
+        peer = min(candidates, key=lambda c: (c.queue.qsize(), c.id))
+        pending.peer = peer
+        pending.tried.add(peer.id)
+        self._enqueue(peer, session_id, bytes([SYNC_REQUEST]) + self.document(session_id).state_vector())
+        loop = asyncio.get_running_loop()
+        pending.timer = loop.call_later(self.sync_peer_timeout, self._sync_timeout, session_id)
+
+    def _sync_timeout(self, session_id: str) -> None:
+        if session_id in self._syncs:
+            self._ask_next_peer(session_id)
+
+    def _sync_reply(self, conn: Connection, session_id: str, update: bytes) -> None:
+        """A peer's 0x08 answer seeds the replica; from the elected peer it also completes the pending sync."""
+        if self._apply(session_id, update):
+            self._persist(session_id, update)
+        pending = self._syncs.get(session_id)
+        # A late answer from a peer that timed out is not sent: the requesters got another one
+        if pending is not None and pending.peer is conn:
+            self._complete_sync(session_id, pending, bytes([SYNC_UPDATE]) + update)
+
+    def _complete_sync(self, session_id: str, pending: PendingSync, frame: bytes) -> None:
+        """The elected peer's state goes to the waiting requesters only."""
+        if pending.timer is not None:
+            pending.timer.cancel()
+        del self._syncs[session_id]
+        conns = self._sessions.get(session_id, {})
+        for ws in pending.requesters:
+            requester = conns.get(ws)
+            if requester is not None:
+                self._send_reply(requester, session_id, frame)
+
+    def _forget_sync(self, session_id: str, conn: Connection) -> None:
+        """A requester or the elected peer left; move on without waiting for the timeout."""
+        pending = self._syncs.get(session_id)
+        if pending is None:
+            return
+        pending.requesters.discard(conn.websocket)
+        if not pending.requesters:
+            if pending.timer is not None:
+                pending.timer.cancel()
+            del self._syncs[session_id]
+        elif pending.peer is conn:
+            self._ask_next_peer(session_id)
+
+    def _enqueue(self, conn: Connection, session_id: str, data: bytes) -> None:
+        if self._can_queue(conn, len(data)):
+            self._put(conn, data)
+            return
+        if self.slow_consumer_policy == SLOW_CONSUMER_DISCONNECT:
+            self._evict(conn, session_id, CLOSE_SLOW_CONSUMER)
+            return
+        if self.slow_consumer_policy == SLOW_CONSUMER_COALESCE:
+            backlog = self._drain(conn)
+            backlog.append(data)
+            for frame in coalesce_frames(backlog):
+                if self._can_queue(conn, len(frame)):
+                    self._put(conn, frame)
+                else:
+                    self._drop(conn)
+            return
+        self._drop(conn)
+
+    @staticmethod
+    def _drop(conn: Connection) -> None:
+        conn.dropped += 1
+        metrics.WS_DROPPED_FRAMES.inc()
+
+    def _can_queue(self, conn: Connection, size: int) -> bool:
+        """Room in the queue and in the byte budgets; an idle queue always takes one frame."""
+        if conn.queue.full():
+            return False
+        if conn.queue.empty():
+            return True
+        state = self._session_state(conn.session_id)
+        return (
+            state.buffered + size <= self.max_buffered_bytes_per_session
+            and self._buffered + size <= self.max_buffered_bytes
+        )
+
+    def _put(self, conn: Connection, data: bytes) -> None:
+        conn.queue.put_nowait(data)
+        self._account(conn, len(data))
+
+    def _account(self, conn: Connection, delta: int) -> None:
+        conn.buffered += delta
+        self._session_state(conn.session_id).buffered += delta
+        self._buffered += delta
+
+    async def _write_loop(self, conn: Connection) -> None:
+        while True:
+            data = await conn.queue.get()
+            self._account(conn, -len(data))
+            start = time.perf_counter()
             try:
-                await ws.send_bytes(data)
+                await conn.websocket.send_bytes(data)
             except Exception:
-                dead.append(ws)
-        for ws in dead:
-            self.disconnect(ws, session_id)
+                metrics.WS_DEAD_SOCKETS.inc()
+                self.disconnect(conn.websocket, conn.session_id)
+                return
+            finally:
+                conn.queue.task_done()
+            metrics.WS_SEND_SECONDS.observe(time.perf_counter() - start)
+            metrics.WS_FRAMES_OUT.inc()
+            metrics.WS_BYTES_OUT.inc(len(data))
+            if conn.awareness and conn.queue.empty():
+                self._put(conn, encode_awareness(conn.awareness))
+                conn.awareness = {}
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            self.evict_idle()
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            self.heartbeat()
+
+    def _evict(self, conn: Connection, session_id: str, code: int) -> None:
+        """Drop conn from the session and close its socket in the background."""
+        self.disconnect(conn.websocket, session_id)
+        task = asyncio.create_task(self._close(conn.websocket, code))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    @staticmethod
+    async def _close(websocket: WebSocket, code: int) -> None:
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    def _drain(self, conn: Connection) -> list[bytes]:
+        backlog: list[bytes] = []
+        while not conn.queue.empty():
+            data = conn.queue.get_nowait()
+            conn.queue.task_done()
+            self._account(conn, -len(data))
+            backlog.append(data)
+        return backlog
+
+    def _stop(self, conn: Connection) -> None:
+        if conn.writer is not None and conn.writer is not asyncio.current_task():
+            conn.writer.cancel()
+        self._drain(conn)
 
 
-manager = ConnectionManager()
+manager = ConnectionManager(
+    store=open_store(SESSION_STORE_PATH),
+    bus=UnixSocketBus(SESSION_BUS_PATH) if SESSION_BUS_PATH else None,
+    recorder=open_recorder(RECORD_PATH),
+)
+metrics.WS_SESSIONS.set_function(lambda: len(manager._sessions))
+metrics.WS_CONNECTIONS.set_function(lambda: len(manager._connections))
+metrics.WS_BUFFERED_BYTES.set_function(lambda: manager._buffered)
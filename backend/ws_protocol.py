@@ -0,0 +1,78 @@
+"""
+Binary frame protocol for /ws/story/{session_id}.
+Mirrors frontend/src/yjsProvider.ts: the first byte is the message type.
+0x02 wraps another frame compressed with zlib; it is only sent to clients that
+connect with ?compress=deflate.
+0x03 / 0x04 are heartbeat ping / pong; either side may ping and the other answers.
+0x05 carries ephemeral awareness (presence) state as JSON and is never persisted.
+0x06 asks the server to continue the story (JSON request); 0x07 streams the
+generation's JSON events to every client in the session.
+0x08 is a client's answer to a 0x00 that carries a state vector: the update the
+sender of that vector is missing. Unlike 0x01 it is not broadcast.
+"""
+
+import zlib
+
+from pycrdt import merge_updates
+
+SYNC_REQUEST = 0x00
+SYNC_UPDATE = 0x01
+COMPRESSED = 0x02
+PING = 0x03
+PONG = 0x04
+AWARENESS = 0x05
+GENERATE = 0x06
+GENERATION = 0x07
+SYNC_REPLY = 0x08
+
+COMPRESSION_DEFLATE = "deflate"
+# Keystroke-sized updates are not worth compressing
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 6
+# Upper bound on an inflated client frame (guards against zip bombs)
+MAX_DECOMPRESSED_BYTES = 16 * 1024 * 1024
+
+
+class FrameTooLarge(ValueError):
+    """A compressed frame that inflates past the allowed size."""
+
+
+def frame_type(data: bytes) -> int | None:
+    """Return the type byte of a frame, or None for an empty frame."""
+    return data[0] if data else None
+
+
+def compress_frame(data: bytes, level: int = COMPRESS_LEVEL) -> bytes:
+    """Wrap a frame as 0x02 + zlib(frame)."""
+    return bytes([COMPRESSED]) + zlib.compress(data, level)
+
+
+def decompress_frame(data: bytes, max_size: int = MAX_DECOMPRESSED_BYTES) -> bytes:
+    """Unwrap a 0x02 frame. Raises FrameTooLarge past max_size, and ValueError if it is corrupt."""
+    inflater = zlib.decompressobj()
+    try:
+        inner = inflater.decompress(data[1:], max_size)
+    except zlib.error as e:
+        raise ValueError(f"Invalid compressed frame: {e}") from e
+    if inflater.unconsumed_tail:
+        raise FrameTooLarge(f"Compressed frame inflates past {max_size} bytes")
+    if not inflater.eof:
+        raise ValueError("Compressed frame is truncated")
+    return inner
+
+
+def coalesce_frames(frames: list[bytes]) -> list[bytes]:
+    """
+    Merge every Yjs update frame into a single update frame.
+    Other frames are kept in their original order after the merged update.
+    If the updates cannot be merged, the frames are returned unchanged.
+    """
+    updates = [f[1:] for f in frames if frame_type(f) == SYNC_UPDATE and len(f) > 1]
+    if len(updates) < 2:
+        return list(frames)
+    try:
+        merged = merge_updates(*updates)
+    except ValueError:
+        return list(frames)
+    others = [f for f in frames if not (frame_type(f) == SYNC_UPDATE and len(f) > 1)]
+    return [bytes([SYNC_UPDATE]) + merged] + others
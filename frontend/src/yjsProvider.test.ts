@@ -4,8 +4,33 @@ import { createStoryProvider, getWsUrl } from './yjsProvider'
 
 const SYNC_REQUEST = 0x00
 const SYNC_UPDATE = 0x01
+const COMPRESSED = 0x02
+const PING = 0x03
+const PONG = 0x04
+const AWARENESS = 0x05
+const GENERATE = 0x06
+const GENERATION = 0x07
+const SYNC_REPLY = 0x08
 const OPEN = 1
 
+// 0x02 + zlib(frame), as the server's compress_frame builds it
+async function compressed(frame: Uint8Array<ArrayBuffer>): Promise<Uint8Array<ArrayBuffer>> {
+  const stream = new Response(frame).body!.pipeThrough(new CompressionStream('deflate'))
+  const body = new Uint8Array(await new Response(stream).arrayBuffer())
+  const msg = new Uint8Array(1 + body.length)
+  msg[0] = COMPRESSED
+  msg.set(body, 1)
+  return msg
+}
+
+function generationFrame(event: object): Uint8Array<ArrayBuffer> {
+  const body = new TextEncoder().encode(JSON.stringify(event))
+  const msg = new Uint8Array(1 + body.length)
+  msg[0] = GENERATION
+  msg.set(body, 1)
+  return msg
+}
+
 describe('createStoryProvider', () => {
   beforeEach(() => {
     vi.useFakeTimers()
@@ -104,6 +129,30 @@ describe('createStoryProvider', () => {
     doc.destroy()
   })
 
+  it('onmessage SYNC_REQUEST with a state vector answers with SYNC_REPLY', async () => {
+    const doc = new Y.Doc()
+    doc.getText('story').insert(0, 'hi')
+    const { connect } = createStoryProvider('s1', doc)
+    connect()
+    await vi.runAllTimersAsync()
+    const Ws = WebSocket as ReturnType<typeof vi.fn>
+    const ws = Ws.mock.results[0]?.value
+    const vector = Y.encodeStateVector(new Y.Doc())
+    const msg = new Uint8Array(1 + vector.length)
+    msg[0] = SYNC_REQUEST
+    msg.set(vector, 1)
+    ws.send.mockClear()
+    ws._triggerMessage(new MessageEvent('message', { data: msg.buffer }))
+    expect(ws.send).toHaveBeenCalledTimes(1)
+    const sent = ws.send.mock.calls[0][0] as Uint8Array
+    expect(sent[0]).toBe(SYNC_REPLY)
+    const copy = new Y.Doc()
+    Y.applyUpdate(copy, sent.subarray(1))
+    expect(copy.getText('story').toString()).toBe('hi')
+    copy.destroy()
+    doc.destroy()
+  })
+
   it('onmessage SYNC_UPDATE applies update to doc', async () => {
     const doc = new Y.Doc()
     const ref = new Y.Doc()
@@ -134,6 +183,117 @@ describe('createStoryProvider', () => {
     doc.destroy()
   })
 
+  it('onmessage PING replies with PONG', async () => {
+    const doc = new Y.Doc()
+    const { connect } = createStoryProvider('s1', doc)
+    connect()
+    await vi.runAllTimersAsync()
+    const Ws = WebSocket as ReturnType<typeof vi.fn>
+    const ws = Ws.mock.results[0]?.value
+    ws._triggerMessage(new MessageEvent('message', { data: new Uint8Array([PING]).buffer }))
+    const last = ws.send.mock.calls[ws.send.mock.calls.length - 1][0] as Uint8Array
+    expect(Array.from(last)).toEqual([PONG])
+    doc.destroy()
+  })
+
+  it('setAwareness sends JSON state and onmessage AWARENESS applies peer diffs', async () => {
+    const doc = new Y.Doc()
+    const onAwareness = vi.fn()
+    const { connect, setAwareness } = createStoryProvider('s1', doc, onAwareness)
+    connect()
+    await vi.runAllTimersAsync()
+    const Ws = WebSocket as ReturnType<typeof vi.fn>
+    const ws = Ws.mock.results[0]?.value
+    setAwareness({ cursor: 3 })
+    const sent = ws.send.mock.calls[ws.send.mock.calls.length - 1][0] as Uint8Array
+    expect(sent[0]).toBe(AWARENESS)
+    expect(JSON.parse(new TextDecoder().decode(sent.subarray(1)))).toEqual({ cursor: 3 })
+    setAwareness(null)
+    const cleared = ws.send.mock.calls[ws.send.mock.calls.length - 1][0] as Uint8Array
+    expect(Array.from(cleared)).toEqual([AWARENESS])
+    const frame = (diff: object) => {
+      const body = new TextEncoder().encode(JSON.stringify(diff))
+      const msg = new Uint8Array(1 + body.length)
+      msg[0] = AWARENESS
+      msg.set(body, 1)
+      return new MessageEvent('message', { data: msg.buffer })
+    }
+    ws._triggerMessage(frame({ a: { cursor: 1 }, b: { typing: true } }))
+    ws._triggerMessage(frame({ a: null }))
+    const states = onAwareness.mock.calls[1][0] as Map<string, unknown>
+    expect(Array.from(states.entries())).toEqual([['b', { typing: true }]])
+    doc.destroy()
+  })
+
+  it('generate sends a request and onmessage GENERATION reports events', async () => {
+    const doc = new Y.Doc()
+    const onGeneration = vi.fn()
+    const { connect, generate } = createStoryProvider('s1', doc, undefined, onGeneration)
+    connect()
+    await vi.runAllTimersAsync()
+    const Ws = WebSocket as ReturnType<typeof vi.fn>
+    const ws = Ws.mock.results[0]?.value
+    generate('a dragon')
+    const sent = ws.send.mock.calls[ws.send.mock.calls.length - 1][0] as Uint8Array
+    expect(sent[0]).toBe(GENERATE)
+    expect(JSON.parse(new TextDecoder().decode(sent.subarray(1)))).toEqual({ user_input: 'a dragon' })
+    const body = new TextEncoder().encode(JSON.stringify({ id: 1, event: 'token', text: 'Once' }))
+    const msg = new Uint8Array(1 + body.length)
+    msg[0] = GENERATION
+    msg.set(body, 1)
+    ws._triggerMessage(new MessageEvent('message', { data: msg.buffer }))
+    expect(onGeneration).toHaveBeenCalledWith({ id: 1, event: 'token', text: 'Once' })
+    doc.destroy()
+  })
+
+  it('onmessage ignores malformed AWARENESS and GENERATION frames', async () => {
+    const doc = new Y.Doc()
+    const onAwareness = vi.fn()
+    const onGeneration = vi.fn()
+    const { connect } = createStoryProvider('s1', doc, onAwareness, onGeneration)
+    connect()
+    await vi.runAllTimersAsync()
+    const Ws = WebSocket as ReturnType<typeof vi.fn>
+    const ws = Ws.mock.results[0]?.value
+    const bad = [[AWARENESS, '{nope'], [AWARENESS, '[1]'], [GENERATION, 'NaN'], [GENERATION, 'null']] as const
+    for (const [type, text] of bad) {
+      const body = new TextEncoder().encode(text)
+      const msg = new Uint8Array(1 + body.length)
+      msg[0] = type
+      msg.set(body, 1)
+      expect(() => ws._triggerMessage(new MessageEvent('message', { data: msg.buffer }))).not.toThrow()
+    }
+    expect(onAwareness).not.toHaveBeenCalled()
+    expect(onGeneration).not.toHaveBeenCalled()
+    doc.destroy()
+  })
+
+  it('onmessage COMPRESSED frames are inflated and keep their order', async () => {
+    const doc = new Y.Doc()
+    const onGeneration = vi.fn()
+    const { connect } = createStoryProvider('s1', doc, undefined, onGeneration)
+    connect()
+    await vi.runAllTimersAsync()
+    const Ws = WebSocket as ReturnType<typeof vi.fn>
+    const ws = Ws.mock.results[0]?.value
+    const message = (msg: Uint8Array<ArrayBuffer>) => new MessageEvent('message', { data: msg.buffer })
+    const other = new Y.Doc()
+    other.getText('story').insert(0, 'Once upon a time')
+    const update = Y.encodeStateAsUpdate(other)
+    const syncFrame = new Uint8Array(1 + update.length)
+    syncFrame[0] = SYNC_UPDATE
+    syncFrame.set(update, 1)
+    ws._triggerMessage(message(await compressed(syncFrame)))
+    ws._triggerMessage(message(await compressed(generationFrame({ id: 1, event: 'token', text: 'Once' }))))
+    ws._triggerMessage(message(new Uint8Array([COMPRESSED, 1, 2, 3]))) // corrupt: dropped
+    ws._triggerMessage(message(generationFrame({ id: 1, event: 'done' })))
+    await vi.waitFor(() => expect(onGeneration).toHaveBeenCalledTimes(2))
+    expect(onGeneration.mock.calls.map((c) => (c[0] as { event: string }).event)).toEqual(['token', 'done'])
+    expect(doc.getText('story').toString()).toBe('Once upon a time')
+    other.destroy()
+    doc.destroy()
+  })
+
   it('doc update sends SYNC_UPDATE', async () => {
     const doc = new Y.Doc()
     const yText = doc.getText('story')
@@ -174,14 +334,19 @@ describe('createStoryProvider', () => {
     vi.stubGlobal('window', {
       location: { protocol: 'https:', host: 'localhost:5173' },
     })
-    expect(getWsUrl('room1')).toMatch(/^wss:\/\/localhost:5173\/ws\/story\/room1$/)
+    expect(getWsUrl('room1')).toMatch(/^wss:\/\/localhost:5173\/ws\/story\/room1\?compress=deflate$/)
   })
 
   it('getWsUrl returns ws when protocol is http', () => {
     vi.stubGlobal('window', {
       location: { protocol: 'http:', host: 'example.com' },
     })
-    expect(getWsUrl('s1')).toMatch(/^ws:\/\/example\.com\/ws\/story\/s1$/)
+    expect(getWsUrl('s1')).toMatch(/^ws:\/\/example\.com\/ws\/story\/s1\?compress=deflate$/)
+  })
+
+  it('getWsUrl asks for compression only when the browser can inflate', () => {
+    vi.stubGlobal('DecompressionStream', undefined)
+    expect(getWsUrl('s1')).toMatch(/\/ws\/story\/s1$/)
   })
 
   it('getWsUrl encodes session id', () => {
@@ -1,30 +1,95 @@
 /**
  * Custom Yjs WebSocket provider for SafeTale Sync.
  * Connects to FastAPI /ws/story/{session_id} and syncs Y.Doc via binary messages.
- * Protocol: 0x00 = sync request, 0x01 = Yjs update payload.
+ * Protocol: 0x00 = sync request, 0x01 = Yjs update payload, 0x03 / 0x04 = heartbeat ping / pong,
+ * 0x02 = another frame, zlib-compressed (only sent to us because the URL asks for it),
+ * 0x05 = awareness (presence) as JSON: our own state out, a diff of peers' states in,
+ * 0x06 = story generation request (JSON), 0x07 = generation events (JSON) shared by the whole session,
+ * 0x08 = our answer to a 0x00 that carries a state vector (sent to the requesters only, not broadcast).
  */
 
 import * as Y from 'yjs'
 
 const SYNC_REQUEST = 0x00
 const SYNC_UPDATE = 0x01
+const COMPRESSED = 0x02
+const PING = 0x03
+const PONG = 0x04
+const AWARENESS = 0x05
+const GENERATE = 0x06
+const GENERATION = 0x07
+const SYNC_REPLY = 0x08
+
+export type AwarenessStates = Map<string, unknown>
+
+export interface GenerationEvent {
+  id?: number
+  event: 'start' | 'token' | 'done' | 'error' | 'joined' | 'queued' | 'busy'
+  text?: string
+  position?: number
+}
+
+// A malformed JSON frame is dropped rather than breaking the socket's message handler
+function parseJsonObject(body: Uint8Array): Record<string, unknown> | null {
+  try {
+    const value: unknown = JSON.parse(new TextDecoder().decode(body))
+    return typeof value === 'object' && value !== null && !Array.isArray(value)
+      ? (value as Record<string, unknown>)
+      : null
+  } catch {
+    return null
+  }
+}
+
+async function inflate(body: Uint8Array<ArrayBuffer>): Promise<Uint8Array<ArrayBuffer>> {
+  const stream = new Response(body).body!.pipeThrough(new DecompressionStream('deflate'))
+  return new Uint8Array(await new Response(stream).arrayBuffer())
+}
 
 export function getWsUrl(sessionId: string): string {
   const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:'
   const base = `${protocol}//${window.location.host}`
-  return `${base}/ws/story/${encodeURIComponent(sessionId)}`
+  // Large syncs arrive compressed when the browser can inflate them
+  const query = typeof DecompressionStream === 'undefined' ? '' : '?compress=deflate'
+  return `${base}/ws/story/${encodeURIComponent(sessionId)}${query}`
 }
 
-export function createStoryProvider(sessionId: string, doc: Y.Doc): {
+export function createStoryProvider(
+  sessionId: string,
+  doc: Y.Doc,
+  onAwareness?: (states: AwarenessStates) => void,
+  onGeneration?: (event: GenerationEvent) => void,
+): {
   connect: () => void
   disconnect: () => void
+  setAwareness: (state: unknown) => void
+  generate: (userInput: string, storyContext?: string) => void
 } {
   let ws: WebSocket | null = null
+  const peers: AwarenessStates = new Map()
+
+  const setAwareness = (state: unknown) => {
+    if (!ws || ws.readyState !== WebSocket.OPEN) return
+    const body = state == null ? new Uint8Array(0) : new TextEncoder().encode(JSON.stringify(state))
+    const msg = new Uint8Array(1 + body.length)
+    msg[0] = AWARENESS
+    msg.set(body, 1)
+    ws.send(msg)
+  }
+
+  const generate = (userInput: string, storyContext?: string) => {
+    if (!ws || ws.readyState !== WebSocket.OPEN) return
+    const body = new TextEncoder().encode(JSON.stringify({ user_input: userInput, story_context: storyContext }))
+    const msg = new Uint8Array(1 + body.length)
+    msg[0] = GENERATE
+    msg.set(body, 1)
+    ws.send(msg)
+  }
 
-  const sendUpdate = (update: Uint8Array) => {
+  const sendUpdate = (update: Uint8Array, type: number = SYNC_UPDATE) => {
     if (!ws || ws.readyState !== WebSocket.OPEN) return
     const msg = new Uint8Array(1 + update.length)
-    msg[0] = SYNC_UPDATE
+    msg[0] = type
     msg.set(update, 1)
     ws.send(msg)
   }
@@ -48,11 +113,35 @@ export function createStoryProvider(sessionId: string, doc: Y.Doc): {
       requestSync()
     }
 
-    ws.onmessage = (event: MessageEvent<ArrayBuffer>) => {
-      const data = new Uint8Array(event.data)
+    const handleFrame = (data: Uint8Array<ArrayBuffer>) => {
       if (data.length === 0) return
       const type = data[0]
+      if (type === PING) {
+        ws?.send(new Uint8Array([PONG]))
+        return
+      }
+      if (type === AWARENESS) {
+        const diff = parseJsonObject(data.subarray(1))
+        if (diff == null) return
+        for (const [key, state] of Object.entries(diff)) {
+          if (state === null) peers.delete(key)
+          else peers.set(key, state)
+        }
+        onAwareness?.(peers)
+        return
+      }
+      if (type === GENERATION) {
+        const event = parseJsonObject(data.subarray(1))
+        if (event != null) onGeneration?.(event as unknown as GenerationEvent)
+        return
+      }
       if (type === SYNC_REQUEST) {
+        if (data.length > 1) {
+          // The server asks for what the joiners behind this state vector are missing
+          sendUpdate(Y.encodeStateAsUpdate(doc, data.subarray(1)), SYNC_REPLY)
+          return
+        }
+        // A bare request: seed the server's empty replica, and through it the session
         const state = Y.encodeStateAsUpdate(doc)
         if (state.length > 0) sendUpdate(state)
         return
@@ -64,8 +153,28 @@ export function createStoryProvider(sessionId: string, doc: Y.Doc): {
       }
     }
 
+    // Inflating is async: frames behind a compressed one wait for it, so they keep their order
+    let inflating: Promise<void> | null = null
+
+    ws.onmessage = (event: MessageEvent<ArrayBuffer>) => {
+      const data = new Uint8Array(event.data)
+      if (data.length === 0) return
+      if (data[0] !== COMPRESSED && inflating == null) {
+        handleFrame(data)
+        return
+      }
+      const next: Promise<void> = (inflating ?? Promise.resolve())
+        .then(async () => handleFrame(data[0] === COMPRESSED ? await inflate(data.subarray(1)) : data))
+        .catch(() => {}) // a corrupt compressed frame is dropped
+        .then(() => {
+          if (inflating === next) inflating = null
+        })
+      inflating = next
+    }
+
     ws.onclose = () => {
       ws = null
+      peers.clear()
     }
 
     ws.onerror = () => {
@@ -80,5 +189,5 @@ export function createStoryProvider(sessionId: string, doc: Y.Doc): {
     }
   }
 
-  return { connect, disconnect }
+  return { connect, disconnect, setAwareness, generate }
 }